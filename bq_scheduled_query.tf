@@ -12,21 +12,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# The scheduled query of every pair starts zombies_schedule_offsets minutes after the time of a zombies_schedule of
+# the form "every day HH:MM", so the heavy queries do not all queue for slots at once. Other schedules are used as is.
+locals {
+  zombies_schedule_time = try(regex("^(.* )(\\d{2}):(\\d{2})$", var.zombies_schedule), null)
+  low_volume_skus_schedules = {
+    for pair in var.accounts_table : "${pair.mc}_${pair.gads}" => (
+      local.zombies_schedule_time == null ? var.zombies_schedule : format("%s%s", local.zombies_schedule_time[0], formatdate("hh:mm", timeadd(
+        "2000-01-01T${local.zombies_schedule_time[1]}:${local.zombies_schedule_time[2]}:00Z",
+        "${lookup(var.zombies_schedule_offsets, "${pair.mc}_${pair.gads}", 0)}m"
+      )))
+    )
+  }
+}
+
 resource "google_bigquery_data_transfer_config" "low_volume_skus_query" {
   depends_on = [google_project_iam_member.permissions_token,
     google_project_service.enable_bqdt,
     google_pubsub_topic.zombies_bq_sq_completed_topic,
-    google_bigquery_dataset.zombies_dataset
+    google_bigquery_dataset.zombies_dataset,
+    google_bigquery_data_transfer_config.targeted_products_refresh,
+    google_bigquery_data_transfer_config.offer_daily_stats_refresh
   ]
-  for_each = { for pair in var.accounts_table : pair.mc => pair }
+  for_each = { for pair in var.accounts_table : "${pair.mc}_${pair.gads}" => pair }
 
   display_name              = "low_volume_skus_${each.value.mc}_${each.value.gads}"
   location                  = var.zombies_data_location
   data_source_id            = "scheduled_query"
-  schedule                  = var.zombies_schedule
+  schedule                  = local.low_volume_skus_schedules["${each.value.mc}_${each.value.gads}"]
   destination_dataset_id    = google_bigquery_dataset.zombies_dataset.dataset_id
   service_account_name      = google_service_account.service_account.email
 
+  schedule_options {
+    disable_auto_scheduling = var.zombies_readiness_gating
+  }
+
+  lifecycle {
+    precondition {
+      condition     = !var.zombies_readiness_gating || var.zombies_readiness_trigger != ""
+      error_message = "zombies_readiness_gating disables the schedule of the low volume skus queries, set zombies_readiness_trigger to the job running src/bq_transfers/readiness.py every day."
+    }
+  }
+
   notification_pubsub_topic = google_pubsub_topic.zombies_bq_sq_completed_topic.id
   params = {
     destination_table_name_template = "LowVolumeSkus_${each.value.mc}_${each.value.gads}_{run_time|\"%Y%m%d\"}",
@@ -47,6 +74,36 @@ resource "google_bigquery_data_transfer_config" "low_volume_skus_query" {
       # limitations under the License.
 
       WITH
+%{ if var.zombies_incremental_aggregates ~}
+        offer_ids_with_group AS (
+        SELECT
+          offer_id,
+          item_group_id,
+          feed_label
+        FROM
+          `${var.gcp_project}.${var.zombies_dataset_name}.offer_daily_groups_${each.value.mc}_${each.value.gads}`
+        WHERE
+          _DATA_DATE BETWEEN DATE_ADD(@run_date, INTERVAL -31 DAY)
+          AND DATE_ADD(@run_date, INTERVAL -1 DAY)
+        GROUP BY
+          item_group_id,
+          offer_id,
+          feed_label ),
+        offer_ids_with_stats AS (
+        SELECT
+          offer_id,
+          SUM(clicks) AS clicks,
+          SUM(impressions) AS impressions,
+          country,
+        FROM
+          `${var.gcp_project}.${var.zombies_dataset_name}.offer_daily_stats_${each.value.mc}_${each.value.gads}`
+        WHERE
+          _DATA_DATE BETWEEN DATE_ADD(@run_date, INTERVAL -31 DAY)
+          AND DATE_ADD(@run_date, INTERVAL -1 DAY)
+        GROUP BY
+          offer_id,
+          country ),
+%{ else ~}
         offer_ids_with_group AS (
         SELECT
           offer_id,
@@ -87,11 +144,16 @@ resource "google_bigquery_data_transfer_config" "low_volume_skus_query" {
         GROUP BY
           offer_id,
           country ),
+%{ endif ~}
+        # The item groups and feed labels are normalized once, the classification is then keyed by item group,
+        # country and feed label end to end so every offer has a single row per group, country and feed label.
         offer_ids_with_group_and_stats AS (
         SELECT
           a.*,
           b.item_group_id,
-          b.feed_label
+          b.feed_label,
+          LOWER(b.item_group_id) AS item_group_key,
+          IFNULL(LOWER(b.feed_label), '') AS feed_label_key
         FROM
           offer_ids_with_stats a
         LEFT JOIN
@@ -100,9 +162,9 @@ resource "google_bigquery_data_transfer_config" "low_volume_skus_query" {
           ( LOWER(a.offer_id) = LOWER(b.offer_id) ) ),
         group_stats AS (
         SELECT
-          item_group_id,
+          item_group_key,
           country,
-          feed_label,
+          feed_label_key,
           SUM(clicks) AS group_clicks,
           SUM(impressions) AS group_impressions,
           AVG(clicks) AS avg_group_clicks,
@@ -110,127 +172,128 @@ resource "google_bigquery_data_transfer_config" "low_volume_skus_query" {
         FROM
           offer_ids_with_group_and_stats
         GROUP BY
-          item_group_id,
+          item_group_key,
           country,
-          feed_label ),
+          feed_label_key ),
         clicks_percentiles_by_country AS (
         SELECT
           country,
-          feed_label,
+          feed_label_key,
           APPROX_QUANTILES(group_clicks, ${var.zombies_deciles}) percentiles
         FROM
           group_stats
         GROUP BY
           country,
-          feed_label ),
+          feed_label_key ),
         impressions_percentiles_by_country AS (
         SELECT
           country,
-          feed_label,
+          feed_label_key,
           APPROX_QUANTILES(group_impressions, ${var.zombies_deciles}) percentiles
         FROM
           group_stats
         GROUP BY
           country,
-          feed_label ),
+          feed_label_key ),
         clicks_threshold_by_country AS (
         SELECT
           country,
-          feed_label,
-          MIN(percentile) AS threshold
-        FROM (
-          SELECT
-            country,
-            feed_label,
-            percentiles[
-          OFFSET
-            (${var.zombies_clicks_decil})] AS percentile
-          FROM
-            clicks_percentiles_by_country )
-        GROUP BY
-          country,
-          feed_label ),
+          feed_label_key,
+          percentiles[
+        OFFSET
+          (${var.zombies_clicks_decil})] AS threshold
+        FROM
+          clicks_percentiles_by_country ),
         impressions_threshold_by_country AS (
         SELECT
           country,
-          feed_label,
-          MIN(percentile) AS threshold
-        FROM (
-          SELECT
-            country,
-            feed_label,
-            percentiles[
-          OFFSET
-            (${var.zombies_impressions_decil})] AS percentile
-          FROM
-            impressions_percentiles_by_country )
-        GROUP BY
-          country,
-          feed_label ),
+          feed_label_key,
+          percentiles[
+        OFFSET
+          (${var.zombies_impressions_decil})] AS threshold
+        FROM
+          impressions_percentiles_by_country ),
         zombie_families AS (
         SELECT
-          item_group_id,
-          group_clicks,
-          group_impressions,
-          avg_group_clicks,
-          avg_group_impressions,
-          clicks_threshold,
-          impressions_threshold
-        FROM (
-          SELECT
-            fs.item_group_id AS item_group_id,
-            fs.group_clicks AS group_clicks,
-            fs.group_impressions AS group_impressions,
-            fs.avg_group_clicks AS avg_group_clicks,
-            fs.avg_group_impressions AS avg_group_impressions,
-            ctc.threshold AS clicks_threshold,
-            itc.threshold AS impressions_threshold,
-          FROM
-            group_stats fs
-          LEFT JOIN
-            clicks_threshold_by_country ctc
-          ON
-            LOWER(fs.feed_label) = LOWER(ctc.feed_label)
-          LEFT JOIN
-            impressions_threshold_by_country itc
-          ON
-            LOWER(fs.feed_label) = LOWER(itc.feed_label) ) ),
+          fs.item_group_key,
+          fs.country,
+          fs.feed_label_key,
+          fs.group_clicks,
+          fs.group_impressions,
+          fs.avg_group_clicks,
+          fs.avg_group_impressions,
+          ctc.threshold AS clicks_threshold,
+          itc.threshold AS impressions_threshold
+        FROM
+          group_stats fs
+        LEFT JOIN
+          clicks_threshold_by_country ctc
+        ON
+          fs.country = ctc.country
+          AND fs.feed_label_key = ctc.feed_label_key
+        LEFT JOIN
+          impressions_threshold_by_country itc
+        ON
+          fs.country = itc.country
+          AND fs.feed_label_key = itc.feed_label_key
+        WHERE
+          fs.item_group_key IS NOT NULL ),
         zombie_products AS (
         SELECT
           owgs.offer_id,
-          zf.item_group_id item_group_id,
+          owgs.item_group_id,
           owgs.country,
           owgs.feed_label,
           owgs.clicks AS offer_id_clicks,
           owgs.impressions AS offer_id_impressions,
-          zf.group_clicks group_clicks,
-          zf.group_impressions group_impressions,
-          zf.avg_group_clicks avg_group_clicks,
-          zf.avg_group_impressions avg_group_impressions,
-          zf.clicks_threshold clicks_threshold,
-          zf.impressions_threshold impressions_threshold,
+          zf.group_clicks,
+          zf.group_impressions,
+          zf.avg_group_clicks,
+          zf.avg_group_impressions,
+          zf.clicks_threshold,
+          zf.impressions_threshold,
         FROM
           offer_ids_with_group_and_stats owgs
-        RIGHT JOIN
+        INNER JOIN
           zombie_families zf
         ON
-          LOWER(owgs.item_group_id) = LOWER(zf.item_group_id)
-          AND offer_id IS NOT NULL
-          AND zf.item_group_id IS NOT NULL),
+          owgs.item_group_key = zf.item_group_key
+          AND owgs.country = zf.country
+          AND owgs.feed_label_key = zf.feed_label_key
+        WHERE
+          owgs.offer_id IS NOT NULL ),
       latest_targeted_products AS (
-        SELECT
-          SPLIT(product_id, ':')[ARRAY_LENGTH(SPLIT(product_id, ':')) - 1] as offer_id,
-          target_country as country
+%{ if var.zombies_materialize_targeted_products ~}
+        # The bounds on @run_date prune the partitions, the keys are already normalized. An offer can be targeted
+        # through several product ids, it is kept once so the join does not duplicate the low volume skus. The query
+        # fails when the refresh appended no partition in the window, instead of finding no low volume skus.
+        SELECT DISTINCT
+          offer_id,
+          country
+        FROM `${var.gcp_project}.${var.zombies_dataset_name}.targeted_products_${each.value.mc}_${each.value.gads}`
+        WHERE
+          _DATA_DATE BETWEEN DATE_ADD(@run_date, INTERVAL -7 DAY) AND @run_date
+          AND _DATA_DATE = (
+            SELECT IFNULL(MAX(_DATA_DATE), ERROR(FORMAT(
+              'No targeted_products_${each.value.mc}_${each.value.gads} partition between %t and %t, check its refresh',
+              DATE_ADD(@run_date, INTERVAL -7 DAY), @run_date)))
+            FROM `${var.gcp_project}.${var.zombies_dataset_name}.targeted_products_${each.value.mc}_${each.value.gads}`
+            WHERE _DATA_DATE BETWEEN DATE_ADD(@run_date, INTERVAL -7 DAY) AND @run_date)
+%{ else ~}
+        SELECT DISTINCT
+          LOWER(SPLIT(product_id, ':')[ARRAY_LENGTH(SPLIT(product_id, ':')) - 1]) as offer_id,
+          LOWER(target_country) as country
         FROM `${var.gcp_project}.${var.zombies_dataset_name}.targeted_products_view_${each.value.gads}`
         WHERE _DATA_DATE = (SELECT MAX(_DATA_DATE) FROM `${var.gcp_project}.${var.zombies_dataset_name}.targeted_products_view_${each.value.gads}`)
+%{ endif ~}
       )
       SELECT
         zp.*
       FROM
         zombie_products AS zp
       INNER JOIN latest_targeted_products ltp ON
-          LOWER(zp.offer_id) = LOWER(ltp.offer_id)
-          AND LOWER(zp.country) = LOWER(ltp.country)
+          LOWER(zp.offer_id) = ltp.offer_id
+          AND LOWER(zp.country) = ltp.country
     EOF
   }
 }
@@ -51,13 +51,43 @@ resource "google_cloudfunctions_function" "function" {
     ]
     name                  = "low_volume_skus_feed_generation"
     runtime               = "python38"
+    # Tracked and batched exports wait within the function time budget.
+    timeout               = var.zombies_track_export_jobs || var.zombies_feed_batch_window_seconds > 0 || var.zombies_feed_delivery == "content_api" ? 540 : 60
 
     environment_variables = {
         GCP_PROJECT = var.gcp_project,
         ACCOUNTS_CONFIG = jsonencode(var.accounts_table),
+        ZOMBIES_ACCOUNTS_SHA256 = sha256(jsonencode(var.accounts_table)),
         ZOMBIES_DATASET_NAME = var.zombies_dataset_name,
+        ZOMBIES_DATA_LOCATION = var.zombies_data_location,
         ZOMBIES_SQL_CONDITION = var.zombies_sql_condition,
         ZOMBIES_FEED_LABEL_INDEX = var.zombies_feed_label_index,
+        ZOMBIES_FEED_MODE = var.zombies_feed_mode,
+        ZOMBIES_FEED_SNAPSHOT_WEEKDAY = var.zombies_feed_snapshot_weekday,
+        ZOMBIES_FEED_COMPRESSION = var.zombies_feed_compression,
+        ZOMBIES_FEED_SHARDING = var.zombies_feed_sharding,
+        ZOMBIES_FEED_SHARD_MAX_ROWS = var.zombies_feed_shard_max_rows,
+        ZOMBIES_FEED_MANIFESTS_TABLE = var.zombies_feed_sharding != "none" ? google_bigquery_table.feed_manifests[0].table_id : "",
+        ZOMBIES_FEED_BATCH_WINDOW_SECONDS = var.zombies_feed_batch_window_seconds,
+        ZOMBIES_FEED_BATCH_EVENTS_TABLE = var.zombies_feed_batch_window_seconds > 0 ? google_bigquery_table.feed_batch_events[0].table_id : "",
+        ZOMBIES_FEED_DELIVERY = var.zombies_feed_delivery,
+        ZOMBIES_CONTENT_API_FEED_IDS = jsonencode(var.zombies_content_api_feed_ids),
+        ZOMBIES_PUSH_BATCH_SIZE = var.zombies_push_batch_size,
+        ZOMBIES_PUSH_CONCURRENCY = var.zombies_push_concurrency,
+        ZOMBIES_PUSH_TIMEOUT_SECONDS = 480,
+        ZOMBIES_PUSH_PROGRESS_TABLE = var.zombies_feed_delivery == "content_api" ? google_bigquery_table.push_progress[0].table_id : "",
+        ZOMBIES_RUN_LEDGER = var.zombies_run_ledger,
+        ZOMBIES_SPANS_EXPORTER = var.zombies_spans_exporter,
+        ZOMBIES_TRACK_EXPORT_JOBS = var.zombies_track_export_jobs,
+        ZOMBIES_EXPORT_TIMEOUT_SECONDS = 480,
+        ZOMBIES_FEED_RUNS_TABLE = var.zombies_track_export_jobs ? google_bigquery_table.feed_runs[0].table_id : "",
+        ZOMBIES_INPUT_FINGERPRINTS_TABLE = var.zombies_input_fingerprints ? google_bigquery_table.input_fingerprints[0].table_id : "",
+        ZOMBIES_MERCHANT_AND_GADS_PROJECT = var.gcp_merchant_and_gads_dataset_project,
+        ZOMBIES_MERCHANT_DATASET_NAME = var.merchant_dataset_name,
+        ZOMBIES_GADS_DATASET_NAME = var.gads_dataset_name,
+        ZOMBIES_DECILES = var.zombies_deciles,
+        ZOMBIES_CLICKS_DECIL = var.zombies_clicks_decil,
+        ZOMBIES_IMPRESSIONS_DECIL = var.zombies_impressions_decil,
     }
 
     # Get the source code of the cloud function as a Zip compression
@@ -72,5 +102,142 @@ resource "google_cloudfunctions_function" "function" {
     event_trigger {
       event_type = "google.pubsub.topic.publish"
       resource = google_pubsub_topic.zombies_bq_sq_completed_topic.id
+      # Pushes interrupted by the time budget or a transient error resume on the next delivery, the function
+      # acknowledges the events failing with a permanent error.
+      failure_policy {
+        retry = var.zombies_feed_delivery == "content_api"
+      }
     }
-}
\ No newline at end of file
+}
+
+# Run records of the tracked feed exports
+resource "google_bigquery_table" "feed_runs" {
+  count = var.zombies_track_export_jobs ? 1 : 0
+  dataset_id = google_bigquery_dataset.zombies_dataset.dataset_id
+  table_id   = "feed_runs"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = "DAY"
+    field = "run_date"
+  }
+
+  schema = <<EOF
+[
+  {"name": "mc_id", "type": "STRING", "mode": "NULLABLE", "description": "Merchant account id"},
+  {"name": "gads_id", "type": "STRING", "mode": "NULLABLE", "description": "GAds account id"},
+  {"name": "run_date", "type": "DATE", "mode": "NULLABLE", "description": "Run date of the LowVolumeSkus table"},
+  {"name": "feed_mode", "type": "STRING", "mode": "NULLABLE", "description": "full or delta"},
+  {"name": "gcs_destination", "type": "STRING", "mode": "NULLABLE", "description": "GCS uri of the exported files"},
+  {"name": "job_id", "type": "STRING", "mode": "NULLABLE", "description": "BigQuery export job id"},
+  {"name": "state", "type": "STRING", "mode": "NULLABLE", "description": "Job state when recorded"},
+  {"name": "error", "type": "STRING", "mode": "NULLABLE", "description": "Job error, if any"},
+  {"name": "created", "type": "TIMESTAMP", "mode": "NULLABLE", "description": "Job creation time"},
+  {"name": "duration_ms", "type": "INTEGER", "mode": "NULLABLE", "description": "Job execution time"},
+  {"name": "total_bytes_processed", "type": "INTEGER", "mode": "NULLABLE", "description": "Bytes processed by the job"},
+  {"name": "total_slot_ms", "type": "INTEGER", "mode": "NULLABLE", "description": "Slot milliseconds used by the job"},
+  {"name": "rows_exported", "type": "INTEGER", "mode": "NULLABLE", "description": "Rows written to the feed files"},
+  {"name": "files_exported", "type": "INTEGER", "mode": "NULLABLE", "description": "Number of feed files written"}
+]
+EOF
+}
+
+# Shards of the sharded feed exports, one row per shard and run
+resource "google_bigquery_table" "feed_manifests" {
+  count = var.zombies_feed_sharding != "none" ? 1 : 0
+  dataset_id = google_bigquery_dataset.zombies_dataset.dataset_id
+  table_id   = "feed_manifests"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = "DAY"
+    field = "run_date"
+  }
+
+  clustering = ["mc_id", "gads_id"]
+
+  schema = <<EOF
+[
+  {"name": "run_date", "type": "DATE", "mode": "NULLABLE", "description": "Run date of the LowVolumeSkus table"},
+  {"name": "mc_id", "type": "STRING", "mode": "NULLABLE", "description": "Merchant account id"},
+  {"name": "gads_id", "type": "STRING", "mode": "NULLABLE", "description": "GAds account id"},
+  {"name": "country", "type": "STRING", "mode": "NULLABLE", "description": "Country of the shard"},
+  {"name": "feed_label", "type": "STRING", "mode": "NULLABLE", "description": "Feed label of the shard"},
+  {"name": "shard", "type": "INTEGER", "mode": "NULLABLE", "description": "Index of the shard in its country and feed label"},
+  {"name": "shard_count", "type": "INTEGER", "mode": "NULLABLE", "description": "Number of shards of its country and feed label"},
+  {"name": "uri", "type": "STRING", "mode": "NULLABLE", "description": "Wildcard gcs uri of the shard files"},
+  {"name": "row_count", "type": "INTEGER", "mode": "NULLABLE", "description": "Rows of the shard"},
+  {"name": "checksum", "type": "INTEGER", "mode": "NULLABLE", "description": "Order independent fingerprint of the shard rows"},
+  {"name": "status", "type": "STRING", "mode": "NULLABLE", "description": "changed, unchanged or removed since the previous run"}
+]
+EOF
+}
+
+# Completion events of the account pairs collected by the batched feed exports
+resource "google_bigquery_table" "feed_batch_events" {
+  count = var.zombies_feed_batch_window_seconds > 0 ? 1 : 0
+  dataset_id = google_bigquery_dataset.zombies_dataset.dataset_id
+  table_id   = "feed_batch_events"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = "DAY"
+    field = "run_date"
+  }
+
+  schema = <<EOF
+[
+  {"name": "run_date", "type": "DATE", "mode": "NULLABLE", "description": "Run date of the LowVolumeSkus table"},
+  {"name": "mc_id", "type": "STRING", "mode": "NULLABLE", "description": "Merchant account id"},
+  {"name": "gads_id", "type": "STRING", "mode": "NULLABLE", "description": "GAds account id"},
+  {"name": "batch_window", "type": "INTEGER", "mode": "NULLABLE", "description": "Index of the batch window of the completion event"},
+  {"name": "recorded", "type": "TIMESTAMP", "mode": "NULLABLE", "description": "Time the event was recorded"}
+]
+EOF
+}
+
+# Batches of label updates pushed with the Content API, to resume interrupted pushes
+resource "google_bigquery_table" "push_progress" {
+  count = var.zombies_feed_delivery == "content_api" ? 1 : 0
+  dataset_id = google_bigquery_dataset.zombies_dataset.dataset_id
+  table_id   = "push_progress"
+  deletion_protection = false
+
+  schema = <<EOF
+[
+  {"name": "run_date", "type": "STRING", "mode": "NULLABLE", "description": "Run date of the LowVolumeSkus table, YYYYMMDD"},
+  {"name": "mc_id", "type": "STRING", "mode": "NULLABLE", "description": "Merchant account id"},
+  {"name": "gads_id", "type": "STRING", "mode": "NULLABLE", "description": "GAds account id"},
+  {"name": "feed_mode", "type": "STRING", "mode": "NULLABLE", "description": "full or delta"},
+  {"name": "batch", "type": "INTEGER", "mode": "NULLABLE", "description": "Index of the pushed batch"},
+  {"name": "pushed", "type": "TIMESTAMP", "mode": "NULLABLE", "description": "Time the batch was pushed"}
+]
+EOF
+}
+
+# Fingerprints of the inputs of every run, to skip the runs whose inputs did not change
+resource "google_bigquery_table" "input_fingerprints" {
+  count = var.zombies_input_fingerprints ? 1 : 0
+  dataset_id = google_bigquery_dataset.zombies_dataset.dataset_id
+  table_id   = "input_fingerprints"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = "DAY"
+    field = "run_date"
+  }
+
+  clustering = ["mc_id", "gads_id"]
+
+  schema = <<EOF
+[
+  {"name": "mc_id", "type": "STRING", "mode": "NULLABLE", "description": "Merchant account id"},
+  {"name": "gads_id", "type": "STRING", "mode": "NULLABLE", "description": "GAds account id"},
+  {"name": "run_date", "type": "DATE", "mode": "NULLABLE", "description": "Run date of the LowVolumeSkus table"},
+  {"name": "fingerprint", "type": "STRING", "mode": "NULLABLE", "description": "SHA-256 of the source partitions, thresholds and scoring query"},
+  {"name": "source_run_date", "type": "DATE", "mode": "NULLABLE", "description": "Run date whose result the run reuses, run_date when it was computed"},
+  {"name": "job_id", "type": "STRING", "mode": "NULLABLE", "description": "BigQuery export job of the result, if any"},
+  {"name": "recorded", "type": "TIMESTAMP", "mode": "NULLABLE", "description": "Time the fingerprint was recorded"}
+]
+EOF
+}
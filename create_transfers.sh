@@ -18,76 +18,8 @@
 
 source ./common.sh
 
-find_config_value()
-{
-  NAME=$1
-
-  FILE="./variables.tf"
-  LINE_NO=$(grep -n "$NAME" "$FILE" | sed "s/:.*//")
-
-  #echo "$LINE_NO"
-
-  I=0
-  LINE=""
-  NOT_FOUND=1
-  
-  while [ "$NOT_FOUND" -eq 1 ]
-  do
-    read -r LINE
-    I=$(( I + 1 ))
-    if [[ ("$LINE" == *"default"*)  && ($I -gt $LINE_NO) ]]; then
-      RESULT=$(echo "$LINE" | cut -d '=' -f2 | sed -e 's/^[[:space:]]*//' | sed -e 's/"//g')
-      NOT_FOUND=0
-    fi;
-  
-  done < "$FILE"
-
-  echo "$RESULT"
-}
-
-find_accounts_values(){
-
-  NAME=$1
-  FILE="./variables.tf"
-  
-  LINE_NO=$(grep -n accounts_table "$FILE" | sed "s/:.*//")
-  I=0
-  J=0
-  start=0
-  LINE=""
-
-  while read LINE; do
-    I=$(( I + 1 ))
-    
-    if [[ ("$LINE" == *"default"* )  && ($I -gt $LINE_NO) ]]; then
-      START=1
-    fi;
-
-    if [[ ($START -eq 1) && ("$LINE" == *"gads"* ) ]]; then
-      JSON_LINE=$(echo "$LINE" |  grep -o "{.*}")
-      MC=$(python3 -c "import sys, json; print(json.loads('$JSON_LINE')['mc'])")
-      GADS=$(python3 -c "import sys, json; print(json.loads('$JSON_LINE')['gads'])")
-      ACCOUNTS[$J]="$MC,$GADS"
-      J=$(( J + 1 ))
-    fi;
-  done < "$FILE"
-
-}
-
-
 deploy_data_transfers(){
 
-  GCP_PROJECT=$(find_config_value "variable \"gcp_project\"")
-  MERCHANT_DATASET_NAME=$(find_config_value "variable \"merchant_dataset_name\"")
-  GADS_DATASET_NAME=$(find_config_value "variable \"gads_dataset_name\"")
-  ZOMBIES_DATA_LOCATION=$(find_config_value "variable \"zombies_data_location\"")
-  SERVICE_ACCOUNT=$(find_config_value "variable \"zombies_sa\"")
-  SERVICE_ACCOUNT="$SERVICE_ACCOUNT""@""$GCP_PROJECT"".iam.gserviceaccount.com"
-  MERCHANT_SCHEDULE=$(find_config_value "variable \"merchant_schedule\"")
-  GADS_SCHEDULE=$(find_config_value "variable \"gads_schedule\"")
-
-  find_accounts_values "variable \"accounts_table\""
-   
   echo "Checking Datasets status..."
 
   terraform apply -target=google_project_service.enable_bigquery -target=google_project_service.enable_bqdt -target=google_bigquery_dataset.merchant_dataset -target=google_bigquery_dataset.gads_dataset
@@ -96,31 +28,19 @@ deploy_data_transfers(){
   terraform import google_bigquery_dataset.gads_dataset[0] "$GADS_DATASET_NAME" || echo >&2 "Ignoring import failure"
   
 
-  for I in ${ACCOUNTS[@]}
-  do
-    MC=$(echo "$I" | cut -d ',' -f1)
-    GADS=$(echo "$I" | cut -d ',' -f2)
-    
-    echo "Creating transfer for Merchant $MC and GAds $GADS..."
-
-    python ./src/bq_transfers/data_transfers.py \
-      --requirements_file ./src/bq_transfers/requirements.txt \
-      --project_id "$GCP_PROJECT" \
-      --merchant_dataset_id "$MERCHANT_DATASET_NAME" \
-      --gads_dataset_id "$GADS_DATASET_NAME" \
-      --dataset_location "$ZOMBIES_DATA_LOCATION" \
-      --gads_account_id "$GADS" \
-      --merchant_account_id "$MC" \
-      --service_account "$SERVICE_ACCOUNT" \
-      --merchant_schedule "$MERCHANT_SCHEDULE" \
-      --gads_schedule "$GADS_SCHEDULE"
+  echo "Creating transfers for ${#ACCOUNTS[@]} Merchant and GAds account pairs..."
 
-  done;
+  python ./src/bq_transfers/data_transfers.py \
+    --requirements_file ./src/bq_transfers/requirements.txt \
+    --config_file "$ZOMBIES_CONFIG_FILE"
 }
 
-terraform init -upgrade
+# Parses and validates variables.tf once, the settings are read from the
+# compiled artifact.
+CONFIG_ASSIGNMENTS=$(python ./src/bq_transfers/zombies_config.py shell)
+eval "$CONFIG_ASSIGNMENTS"
 
-CREATE_MERCHANT_AND_GADS_TRANSFERS=$(find_config_value "variable \"create_merchant_and_gads_transfers\"")
+terraform init -upgrade
 
 echo "$GCP_PROJECT"
 
@@ -16,5 +16,18 @@
 # Low volume SKU setup script 2/2 - Deploy core solution.
 source ./common.sh
 
+# Compiles variables.tf into the config artifact shipped with the Cloud Function.
+python ./src/bq_transfers/zombies_config.py build
+CONFIG_ASSIGNMENTS=$(python ./src/bq_transfers/zombies_config.py shell)
+eval "$CONFIG_ASSIGNMENTS"
+
+# Without a schedule, the low volume skus queries only run when readiness.py
+# starts them.
+if [[ "$ZOMBIES_READINESS_GATING" == "true" && -z "$ZOMBIES_READINESS_TRIGGER" ]]; then
+  echo "zombies_readiness_gating is true but zombies_readiness_trigger is empty:" \
+    "nothing would start the low volume skus queries, schedule src/bq_transfers/readiness.py and set it." >&2
+  exit 1
+fi
+
 terraform init -upgrade
 terraform apply --parallelism=1
@@ -0,0 +1,249 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Incremental daily aggregates.
+#
+# When zombies_incremental_aggregates is true the clicks and impressions per offer and country, and the item groups
+# of the offers, are kept per day in date partitioned tables. A scheduled query adds the newest day and drops the
+# days leaving the 31 days window before the low volume skus query runs, so the latter sums 31 small partitions instead
+# of rescanning the Merchant Center and Google Ads history. The days already aggregated are recorded in a watermark
+# table, so a day without any source row is not aggregated again on every run. The geo targets are reduced once to a
+# native lookup of the country of every parent criteria id.
+
+resource "google_bigquery_job" "geo_country_lookup" {
+  depends_on = [google_bigquery_table.geo_targets_table]
+
+  count = var.zombies_incremental_aggregates ? 1 : 0
+
+  job_id = "geo_country_lookup_${random_id.id.hex}"
+
+  location = var.zombies_data_location
+
+  query {
+    create_disposition = ""
+    write_disposition = ""
+    query = <<EOF
+        # Copyright 2023 Google LLC
+        #
+        # Licensed under the Apache License, Version 2.0 (the "License");
+        # you may not use this file except in compliance with the License.
+        # You may obtain a copy of the License at
+        #
+        #     http://www.apache.org/licenses/LICENSE-2.0
+        #
+        # Unless required by applicable law or agreed to in writing, software
+        # distributed under the License is distributed on an "AS IS" BASIS,
+        # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+        # See the License for the specific language governing permissions and
+        # limitations under the License.
+        # Materializes the country of every parent criteria id of the geo targets CSV.
+
+        CREATE OR REPLACE TABLE `${var.gcp_project}.${var.zombies_dataset_name}.geo_country_lookup`
+        CLUSTER BY parent_id
+        AS (
+          SELECT DISTINCT
+            parent_id,
+            country_code
+          FROM
+            `${var.gcp_project}.${var.zombies_dataset_name}.geo_targets`
+          WHERE
+            parent_id IS NOT NULL
+        )
+    EOF
+  }
+}
+
+resource "google_bigquery_table" "offer_daily_stats" {
+  depends_on = [google_bigquery_dataset.zombies_dataset]
+
+  for_each = { for pair in var.accounts_table : "${pair.mc}_${pair.gads}" => pair if var.zombies_incremental_aggregates }
+
+  dataset_id = google_bigquery_dataset.zombies_dataset.dataset_id
+  table_id   = "offer_daily_stats_${each.value.mc}_${each.value.gads}"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = "DAY"
+    field = "_DATA_DATE"
+  }
+
+  clustering = ["offer_id", "country"]
+
+  schema = <<EOF
+[
+  {"name": "_DATA_DATE", "type": "DATE", "mode": "NULLABLE", "description": "Date of the Google Ads statistics"},
+  {"name": "offer_id", "type": "STRING", "mode": "NULLABLE", "description": "Item id of the Shopping product statistics"},
+  {"name": "country", "type": "STRING", "mode": "NULLABLE", "description": "Country code of the product country"},
+  {"name": "clicks", "type": "INTEGER", "mode": "NULLABLE", "description": "Clicks of the offer in the country that day"},
+  {"name": "impressions", "type": "INTEGER", "mode": "NULLABLE", "description": "Impressions of the offer in the country that day"}
+]
+EOF
+}
+
+resource "google_bigquery_table" "offer_daily_groups" {
+  depends_on = [google_bigquery_dataset.zombies_dataset]
+
+  for_each = { for pair in var.accounts_table : "${pair.mc}_${pair.gads}" => pair if var.zombies_incremental_aggregates }
+
+  dataset_id = google_bigquery_dataset.zombies_dataset.dataset_id
+  table_id   = "offer_daily_groups_${each.value.mc}_${each.value.gads}"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = "DAY"
+    field = "_DATA_DATE"
+  }
+
+  clustering = ["offer_id"]
+
+  schema = <<EOF
+[
+  {"name": "_DATA_DATE", "type": "DATE", "mode": "NULLABLE", "description": "Date of the Merchant Center snapshot"},
+  {"name": "offer_id", "type": "STRING", "mode": "NULLABLE", "description": "Offer id of the product"},
+  {"name": "item_group_id", "type": "STRING", "mode": "NULLABLE", "description": "Item group id of the product"},
+  {"name": "feed_label", "type": "STRING", "mode": "NULLABLE", "description": "Feed label of the product"}
+]
+EOF
+}
+
+resource "google_bigquery_table" "offer_daily_watermark" {
+  depends_on = [google_bigquery_dataset.zombies_dataset]
+
+  for_each = { for pair in var.accounts_table : "${pair.mc}_${pair.gads}" => pair if var.zombies_incremental_aggregates }
+
+  dataset_id = google_bigquery_dataset.zombies_dataset.dataset_id
+  table_id   = "offer_daily_watermark_${each.value.mc}_${each.value.gads}"
+  deletion_protection = false
+
+  schema = <<EOF
+[
+  {"name": "_DATA_DATE", "type": "DATE", "mode": "NULLABLE", "description": "Day aggregated into the daily tables, with or without rows"},
+  {"name": "processed_time", "type": "TIMESTAMP", "mode": "NULLABLE", "description": "Time the day was aggregated"}
+]
+EOF
+}
+
+resource "google_bigquery_data_transfer_config" "offer_daily_stats_refresh" {
+  depends_on = [google_project_iam_member.permissions_token,
+    google_project_service.enable_bqdt,
+    google_bigquery_job.geo_country_lookup,
+    google_bigquery_table.offer_daily_stats,
+    google_bigquery_table.offer_daily_groups,
+    google_bigquery_table.offer_daily_watermark
+  ]
+  for_each = { for pair in var.accounts_table : "${pair.mc}_${pair.gads}" => pair if var.zombies_incremental_aggregates }
+
+  display_name         = "offer_daily_stats_${each.value.mc}_${each.value.gads}"
+  location             = var.zombies_data_location
+  data_source_id       = "scheduled_query"
+  schedule             = var.zombies_daily_stats_schedule
+  service_account_name = google_service_account.service_account.email
+
+  # With readiness gating, readiness.py starts the refresh before the low volume skus query of the pair.
+  schedule_options {
+    disable_auto_scheduling = var.zombies_readiness_gating
+  }
+
+  params = {
+    query = <<EOF
+      # Copyright 2023 Google LLC
+      #
+      # Licensed under the Apache License, Version 2.0 (the "License");
+      # you may not use this file except in compliance with the License.
+      # You may obtain a copy of the License at
+      #
+      #     https://www.apache.org/licenses/LICENSE-2.0
+      #
+      # Unless required by applicable law or agreed to in writing, software
+      # distributed under the License is distributed on an "AS IS" BASIS,
+      # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+      # See the License for the specific language governing permissions and
+      # limitations under the License.
+      # Rolls the daily aggregates forward to the window of the run date.
+      #
+      # Only the days of the window missing from the watermark are aggregated, the newest day on a daily run and the
+      # whole window on the first run or after a gap. A day is recorded in the watermark even when the sources have no
+      # row for it. The day before the run date is always recomputed so a rerun picks up the data restated by the
+      # transfers. The days leaving the window are dropped.
+
+      DECLARE days ARRAY<DATE> DEFAULT (
+        SELECT
+          ARRAY_AGG(day)
+        FROM
+          UNNEST(GENERATE_DATE_ARRAY(DATE_ADD(@run_date, INTERVAL -31 DAY), DATE_ADD(@run_date, INTERVAL -1 DAY))) AS day
+        WHERE
+          day = DATE_ADD(@run_date, INTERVAL -1 DAY)
+          OR day NOT IN (
+            SELECT _DATA_DATE
+            FROM `${var.gcp_project}.${var.zombies_dataset_name}.offer_daily_watermark_${each.value.mc}_${each.value.gads}`
+            WHERE _DATA_DATE BETWEEN DATE_ADD(@run_date, INTERVAL -31 DAY) AND DATE_ADD(@run_date, INTERVAL -1 DAY)));
+
+      BEGIN TRANSACTION;
+
+      DELETE FROM `${var.gcp_project}.${var.zombies_dataset_name}.offer_daily_stats_${each.value.mc}_${each.value.gads}`
+      WHERE _DATA_DATE IN UNNEST(days) OR _DATA_DATE < DATE_ADD(@run_date, INTERVAL -31 DAY);
+
+      DELETE FROM `${var.gcp_project}.${var.zombies_dataset_name}.offer_daily_groups_${each.value.mc}_${each.value.gads}`
+      WHERE _DATA_DATE IN UNNEST(days) OR _DATA_DATE < DATE_ADD(@run_date, INTERVAL -31 DAY);
+
+      DELETE FROM `${var.gcp_project}.${var.zombies_dataset_name}.offer_daily_watermark_${each.value.mc}_${each.value.gads}`
+      WHERE _DATA_DATE IN UNNEST(days) OR _DATA_DATE < DATE_ADD(@run_date, INTERVAL -31 DAY);
+
+      INSERT INTO `${var.gcp_project}.${var.zombies_dataset_name}.offer_daily_stats_${each.value.mc}_${each.value.gads}`
+        (_DATA_DATE, offer_id, country, clicks, impressions)
+      SELECT
+        _DATA_DATE,
+        segments_product_item_id AS offer_id,
+        GeoTargets.country_code AS country,
+        SUM(metrics_clicks) AS clicks,
+        SUM(metrics_impressions) AS impressions
+      FROM
+        `${var.gcp_merchant_and_gads_dataset_project}.${var.gads_dataset_name}.ads_ShoppingProductStats_${each.value.gads}` AS ShoppingProductStats
+      INNER JOIN
+        `${var.gcp_project}.${var.zombies_dataset_name}.geo_country_lookup` AS GeoTargets
+        ON
+        SPLIT(ShoppingProductStats.segments_product_country, '/')[SAFE_OFFSET(1)] = GeoTargets.parent_id
+      WHERE
+        _DATA_DATE IN UNNEST(days)
+        AND segments_product_item_id IS NOT NULL
+      GROUP BY
+        _DATA_DATE,
+        offer_id,
+        country;
+
+      INSERT INTO `${var.gcp_project}.${var.zombies_dataset_name}.offer_daily_groups_${each.value.mc}_${each.value.gads}`
+        (_DATA_DATE, offer_id, item_group_id, feed_label)
+      SELECT DISTINCT
+        _PARTITIONDATE,
+        offer_id,
+        item_group_id,
+        feed_label
+      FROM
+        `${var.gcp_merchant_and_gads_dataset_project}.${var.merchant_dataset_name}.Products_${each.value.mc}`
+      WHERE
+        _PARTITIONDATE IN UNNEST(days)
+        AND offer_id IS NOT NULL;
+
+      INSERT INTO `${var.gcp_project}.${var.zombies_dataset_name}.offer_daily_watermark_${each.value.mc}_${each.value.gads}`
+        (_DATA_DATE, processed_time)
+      SELECT
+        day,
+        CURRENT_TIMESTAMP()
+      FROM
+        UNNEST(days) AS day;
+
+      COMMIT TRANSACTION;
+    EOF
+  }
+}
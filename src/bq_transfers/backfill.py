@@ -0,0 +1,663 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Backfills the LowVolumeSkus tables and feeds of past run dates.
+
+Every account pair and run date of the range is scored with the query of its
+deployed scheduled query into LowVolumeSkus_{mc}_{gads}_{YYYYMMDD}, then
+exported by the trigger_job of the feed generation Cloud Function, called in
+process with the message of a scheduled query run of that date. At most
+--concurrency queries and exports run at a time. The exports of a pair follow
+the run dates, as the delta feeds, the shard manifests and the pushed labels
+depend on the previous run. With zombies_materialize_targeted_products, the
+targeted products partition of every run date is appended before it is scored.
+Every finished step is appended to the --checkpoint_file, a rerun with the same
+file only runs the remaining ones. A full feed is replaced by the next one, so
+by default only the last run date of a pair is exported in full feed mode.
+The throughput and the latency of every step are printed at the end, e.g.:
+
+  python src/bq_transfers/backfill.py --start_date 20240101 --end_date 20240131 --concurrency 8
+  python src/bq_transfers/backfill.py --start_date 20240101 --end_date 20240107 --local_offers 10000
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import data_transfers
+import zombies_config
+
+# The timing spans are shared with the feed generation Cloud Function.
+_FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'cfs', 'low_volume_skus_feed_generation')
+sys.path.insert(0, _FUNCTION_DIR)
+import spans  # pylint: disable=g-import-not-at-top,wrong-import-position
+
+_TOOLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'tools')
+SCORE = 'score'
+EXPORT = 'export'
+EXPORT_ALL = 'all'  # Every run date of a pair is exported.
+EXPORT_LATEST = 'latest'  # Only the last run date of a pair is exported.
+EXPORT_NONE = 'none'
+# Outcomes of a step.
+STEP_DONE = 'DONE'
+STEP_RESUMED = 'RESUMED'  # Done by a previous run of the same checkpoint.
+STEP_FAILED = 'FAILED'
+STEP_SKIPPED = 'SKIPPED'  # An earlier step of the pair failed.
+_SCHEDULED_QUERY_ID = 'scheduled_query'
+# Time of the day of the scheduled query run given to the Cloud Function.
+_RUN_TIME = '00:00:00Z'
+_FULL_FEED_MODE = 'full'
+_EXPORT_TIMEOUT_SECONDS = 3600
+
+
+class Task(NamedTuple):
+  """An account pair and a run date to backfill."""
+  mc: str
+  gads: str
+  run_date: datetime.date
+
+
+class StepResult(NamedTuple):
+  """Outcome and latency of the scoring or the export of a task."""
+  outcome: str
+  seconds: float
+
+
+class TaskResult(NamedTuple):
+  """Outcomes of the steps of a task, export is None when not exported."""
+  score: StepResult
+  export: Optional[StepResult]
+
+
+def get_tasks(account_pairs: List[Tuple[str, str]], start_date: datetime.date,
+              end_date: datetime.date) -> List[Task]:
+  """Returns the tasks of every pair and run date, oldest run date first."""
+  days = (end_date - start_date).days + 1
+  return [Task(mc, gads, start_date + datetime.timedelta(days=day))
+          for day in range(days) for mc, gads in account_pairs]
+
+
+def get_table_name(task: Task) -> str:
+  """Returns the LowVolumeSkus table of a task, as named by main.py."""
+  return f'LowVolumeSkus_{task.mc}_{task.gads}_{task.run_date:%Y%m%d}'
+
+
+def get_event(task: Task, query: str) -> Dict[str, str]:
+  """Returns the Pub/Sub event of the scheduled query run of a task.
+
+  Args:
+    task: Account pair and run date of the run.
+    query: Query of the scheduled query.
+  Returns:
+    The event trigger_job receives when the scheduled query of the pair ran
+    on the run date.
+  """
+  message = {
+      'name': f'low_volume_skus_{task.mc}_{task.gads}',
+      'state': 'SUCCEEDED',
+      'runTime': f'{task.run_date.isoformat()}T{_RUN_TIME}',
+      'params': {
+          'destination_table_name_template':
+              f'LowVolumeSkus_{task.mc}_{task.gads}_{{run_time|"%Y%m%d"}}',
+          'query': query,
+      },
+  }
+  return {'data': base64.b64encode(json.dumps(message).encode('utf-8'))}
+
+
+def get_function_environment(config: Dict[str, object], spans_exporter: str,
+                             spans_file: str) -> Dict[str, str]:
+  """Returns the environment of the deployed feed generation Cloud Function.
+
+  The variables mirror cf_feed_generation.tf, except that the export jobs are
+  always waited for, so the next run date of a pair is only exported once the
+  previous one landed, and that the exports are not batched.
+
+  Args:
+    config: Compiled zombies configuration.
+    spans_exporter: Exporter of the timing spans of the function.
+    spans_file: JSON lines file the jsonl exporter appends the spans to.
+  Returns:
+    A dict from environment variable to value.
+  """
+  variables = config['variables']
+
+  def _value(name):
+    value = variables.get(name)
+    if isinstance(value, bool):
+      return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+      return json.dumps(value)
+    return '' if value is None else str(value)
+
+  accounts = zombies_config.get_accounts(config)
+  return {
+      'GCP_PROJECT': _value('gcp_project'),
+      'ACCOUNTS_CONFIG': json.dumps({
+          str(i): {'mc': account.mc, 'gads': account.gads,
+                   'gcs_url': account.gcs_url}
+          for i, account in enumerate(accounts)}),
+      'ZOMBIES_ACCOUNTS_SHA256': config['accounts_sha256'],
+      'ZOMBIES_DATASET_NAME': _value('zombies_dataset_name'),
+      'ZOMBIES_DATA_LOCATION': _value('zombies_data_location'),
+      'ZOMBIES_SQL_CONDITION': _value('zombies_sql_condition'),
+      'ZOMBIES_FEED_LABEL_INDEX': _value('zombies_feed_label_index'),
+      'ZOMBIES_FEED_MODE': _value('zombies_feed_mode'),
+      'ZOMBIES_FEED_SNAPSHOT_WEEKDAY': _value('zombies_feed_snapshot_weekday'),
+      'ZOMBIES_FEED_COMPRESSION': _value('zombies_feed_compression'),
+      'ZOMBIES_FEED_SHARDING': _value('zombies_feed_sharding'),
+      'ZOMBIES_FEED_SHARD_MAX_ROWS': _value('zombies_feed_shard_max_rows'),
+      'ZOMBIES_FEED_MANIFESTS_TABLE': (
+          'feed_manifests'
+          if variables.get('zombies_feed_sharding') != 'none' else ''),
+      'ZOMBIES_FEED_BATCH_WINDOW_SECONDS': '0',
+      'ZOMBIES_FEED_DELIVERY': _value('zombies_feed_delivery'),
+      'ZOMBIES_CONTENT_API_FEED_IDS': _value('zombies_content_api_feed_ids'),
+      'ZOMBIES_PUSH_BATCH_SIZE': _value('zombies_push_batch_size'),
+      'ZOMBIES_PUSH_CONCURRENCY': _value('zombies_push_concurrency'),
+      'ZOMBIES_PUSH_TIMEOUT_SECONDS': str(_EXPORT_TIMEOUT_SECONDS),
+      'ZOMBIES_PUSH_PROGRESS_TABLE': (
+          'push_progress'
+          if variables.get('zombies_feed_delivery') == 'content_api' else ''),
+      'ZOMBIES_RUN_LEDGER': _value('zombies_run_ledger'),
+      'ZOMBIES_SPANS_EXPORTER': spans_exporter,
+      'ZOMBIES_SPANS_JSONL': spans_file,
+      'ZOMBIES_TRACK_EXPORT_JOBS': 'true',
+      'ZOMBIES_EXPORT_TIMEOUT_SECONDS': str(_EXPORT_TIMEOUT_SECONDS),
+      'ZOMBIES_FEED_RUNS_TABLE': (
+          'feed_runs' if variables.get('zombies_track_export_jobs') else ''),
+      'ZOMBIES_INPUT_FINGERPRINTS_TABLE': (
+          'input_fingerprints'
+          if variables.get('zombies_input_fingerprints') else ''),
+      'ZOMBIES_MERCHANT_AND_GADS_PROJECT': _value(
+          'gcp_merchant_and_gads_dataset_project'),
+      'ZOMBIES_MERCHANT_DATASET_NAME': _value('merchant_dataset_name'),
+      'ZOMBIES_GADS_DATASET_NAME': _value('gads_dataset_name'),
+      'ZOMBIES_DECILES': _value('zombies_deciles'),
+      'ZOMBIES_CLICKS_DECIL': _value('zombies_clicks_decil'),
+      'ZOMBIES_IMPRESSIONS_DECIL': _value('zombies_impressions_decil'),
+  }
+
+
+class Checkpoint(object):
+  """Records the finished steps in a JSON lines file to resume a backfill."""
+
+  def __init__(self, path: Optional[str]):
+    """Initialise new instance of Checkpoint.
+    Args:
+      path: JSON lines file of the finished steps, None to keep none.
+    """
+    self._path = path
+    self._lock = threading.Lock()
+    self._done = set()
+    if not path:
+      return
+    try:
+      with open(path) as f:
+        for line in f:
+          if line.strip():
+            record = json.loads(line)
+            self._done.add((record['mc'], record['gads'], record['run_date'],
+                            record['step']))
+    except FileNotFoundError:
+      pass
+
+  def is_done(self, task: Task, step: str) -> bool:
+    """Returns whether a step of a task finished in a previous run."""
+    return (task.mc, task.gads, task.run_date.isoformat(), step) in self._done
+
+  def record(self, task: Task, step: str, seconds: float,
+             **attributes) -> None:
+    """Appends a finished step of a task to the checkpoint file."""
+    record = dict(attributes, mc=task.mc, gads=task.gads,
+                  run_date=task.run_date.isoformat(), step=step,
+                  seconds=seconds, finished=time.time())
+    with self._lock:
+      self._done.add((task.mc, task.gads, task.run_date.isoformat(), step))
+      if self._path:
+        with open(self._path, 'a') as f:
+          f.write(json.dumps(record) + '\n')
+
+
+class BigQueryEngine(object):
+  """Scores with the deployed scheduled queries and exports with trigger_job."""
+
+  def __init__(self, client,
+               data_transfer: data_transfers.CloudDataTransferUtils,
+               variables: Dict[str, object], function):
+    """Initialise new instance of BigQueryEngine.
+    Args:
+      client: bigquery.Client running the queries.
+      data_transfer: Client of the data transfer service.
+      variables: Variables of the compiled zombies configuration.
+      function: Module of the feed generation Cloud Function, its environment
+        already set.
+    """
+    self._client = client
+    self._data_transfer = data_transfer
+    self._variables = variables
+    self._function = function
+    self._location = variables['zombies_data_location'].lower()
+    self._dataset = (f"{variables['gcp_project']}."
+                     f"{variables['zombies_dataset_name']}")
+    self._queries = {}
+    self._lock = threading.Lock()
+    self._incremental = bool(variables.get('zombies_incremental_aggregates'))
+    self._materialized = bool(
+        variables.get('zombies_materialize_targeted_products'))
+    self.feed_mode = variables.get('zombies_feed_mode', _FULL_FEED_MODE)
+    # The daily aggregates of a pair are rolled forward one run date after
+    # the other, and its targeted products partitions appended one at a time.
+    self.ordered = self._incremental or self._materialized
+
+  def _get_query(self, name: str) -> str:
+    """Returns the query of a deployed scheduled query, fetched once."""
+    with self._lock:
+      if name not in self._queries:
+        transfer_config = self._data_transfer.find_transfer_config(
+            _SCHEDULED_QUERY_ID, self._location, name=name)
+        if transfer_config is None:
+          raise data_transfers.DataTransferError(
+              f'Scheduled query {name} not found.')
+        self._queries[name] = transfer_config.params['query']
+      return self._queries[name]
+
+  def _run_query(self, query: str, run_date: datetime.date, destination=None):
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('run_date', 'DATE', run_date)])
+    if destination:
+      job_config.destination = destination
+      job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+    job = self._client.query(query, job_config=job_config)
+    job.result()
+    return job
+
+  def score(self, task: Task) -> Dict[str, object]:
+    """Writes the LowVolumeSkus table of a task, returns the job statistics."""
+    if self._materialized:
+      # The query reads the partitions of the week before the run date, which
+      # only exist from the deployment of the refresh on.
+      self._run_query(
+          self._get_query(f'targeted_products_{task.mc}_{task.gads}'),
+          task.run_date)
+    if self._incremental:
+      self._run_query(
+          self._get_query(f'offer_daily_stats_{task.mc}_{task.gads}'),
+          task.run_date)
+    job = self._run_query(
+        self._get_query(f'low_volume_skus_{task.mc}_{task.gads}'),
+        task.run_date, f'{self._dataset}.{get_table_name(task)}')
+    return {'job_id': job.job_id,
+            'total_bytes_processed': job.total_bytes_processed,
+            'slot_millis': job.slot_millis}
+
+  def export(self, task: Task) -> Dict[str, object]:
+    """Generates the feed of a task with the Cloud Function."""
+    query = self._get_query(f'low_volume_skus_{task.mc}_{task.gads}')
+    self._function.trigger_job(get_event(task, query), None)
+    return {}
+
+
+class LocalEngine(object):
+  """Scores and exports on the DuckDB fixtures of src/tools/sql_harness.py."""
+
+  ordered = False
+  feed_mode = _FULL_FEED_MODE  # Every export writes the whole feed file.
+
+  def __init__(self, conn, variables: Dict[str, str], output_dir: str):
+    """Initialise new instance of LocalEngine.
+    Args:
+      conn: DuckDB connection holding the source tables of the pairs.
+      variables: Terraform variable values of sql_harness.load_variables.
+      output_dir: Folder the feed files are written to.
+    """
+    sys.path.insert(0, _TOOLS_DIR)
+    import sql_harness  # pylint: disable=g-import-not-at-top
+    self._sql_harness = sql_harness
+    self._conn = conn
+    self._variables = variables
+    self._output_dir = output_dir
+    self._lock = threading.Lock()
+    self._pairs = set()
+
+  def _create_views(self, task: Task) -> None:
+    """Materializes the targeting views of the pair of a task once."""
+    with self._lock:
+      if (task.mc, task.gads) in self._pairs:
+        return
+      for stage in self._sql_harness.STAGES[:-1]:
+        self._conn.execute(self._sql_harness.get_stage_query(
+            stage, self._variables, task.mc, task.gads, task.run_date))
+      self._pairs.add((task.mc, task.gads))
+
+  def score(self, task: Task) -> Dict[str, object]:
+    """Writes the LowVolumeSkus table of a task, returns its row count."""
+    self._create_views(task)
+    stage = self._sql_harness.STAGES[-1]
+    cursor = self._conn.cursor()
+    try:
+      cursor.execute(self._sql_harness.get_stage_query(
+          stage, self._variables, task.mc, task.gads, task.run_date))
+      rows = cursor.execute(
+          f'SELECT COUNT(*) FROM "{get_table_name(task)}"').fetchone()[0]
+    finally:
+      cursor.close()
+    return {'rows': rows}
+
+  def export(self, task: Task) -> Dict[str, object]:
+    """Writes the full feed file of a task, like the EXPORT DATA query."""
+    path = os.path.join(
+        self._output_dir,
+        f'low_volume_skus_{task.mc}_{task.gads}_{task.run_date:%Y%m%d}.tsv')
+    cursor = self._conn.cursor()
+    try:
+      cursor.execute(f"""
+          COPY (
+            SELECT offer_id, MIN(item_group_id) AS item_group_id, country, 'low_volume_sku' AS custom_label_{self._variables['zombies_feed_label_index']}
+            FROM "{get_table_name(task)}"
+            WHERE {self._variables['zombies_sql_condition']}
+            GROUP BY offer_id, country
+            ORDER BY offer_id, country
+          ) TO '{path}' (HEADER, DELIMITER '\t')
+        """)
+    finally:
+      cursor.close()
+    return {'path': path}
+
+
+class BackfillRunner(object):
+  """Scores and exports tasks with bounded concurrency."""
+
+  def __init__(self, engine, checkpoint: Checkpoint, tracer: spans.Tracer,
+               concurrency: int = 4, export_mode: str = EXPORT_ALL):
+    """Initialise new instance of BackfillRunner.
+    Args:
+      engine: Engine with score(task) and export(task) methods returning the
+        attributes of their span, an ordered attribute telling whether the
+        run dates of a pair must be scored one after the other and the
+        feed_mode of the exports.
+      checkpoint: Checkpoint of the finished steps.
+      tracer: Tracer recording a span per step.
+      concurrency: Maximum number of steps of each kind running at a time.
+      export_mode: Run dates of a pair to export, all, latest or none.
+    """
+    self._engine = engine
+    self._checkpoint = checkpoint
+    self._tracer = tracer
+    self._concurrency = concurrency
+    self._export_mode = export_mode
+
+  def _run_step(self, task: Task, step: str) -> StepResult:
+    """Runs a step of a task unless the checkpoint has it."""
+    if self._checkpoint.is_done(task, step):
+      return StepResult(STEP_RESUMED, 0.0)
+    start = time.monotonic()
+    try:
+      with self._tracer.span(f'backfill_{step}',
+                             run_date=f'{task.run_date:%Y%m%d}',
+                             mc_id=task.mc, gads_id=task.gads) as span:
+        attributes = getattr(self._engine, step)(task)
+        span.set(**attributes)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('Could not %s %s %s %s.', step, task.mc, task.gads,
+                        task.run_date)
+      return StepResult(STEP_FAILED, time.monotonic() - start)
+    seconds = time.monotonic() - start
+    self._checkpoint.record(task, step, seconds, **attributes)
+    logging.info('%s %s %s %s in %.1f seconds.', step, task.mc, task.gads,
+                 task.run_date, seconds)
+    return StepResult(STEP_DONE, seconds)
+
+  def _score_pair(self, tasks: List[Task],
+                  futures: Dict[Task, concurrent.futures.Future]) -> None:
+    """Scores the run dates of a pair one after the other."""
+    for task in tasks:
+      futures[task].set_result(self._run_step(task, SCORE))
+
+  def _export_pair(self, tasks: List[Task],
+                   scores: Dict[Task, concurrent.futures.Future]
+                   ) -> Dict[Task, StepResult]:
+    """Exports the run dates of a pair in order, once they are scored."""
+    results = {}
+    failed = False
+    for task in tasks:
+      if failed:
+        results[task] = StepResult(STEP_SKIPPED, 0.0)
+        continue
+      if scores[task].result().outcome in (STEP_FAILED, STEP_SKIPPED):
+        results[task] = StepResult(STEP_SKIPPED, 0.0)
+        failed = True
+        continue
+      results[task] = self._run_step(task, EXPORT)
+      failed = results[task].outcome == STEP_FAILED
+    return results
+
+  def _get_exported(self, tasks: List[Task]) -> List[Task]:
+    if self._export_mode == EXPORT_ALL:
+      return tasks
+    if self._export_mode == EXPORT_LATEST:
+      return tasks[-1:]
+    return []
+
+  def run(self, tasks: List[Task]) -> Dict[Task, TaskResult]:
+    """Scores and exports tasks.
+
+    The oldest run dates are scored first. The exports of a pair wait for the
+    scoring of its run dates and stop at the first failure, the remaining run
+    dates of the pair are skipped.
+
+    Args:
+      tasks: Account pairs and run dates to backfill.
+    Returns:
+      The outcome of every task.
+    """
+    tasks = sorted(tasks, key=lambda task: (task.run_date, task.mc, task.gads))
+    pairs = {}
+    for task in tasks:
+      pairs.setdefault((task.mc, task.gads), []).append(task)
+    scores = {}
+    exports = []
+    with concurrent.futures.ThreadPoolExecutor(
+        self._concurrency) as score_pool, concurrent.futures.ThreadPoolExecutor(
+            self._concurrency) as export_pool:
+      if self._engine.ordered:
+        for pair_tasks in pairs.values():
+          futures = {task: concurrent.futures.Future() for task in pair_tasks}
+          scores.update(futures)
+          score_pool.submit(self._score_pair, pair_tasks, futures)
+      else:
+        for task in tasks:
+          scores[task] = score_pool.submit(self._run_step, task, SCORE)
+      for pair_tasks in pairs.values():
+        exported = self._get_exported(pair_tasks)
+        if exported:
+          exports.append(
+              export_pool.submit(self._export_pair, exported, scores))
+      export_results = {}
+      for future in exports:
+        export_results.update(future.result())
+      return {task: TaskResult(scores[task].result(), export_results.get(task))
+              for task in tasks}
+
+
+def _percentile(values: List[float], share: float) -> float:
+  values = sorted(values)
+  return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def _print_results(results: Dict[Task, TaskResult], seconds: float) -> bool:
+  """Prints the outcome of every task and the throughput.
+
+  Args:
+    results: Outcome of every task.
+    seconds: Wall time of the backfill.
+  Returns:
+    Whether no step failed.
+  """
+  print('Merchant\tGAds\tRun date\tScore\tSeconds\tExport\tSeconds')
+  for task, result in sorted(results.items()):
+    export = result.export or StepResult('', 0.0)
+    print(f'{task.mc}\t{task.gads}\t{task.run_date:%Y%m%d}\t'
+          f'{result.score.outcome}\t{result.score.seconds:.1f}\t'
+          f'{export.outcome}\t{export.seconds:.1f}')
+  steps = {SCORE: [result.score for result in results.values()],
+           EXPORT: [result.export for result in results.values()
+                    if result.export]}
+  print(f'\n{len(results)} tasks in {seconds:.1f} seconds')
+  print('Step\tDone\tResumed\tFailed\tSkipped\tPer minute\tp50\tp95\tmax')
+  for step, step_results in steps.items():
+    counts = {outcome: 0 for outcome in (STEP_DONE, STEP_RESUMED, STEP_FAILED,
+                                         STEP_SKIPPED)}
+    for step_result in step_results:
+      counts[step_result.outcome] += 1
+    latencies = [step_result.seconds for step_result in step_results
+                 if step_result.outcome == STEP_DONE] or [0.0]
+    print(f'{step}\t{counts[STEP_DONE]}\t{counts[STEP_RESUMED]}\t'
+          f'{counts[STEP_FAILED]}\t{counts[STEP_SKIPPED]}\t'
+          f'{counts[STEP_DONE] * 60 / max(seconds, 1e-9):.1f}\t'
+          f'{_percentile(latencies, 0.5):.1f}\t'
+          f'{_percentile(latencies, 0.95):.1f}\t{max(latencies):.1f}')
+  return not any(step_result.outcome == STEP_FAILED
+                 for step_results in steps.values()
+                 for step_result in step_results)
+
+
+def _get_local_engine(args, account_pairs: List[Tuple[str, str]],
+                      start_date: datetime.date,
+                      end_date: datetime.date) -> LocalEngine:
+  """Returns a LocalEngine over generated or previously written fixtures."""
+  sys.path.insert(0, _TOOLS_DIR)
+  import duckdb  # pylint: disable=g-import-not-at-top
+  import sql_harness  # pylint: disable=g-import-not-at-top
+  import synthetic_data  # pylint: disable=g-import-not-at-top
+  os.makedirs(args.local_output_dir, exist_ok=True)
+  # The LowVolumeSkus tables outlive the run, so that a resumed run exports
+  # the run dates scored before.
+  conn = duckdb.connect(os.path.join(args.local_output_dir, 'backfill.duckdb'))
+  if args.local_data_dir:
+    synthetic_data.attach_tables(conn, args.local_data_dir)
+  else:
+    # The fixtures precede the last run date and cover the window of the first.
+    options = synthetic_data.Options(
+        offers=args.local_offers,
+        days=synthetic_data.Options().days + (end_date - start_date).days)
+    for mc, gads in account_pairs:
+      synthetic_data.create_tables(conn, options, mc, gads, end_date)
+  return LocalEngine(
+      conn, sql_harness.load_variables(zombies_config.VARIABLES_FILE),
+      args.local_output_dir)
+
+
+def _get_args_parser():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--config_file', default=zombies_config.CONFIG_FILE,
+                      help='JSON artifact compiled from variables.tf by '
+                      'zombies_config.py.')
+  parser.add_argument('--start_date', required=True,
+                      help='First run date as YYYYMMDD.')
+  parser.add_argument('--end_date', required=True,
+                      help='Last run date as YYYYMMDD, included.')
+  parser.add_argument('--pairs', nargs='+', default=None,
+                      help='Account pairs as MC_GADS, every pair of the '
+                      'configuration by default.')
+  parser.add_argument('--concurrency', type=int, default=4,
+                      help='Maximum number of queries, and of exports, '
+                      'running at a time.')
+  parser.add_argument('--export', choices=(EXPORT_ALL, EXPORT_LATEST,
+                                           EXPORT_NONE),
+                      default=None,
+                      help='Run dates of a pair whose feed is generated, '
+                      'latest in full feed mode and all in delta mode by '
+                      'default.')
+  parser.add_argument('--checkpoint_file', default='zombies_backfill.jsonl',
+                      help='JSON lines file of the finished steps, the steps '
+                      'it holds are not run again.')
+  parser.add_argument('--local_offers', type=int, default=None,
+                      help='Runs on a local DuckDB over fixtures of that many '
+                      'offers per pair generated by synthetic_data.py.')
+  parser.add_argument('--local_data_dir', default=None,
+                      help='Runs on a local DuckDB over the files written by '
+                      'synthetic_data.py.')
+  parser.add_argument('--local_output_dir', default='.',
+                      help='Folder of the DuckDB database and of the feed '
+                      'files of a local run.')
+  parser.add_argument('--spans_exporter', default=spans.JSONL_EXPORTER,
+                      help='Exporter of the timing spans: jsonl, otel or none.')
+  parser.add_argument('--spans_file', default='zombies_spans.jsonl',
+                      help='JSON lines file the jsonl exporter appends the '
+                      'spans to.')
+  return parser
+
+
+def main(argv=None):
+  logging.basicConfig(level=logging.INFO)
+  args = _get_args_parser().parse_args(argv)
+  start_date = datetime.datetime.strptime(args.start_date, '%Y%m%d').date()
+  end_date = datetime.datetime.strptime(args.end_date, '%Y%m%d').date()
+  if end_date < start_date:
+    raise SystemExit('--end_date precedes --start_date.')
+  local = args.local_offers or args.local_data_dir
+  config = None
+  if args.pairs:
+    account_pairs = [tuple(pair.split('_', 1)) for pair in args.pairs]
+  else:
+    config = zombies_config.load_config(config_file=args.config_file)
+    account_pairs = [(account.mc, account.gads)
+                     for account in zombies_config.get_accounts(config)]
+  tracer = spans.get_tracer(args.spans_exporter, args.spans_file,
+                            stage='backfill')
+  if local:
+    engine = _get_local_engine(args, account_pairs, start_date, end_date)
+  else:
+    config = config or zombies_config.load_config(config_file=args.config_file)
+    variables = config['variables']
+    os.environ.update(get_function_environment(
+        config, args.spans_exporter, args.spans_file))
+    import main as function  # pylint: disable=g-import-not-at-top
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    # Built before the threads start, the invocations share it.
+    function._get_state()  # pylint: disable=protected-access
+    engine = BigQueryEngine(
+        bigquery.Client(project=variables['gcp_project']),
+        data_transfers.CloudDataTransferUtils(variables['gcp_project'],
+                                              tracer=tracer),
+        variables, function)
+  export_mode = args.export
+  if export_mode is None:
+    # Each full feed replaces the previous one, only the last one is kept.
+    export_mode = (EXPORT_LATEST if engine.feed_mode == _FULL_FEED_MODE
+                   else EXPORT_ALL)
+  runner = BackfillRunner(engine, Checkpoint(args.checkpoint_file), tracer,
+                          args.concurrency, export_mode)
+  start = time.monotonic()
+  results = runner.run(get_tasks(account_pairs, start_date, end_date))
+  if not _print_results(results, time.monotonic() - start):
+    raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,153 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Tests of BackfillRunner with a recording engine and the LocalEngine."""
+
+import datetime
+import os
+import sys
+import threading
+from typing import Dict, List, Set, Tuple
+
+import pytest
+
+pytest.importorskip('pytz')
+pytest.importorskip('google.cloud.bigquery_datatransfer_v1')
+
+import backfill  # pylint: disable=g-import-not-at-top,wrong-import-position
+import zombies_config  # pylint: disable=g-import-not-at-top,wrong-import-position
+
+_PAIRS = [('1234', '5678'), ('4321', '8765')]
+_START_DATE = datetime.date(2024, 1, 1)
+_END_DATE = datetime.date(2024, 1, 5)
+
+
+class _RecordingEngine(object):
+  """Records the steps it runs and fails those it is given."""
+
+  def __init__(self, failures: Set[Tuple[str, str, int]] = frozenset(),
+               ordered: bool = False):
+    """Initialise new instance of _RecordingEngine.
+    Args:
+      failures: (step, mc, day of the month) of the steps raising an error.
+      ordered: Whether the run dates of a pair are scored in order.
+    """
+    self.ordered = ordered
+    self.steps = []  # type: List[Tuple[str, str, int]]
+    self._failures = failures
+    self._lock = threading.Lock()
+
+  def _run(self, step: str, task: backfill.Task) -> Dict[str, object]:
+    with self._lock:
+      self.steps.append((step, task.mc, task.run_date.day))
+    if (step, task.mc, task.run_date.day) in self._failures:
+      raise RuntimeError(f'{step} failed')
+    return {}
+
+  def score(self, task: backfill.Task) -> Dict[str, object]:
+    return self._run(backfill.SCORE, task)
+
+  def export(self, task: backfill.Task) -> Dict[str, object]:
+    return self._run(backfill.EXPORT, task)
+
+
+def _run(engine, checkpoint_file=None, export_mode=backfill.EXPORT_ALL):
+  runner = backfill.BackfillRunner(
+      engine, backfill.Checkpoint(checkpoint_file),
+      backfill.spans.get_tracer(backfill.spans.NO_EXPORTER), 2, export_mode)
+  results = runner.run(backfill.get_tasks(_PAIRS, _START_DATE, _END_DATE))
+  return {(task.mc, task.run_date.day): result
+          for task, result in results.items()}
+
+
+def _get_outcomes(results, mc: str, step: str) -> List[str]:
+  return [getattr(result, step).outcome if getattr(result, step) else None
+          for (result_mc, _), result in sorted(results.items())
+          if result_mc == mc]
+
+
+@pytest.mark.parametrize('ordered', [False, True])
+def test_exports_of_a_pair_stop_at_its_first_failure(ordered):
+  engine = _RecordingEngine({(backfill.SCORE, '1234', 3)}, ordered)
+
+  results = _run(engine)
+
+  assert _get_outcomes(results, '1234', backfill.SCORE) == [
+      backfill.STEP_DONE, backfill.STEP_DONE, backfill.STEP_FAILED,
+      backfill.STEP_DONE, backfill.STEP_DONE]
+  assert _get_outcomes(results, '1234', backfill.EXPORT) == [
+      backfill.STEP_DONE, backfill.STEP_DONE] + [backfill.STEP_SKIPPED] * 3
+  assert _get_outcomes(results, '4321', backfill.EXPORT) == (
+      [backfill.STEP_DONE] * 5)
+  assert [day for step, mc, day in engine.steps
+          if step == backfill.EXPORT and mc == '1234'] == [1, 2]
+
+
+def test_rerun_resumes_after_the_finished_steps(tmp_path):
+  checkpoint_file = str(tmp_path / 'checkpoint.jsonl')
+  _run(_RecordingEngine({(backfill.EXPORT, '4321', 2)}), checkpoint_file)
+  engine = _RecordingEngine()
+
+  results = _run(engine, checkpoint_file)
+
+  assert _get_outcomes(results, '4321', backfill.SCORE) == (
+      [backfill.STEP_RESUMED] * 5)
+  assert _get_outcomes(results, '4321', backfill.EXPORT) == [
+      backfill.STEP_RESUMED] + [backfill.STEP_DONE] * 4
+  assert _get_outcomes(results, '1234', backfill.EXPORT) == (
+      [backfill.STEP_RESUMED] * 5)
+  assert sorted(engine.steps) == [
+      (backfill.EXPORT, '4321', day) for day in range(2, 6)]
+
+
+def test_latest_export_mode_only_exports_the_last_run_date():
+  engine = _RecordingEngine()
+
+  results = _run(engine, export_mode=backfill.EXPORT_LATEST)
+
+  assert _get_outcomes(results, '1234', backfill.EXPORT) == [
+      None, None, None, None, backfill.STEP_DONE]
+  assert sorted(step for step in engine.steps
+                if step[0] == backfill.EXPORT) == [
+                    (backfill.EXPORT, '1234', 5), (backfill.EXPORT, '4321', 5)]
+
+
+def test_local_engine_scores_and_exports_the_fixtures(tmp_path):
+  duckdb = pytest.importorskip('duckdb')
+  sys.path.insert(0, backfill._TOOLS_DIR)  # pylint: disable=protected-access
+  import sql_harness  # pylint: disable=g-import-not-at-top
+  import synthetic_data  # pylint: disable=g-import-not-at-top
+  conn = duckdb.connect(str(tmp_path / 'backfill.duckdb'))
+  options = synthetic_data.Options(
+      offers=200, days=synthetic_data.Options().days + 4)
+  for mc, gads in _PAIRS:
+    synthetic_data.create_tables(conn, options, mc, gads, _END_DATE)
+  engine = backfill.LocalEngine(
+      conn, sql_harness.load_variables(zombies_config.VARIABLES_FILE),
+      str(tmp_path))
+  checkpoint_file = str(tmp_path / 'checkpoint.jsonl')
+
+  results = _run(engine, checkpoint_file, backfill.EXPORT_LATEST)
+  resumed = _run(engine, checkpoint_file, backfill.EXPORT_LATEST)
+
+  assert all(result.score.outcome == backfill.STEP_DONE
+             for result in results.values())
+  assert sorted(path for path in os.listdir(tmp_path)
+                if path.endswith('.tsv')) == [
+                    'low_volume_skus_1234_5678_20240105.tsv',
+                    'low_volume_skus_4321_8765_20240105.tsv']
+  assert all(result.score.outcome == backfill.STEP_RESUMED
+             for result in resumed.values())
@@ -17,10 +17,18 @@
 """Module for managing BigQuery data transfers."""
 
 import argparse
+import collections
 import datetime
+import heapq
+import json
 import logging
+import os
+import random
+import sys
+import threading
 import time
-from typing import Any, Dict
+from concurrent import futures
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 import pytz
 
@@ -30,17 +38,45 @@ from google.cloud.bigquery_datatransfer_v1 import types
 from google.protobuf import struct_pb2
 from google.protobuf import timestamp_pb2
 import authorization
+import zombies_config
+
+# The timing spans are shared with the feed generation Cloud Function.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'cfs', 'low_volume_skus_feed_generation'))
+import spans  # pylint: disable=g-import-not-at-top,wrong-import-position
 
 
 _MERCHANT_CENTER_ID = 'merchant_center'  # Data source id for Merchant Center.
 _GOOGLE_ADS_ID = 'google_ads'  # Data source id for Google Ads.
-_SLEEP_SECONDS = 60  # Seconds to sleep before checking resource status.
+_SLEEP_SECONDS = 60  # Maximum seconds to sleep before checking resource status.
+_INITIAL_SLEEP_SECONDS = 5  # First polling delay, doubled after every check.
 _MAX_POLL_COUNTER = 100
+_MAX_WAIT_SECONDS = _SLEEP_SECONDS * _MAX_POLL_COUNTER
+# Runs listed to find the run of a date, past the refresh window reruns.
+_RUNS_PAGE_SIZE = 10
 _PENDING_STATE = 2
 _RUNNING_STATE = 3
 _SUCCESS_STATE = 4
 _FAILED_STATE = 5
 _CANCELLED_STATE = 6
+# Outcomes of wait_for_transfers_completion.
+TRANSFER_SUCCEEDED = 'SUCCEEDED'
+TRANSFER_FAILED = 'FAILED'
+TRANSFER_CANCELLED = 'CANCELLED'
+TRANSFER_NO_RUNS = 'NO_RUNS'
+TRANSFER_TIMED_OUT = 'TIMED_OUT'
+TRANSFER_MISSING = 'MISSING'  # The transfer config does not exist.
+_TERMINAL_OUTCOMES = {
+    _SUCCESS_STATE: TRANSFER_SUCCEEDED,
+    _FAILED_STATE: TRANSFER_FAILED,
+    _CANCELLED_STATE: TRANSFER_CANCELLED,
+}
+_DEFAULT_MAX_WORKERS = 8  # Concurrent transfer creations in bulk mode.
+# Transfer parameter holding the account id of each data source.
+_ACCOUNT_ID_PARAMS = {
+    _MERCHANT_CENTER_ID: 'merchant_id',
+    _GOOGLE_ADS_ID: 'customer_id',
+}
 
 
 class Error(Exception):
@@ -51,70 +87,302 @@ class DataTransferError(Error):
   """An exception to be raised when data transfer was not successful."""
 
 
+class _TransferIndex(object):
+  """In-memory index of the transfer configs of a location.
+
+  Configs are keyed by (data source id, destination dataset id, merchant or
+  customer id) and then by display name.
+  """
+
+  def __init__(self):
+    self._configs = collections.defaultdict(
+        lambda: collections.defaultdict(list))
+    self._keys_by_name = {}
+
+  def __len__(self) -> int:
+    return len(self._keys_by_name)
+
+  def add(self, transfer_config: types.TransferConfig) -> None:
+    """Adds a transfer config, replacing the config with the same name."""
+    previous_key = self._keys_by_name.pop(transfer_config.name, None)
+    if previous_key:
+      configs = self._configs[previous_key[:3]][previous_key[3]]
+      configs[:] = [config for config in configs
+                    if config.name != transfer_config.name]
+    key = _get_index_key(transfer_config)
+    self._configs[key[:3]][key[3]].append(transfer_config)
+    self._keys_by_name[transfer_config.name] = key
+
+  def find(self, data_source_id: str, destination_dataset_id: Optional[str],
+           account_id: Optional[str],
+           name: Optional[str]) -> List[types.TransferConfig]:
+    """Returns the transfer configs matching the non empty arguments."""
+    if destination_dataset_id and account_id is not None:
+      buckets = [self._configs.get(
+          (data_source_id, destination_dataset_id, account_id), {})]
+    else:
+      buckets = [bucket for key, bucket in self._configs.items()
+                 if key[0] == data_source_id and
+                 (not destination_dataset_id or key[1] == destination_dataset_id)
+                 and (account_id is None or key[2] == account_id)]
+    if name is not None:
+      return [config for bucket in buckets for config in bucket.get(name, [])]
+    return [config for bucket in buckets for configs in bucket.values()
+            for config in configs]
+
+
 class CloudDataTransferUtils(object):
   """This class provides methods to manage BigQuery data transfers.
 
   """
 
-  def __init__(self, project_id: str):
+  def __init__(self, project_id: str, client: Any = None,
+               tracer: Optional[spans.Tracer] = None):
     """Initialise new instance of CloudDataTransferUtils.
     Args:
       project_id: GCP project id.
+      client: Data transfer service client, a new DataTransferServiceClient is
+        created if not provided.
+      tracer: Records the API call latencies and the transfer runs, no span
+        is recorded if not provided.
     """
     self.project_id = project_id
-    self.client = bigquery_datatransfer_v1.DataTransferServiceClient()
+    self._tracer = tracer or spans.get_tracer(spans.NO_EXPORTER)
+    self.client = client or bigquery_datatransfer_v1.DataTransferServiceClient()
+    # Authorization codes are requested interactively, prompts from
+    # concurrent transfer creations must not interleave.
+    self._authorization_lock = threading.Lock()
+    # Transfer configs listed once per location, see _get_transfer_index.
+    self._transfer_index = {}
+    self._transfer_index_lock = threading.Lock()
 
   def wait_for_transfer_completion(self,
                                    transfer_config: Dict[str,
                                                          Any]
                                                          ) -> None:
     """Waits for the completion of data transfer operation.
-    This method retrieves data transfer operation and checks for its status. If
-    the operation is not completed, then the operation is re-checked after
-    `_SLEEP_SECONDS` seconds.
+    This method retrieves data transfer operation and checks for its status
+    with the backoff of `wait_for_transfers_completion`.
     Args:
       transfer_config: Resource representing data transfer.
     Raises:
       DataTransferError: If the data transfer is not successfully completed.
     """
-    # TODO: Use exponential back-off for polling.
     transfer_config_name = transfer_config.name
-    transfer_config_id = transfer_config_name.split('/')[-1]
-    poll_counter = 0  # Counter to keep polling count.
-    while True:
-
-      parent = self.client.transfer_config_path(
-          self.project_id, transfer_config_id)
-      request = bigquery_datatransfer_v1.ListTransferRunsRequest(
-        parent=parent,
+    outcome = self.wait_for_transfers_completion(
+        [transfer_config])[transfer_config_name]
+    if outcome in (TRANSFER_SUCCEEDED, TRANSFER_NO_RUNS):
+      return
+    if outcome == TRANSFER_TIMED_OUT:
+      error_message = (f'Transfer {transfer_config_name} is taking too long'
+                       ' to finish. Hence failing the request.')
+    else:
+      error_message = (f'Transfer {transfer_config_name} was not successful. '
+                       f'Outcome - {outcome}')
+    logging.error(error_message)
+    raise DataTransferError(error_message)
+
+  def wait_for_transfers_completion(
+      self,
+      transfer_configs: Iterable[types.TransferConfig],
+      max_wait_seconds: float = _MAX_WAIT_SECONDS,
+      sleep: Callable[[float], None] = time.sleep,
+      clock: Callable[[], float] = time.monotonic,
+      run_date: Optional[datetime.date] = None,
+      on_outcome: Optional[Callable[[str, str], Any]] = None
+      ) -> Dict[str, str]:
+    """Waits for the latest run of many data transfers at once.
+    Every transfer is polled on its own schedule, starting after
+    `_INITIAL_SLEEP_SECONDS` and doubling the delay up to `_SLEEP_SECONDS`
+    with full jitter, so the whole wait lasts about as long as the slowest
+    transfer. The latest run of every transfer is recorded as a span with the
+    number of polls it took.
+    Args:
+      transfer_configs: Resources representing the data transfers.
+      max_wait_seconds: Time after which the pending transfers time out.
+      sleep: Function used to wait between polls.
+      clock: Monotonic clock in seconds.
+      run_date: Waits for the run of this date instead of the latest run, a
+        transfer without a run for the date yet is still pending.
+      on_outcome: Called with the transfer config name and its outcome as
+        soon as a transfer finishes, before the other ones are polled again.
+        The transfer configs it returns, e.g. runs it started, are waited for
+        too, until the same deadline.
+    Returns:
+      Dictionary from transfer config name to one of TRANSFER_SUCCEEDED,
+      TRANSFER_FAILED, TRANSFER_CANCELLED, TRANSFER_NO_RUNS or
+      TRANSFER_TIMED_OUT.
+    """
+    deadline = clock() + max_wait_seconds
+    outcomes = {}
+    delays = {}
+    polls = collections.Counter()
+    configs = {}
+    pending = []
+
+    def _add_config(transfer_config):
+      if transfer_config.name in configs:
+        return
+      configs[transfer_config.name] = transfer_config
+      delays[transfer_config.name] = _INITIAL_SLEEP_SECONDS
+      heapq.heappush(pending, (clock(), transfer_config.name))
+
+    def _set_outcome(transfer_config_name, outcome):
+      outcomes[transfer_config_name] = outcome
+      if on_outcome:
+        for transfer_config in on_outcome(transfer_config_name, outcome) or ():
+          _add_config(transfer_config)
+
+    for transfer_config in transfer_configs:
+      _add_config(transfer_config)
+    with self._tracer.span('wait_for_transfers',
+                           transfers=len(configs)) as wait_span:
+      while pending:
+        poll_time, transfer_config_name = heapq.heappop(pending)
+        wait_seconds = poll_time - clock()
+        if wait_seconds > 0:
+          sleep(wait_seconds)
+        latest_transfer = self._get_latest_transfer_run(transfer_config_name,
+                                                        run_date)
+        polls[transfer_config_name] += 1
+        if not latest_transfer and run_date is None:
+          _set_outcome(transfer_config_name, TRANSFER_NO_RUNS)
+          continue
+        if latest_transfer and latest_transfer.state in _TERMINAL_OUTCOMES:
+          outcome = _TERMINAL_OUTCOMES[latest_transfer.state]
+          if outcome == TRANSFER_SUCCEEDED:
+            logging.info('Transfer %s was successful.', transfer_config_name)
+          else:
+            logging.error('Transfer %s was not successful. Error - %s',
+                          transfer_config_name, latest_transfer.error_status)
+          self._record_transfer_run(configs[transfer_config_name],
+                                    latest_transfer, outcome,
+                                    polls[transfer_config_name])
+          _set_outcome(transfer_config_name, outcome)
+          continue
+        if clock() >= deadline:
+          logging.error('Transfer %s is taking too long to finish.',
+                        transfer_config_name)
+          _set_outcome(transfer_config_name, TRANSFER_TIMED_OUT)
+          continue
+        delay = random.uniform(0, delays[transfer_config_name])
+        delays[transfer_config_name] = min(delays[transfer_config_name] * 2,
+                                           _SLEEP_SECONDS)
+        logging.info(
+            'Transfer %s still in progress. Checking again in %.0f seconds.',
+            transfer_config_name, delay)
+        heapq.heappush(pending, (min(clock() + delay, deadline),
+                                 transfer_config_name))
+      wait_span.set(transfers=len(configs), polls=sum(polls.values()))
+    return outcomes
+
+  def _record_transfer_run(self, transfer_config: types.TransferConfig,
+                           transfer_run: types.TransferRun, outcome: str,
+                           polls: int) -> None:
+    """Records the span of a finished transfer run.
+    Args:
+      transfer_config: Resource representing the data transfer.
+      transfer_run: Latest run of the data transfer.
+      outcome: Outcome of the run, as returned by wait_for_transfers_completion.
+      polls: Number of times the run was polled.
+    """
+    if not transfer_run.start_time or not transfer_run.end_time:
+      return
+    self._tracer.record(
+        'transfer_run',
+        transfer_run.start_time.timestamp(),
+        transfer_run.end_time.timestamp(),
+        status='ok' if outcome == TRANSFER_SUCCEEDED else 'error',
+        run_date=transfer_run.run_time.strftime('%Y%m%d'),
+        data_source_id=transfer_config.data_source_id,
+        account_id=_get_account_id(transfer_config.data_source_id,
+                                   transfer_config.params),
+        transfer_config=transfer_config.name,
+        outcome=outcome,
+        polls=polls)
+
+  def _get_latest_transfer_run(
+      self, transfer_config_name: str,
+      run_date: Optional[datetime.date] = None
+      ) -> Optional[types.TransferRun]:
+    """Returns the newest run of a data transfer.
+    Args:
+      transfer_config_name: Resource name of the data transfer.
+      run_date: Only returns a run whose run time is on this date, in UTC.
+    Returns:
+      The newest transfer run, None if the transfer never ran or has no run
+      for the date.
+    """
+    request = bigquery_datatransfer_v1.ListTransferRunsRequest(
+        parent=transfer_config_name,
+        page_size=1 if run_date is None else _RUNS_PAGE_SIZE,
         )
-      # Make the request
+    # Runs are listed newest first, only the first page is fetched.
+    with self._tracer.span('dts.list_transfer_runs',
+                           transfer_config=transfer_config_name):
       response = self.client.list_transfer_runs(request=request)
-      latest_transfer = None
-      for transfer in response:
-        latest_transfer = transfer
-        break
-      if not latest_transfer:
-        return
-      if latest_transfer.state == _SUCCESS_STATE:
-        logging.info('Transfer %s was successful.', transfer_config_name)
-        return
-      if (latest_transfer.state == _FAILED_STATE or
-          latest_transfer.state == _CANCELLED_STATE):
-        error_message = (f'Transfer {transfer_config_name} was not successful. '
-                         f'Error - {latest_transfer.error_status}')
-        logging.error(error_message)
-        raise DataTransferError(error_message)
-      logging.info(
-          'Transfer %s still in progress. Sleeping for %s seconds before '
-          'checking again.', transfer_config_name, _SLEEP_SECONDS)
-      time.sleep(_SLEEP_SECONDS)
-      poll_counter += 1
-      if poll_counter >= _MAX_POLL_COUNTER:
-        error_message = (f'Transfer {transfer_config_name} is taking too long'
-                         ' to finish. Hence failing the request.')
-        logging.error(error_message)
-        raise DataTransferError(error_message)
+    for transfer_run in response.transfer_runs:
+      if (run_date is None or
+          transfer_run.run_time.astimezone(pytz.utc).date() == run_date):
+        return transfer_run
+    return None
+
+  def get_transfer_run(self, transfer_config_name: str,
+                       run_date: datetime.date) -> Optional[types.TransferRun]:
+    """Returns the newest run of a data transfer for a run date.
+    Args:
+      transfer_config_name: Resource name of the data transfer.
+      run_date: Date of the run time, in UTC.
+    Returns:
+      The transfer run, None if the transfer has no run for the date.
+    """
+    return self._get_latest_transfer_run(transfer_config_name, run_date)
+
+  def start_manual_run(self, transfer_config_name: str,
+                       run_date: datetime.date,
+                       **attributes: Any) -> List[types.TransferRun]:
+    """Starts a run of a data transfer for a run date.
+    The run time is the start of the date in UTC, so a scheduled query sees
+    the date as its @run_date parameter.
+    Args:
+      transfer_config_name: Resource name of the data transfer.
+      run_date: Date of the run time, in UTC.
+      **attributes: Attributes of the span recording the call.
+    Returns:
+      The started transfer runs.
+    """
+    run_time = timestamp_pb2.Timestamp()
+    run_time.FromDatetime(datetime.datetime.combine(run_date,
+                                                    datetime.time.min))
+    request = bigquery_datatransfer_v1.StartManualTransferRunsRequest(
+        parent=transfer_config_name,
+        requested_run_time=run_time,
+        )
+    with self._tracer.span('dts.start_manual_transfer_runs',
+                           transfer_config=transfer_config_name,
+                           run_date=run_date.strftime('%Y%m%d'), **attributes):
+      response = self.client.start_manual_transfer_runs(request=request)
+    logging.info('Started run %s of %s.', run_date, transfer_config_name)
+    return list(response.runs)
+
+  def find_transfer_config(self, data_source_id: str, dataset_location: str,
+                           account_id: Optional[str] = None,
+                           name: Optional[str] = None
+                           ) -> Optional[types.TransferConfig]:
+    """Finds a data transfer of any destination dataset in the index.
+    Args:
+      data_source_id: Data source id.
+      dataset_location: BigQuery dataset location.
+      account_id: Merchant or customer id of the transfer.
+      name: Display name of the transfer.
+    Returns:
+      The first transfer config matching the non empty arguments, None if
+      there is none.
+    """
+    index = self._get_transfer_index(dataset_location)
+    with self._transfer_index_lock:
+      candidates = index.find(data_source_id, None, account_id, name)
+    return candidates[0] if candidates else None
 
   def _get_existing_transfer(self, data_source_id: str,
                              destination_dataset_id: str = None,
@@ -122,32 +390,77 @@ class CloudDataTransferUtils(object):
                              params: Dict[str, str] = None,
                              name: str = None) -> bool:
     """Gets data transfer if it already exists.
+    The lookup is answered from the in-memory transfer index of the location,
+    the transfer configs are only listed the first time a location is used.
     Args:
       data_source_id: Data source id.
       destination_dataset_id: BigQuery dataset id.
       dataset_location: BigQuery dataset location.
       params: Data transfer specific parameters.
+      name: Display name of the transfer.
     Returns:
       Data Transfer if the transfer already exists.
       None otherwise.
     """
-    parent = self.client.common_location_path(self.project_id, dataset_location)
-    parent = dict(parent=parent)
-
-    for transfer_config in self.client.list_transfer_configs(dict(parent)):
-      if transfer_config.data_source_id != data_source_id:
-        continue
-      if destination_dataset_id and transfer_config.destination_dataset_id != destination_dataset_id:
-        continue
+    index = self._get_transfer_index(dataset_location)
+    with self._transfer_index_lock:
+      candidates = index.find(data_source_id, destination_dataset_id,
+                              _get_account_id(data_source_id, params), name)
+    for transfer_config in candidates:
       # If the transfer config is in Failed state, we should ignore.
       is_valid_state = transfer_config.state in (_PENDING_STATE, _RUNNING_STATE,
                                                  _SUCCESS_STATE)
-      params_match = self._check_params_match(transfer_config, params)
-      name_matches = name is None or name == transfer_config.display_name
-      if params_match and is_valid_state and name_matches:
+      if is_valid_state and self._check_params_match(transfer_config, params):
         return transfer_config
     return None
 
+  def _get_transfer_index(self, dataset_location: str) -> _TransferIndex:
+    """Returns the transfer configs of a location, listing them only once.
+    Args:
+      dataset_location: BigQuery dataset location.
+    Returns:
+      The transfer index of the location.
+    """
+    with self._transfer_index_lock:
+      if dataset_location not in self._transfer_index:
+        parent = self.client.common_location_path(self.project_id,
+                                                  dataset_location)
+        index = _TransferIndex()
+        with self._tracer.span('dts.list_transfer_configs',
+                               location=dataset_location) as span:
+          for transfer_config in self.client.list_transfer_configs(
+              dict(parent=parent)):
+            index.add(transfer_config)
+          span.set(transfer_configs=len(index))
+        logging.info('Indexed %s transfer configs in location %s.',
+                     len(index), dataset_location)
+        self._transfer_index[dataset_location] = index
+      return self._transfer_index[dataset_location]
+
+  def _index_transfer_config(self, dataset_location: str,
+                             transfer_config: types.TransferConfig) -> None:
+    """Adds or replaces a transfer config in an already built index.
+    Args:
+      dataset_location: BigQuery dataset location.
+      transfer_config: Created or updated data transfer configuration.
+    """
+    with self._transfer_index_lock:
+      index = self._transfer_index.get(dataset_location)
+      if index is not None:
+        index.add(transfer_config)
+
+  def invalidate_transfer_index(self, dataset_location: str = None) -> None:
+    """Drops the transfer index so the configs are listed again.
+    Args:
+      dataset_location: BigQuery dataset location, all the locations are
+        invalidated if not provided.
+    """
+    with self._transfer_index_lock:
+      if dataset_location is None:
+        self._transfer_index.clear()
+      else:
+        self._transfer_index.pop(dataset_location, None)
+
   def _check_params_match(self,
                           transfer_config: types.TransferConfig,
                           params: Dict[str, str]) -> bool:
@@ -167,13 +480,17 @@ class CloudDataTransferUtils(object):
     return True
 
   def _update_existing_transfer(self, transfer_config: types.TransferConfig,
-                                params: Dict[str, str]) -> types.TransferConfig:
+                                params: Dict[str, str],
+                                dataset_location: str = None
+                                ) -> types.TransferConfig:
     """Updates existing data transfer.
     If the parameters are already present in the config, then the transfer
     config update is skipped.
     Args:
       transfer_config: Data transfer configuration to update.
       params: Data transfer specific parameters.
+      dataset_location: BigQuery dataset location, used to keep the transfer
+        index up to date.
     Returns:
       Updated data transfer config.
     """
@@ -189,8 +506,11 @@ class CloudDataTransferUtils(object):
       new_transfer_config.params[key] = value
     # Only params field is updated.
     update_mask = {"paths": ["params"]}
-    new_transfer_config = self.client.update_transfer_config(
-        new_transfer_config, update_mask)
+    with self._tracer.span('dts.update_transfer_config',
+                           transfer_config=transfer_config.name):
+      new_transfer_config = self.client.update_transfer_config(
+          new_transfer_config, update_mask)
+    self._index_transfer_config(dataset_location, new_transfer_config)
     logging.info('The data transfer config "%s" parameters updated.',
                  new_transfer_config.display_name)
     return new_transfer_config
@@ -227,7 +547,8 @@ class CloudDataTransferUtils(object):
       logging.info(
           'Data transfer for merchant id %s to destination dataset %s '
           'already exists.', merchant_id, destination_dataset)
-      return self._update_existing_transfer(data_transfer_config, parameters)
+      return self._update_existing_transfer(data_transfer_config, parameters,
+                                            dataset_location)
     logging.info(
         'Creating data transfer for merchant id %s to destination dataset %s',
         merchant_id, destination_dataset)
@@ -250,7 +571,11 @@ class CloudDataTransferUtils(object):
         service_account_name=service_account
     )
 
-    transfer_config = self.client.create_transfer_config(request)
+    with self._tracer.span('dts.create_transfer_config',
+                           data_source_id=_MERCHANT_CENTER_ID,
+                           account_id=merchant_id):
+      transfer_config = self.client.create_transfer_config(request)
+    self._index_transfer_config(dataset_location, transfer_config)
     logging.info(
         'Data transfer created for merchant id %s to destination dataset %s',
         merchant_id, destination_dataset)
@@ -313,7 +638,11 @@ class CloudDataTransferUtils(object):
         authorization_code=authorization_code,
         service_account_name=service_account
     )
-    transfer_config = self.client.create_transfer_config(request)
+    with self._tracer.span('dts.create_transfer_config',
+                           data_source_id=_GOOGLE_ADS_ID,
+                           account_id=customer_id):
+      transfer_config = self.client.create_transfer_config(request)
+    self._index_transfer_config(dataset_location, transfer_config)
     logging.info(
         'Data transfer created for Google Ads customer id %s to destination '
         'dataset %s', customer_id, destination_dataset)
@@ -351,62 +680,276 @@ class CloudDataTransferUtils(object):
 
     if not data_source:
       raise AssertionError('Invalid data source')
-    return authorization.retrieve_authorization_code(client_id, scopes, data_source_id)
+    with self._authorization_lock, self._tracer.span(
+        'authorization', data_source_id=data_source_id):
+      return authorization.retrieve_authorization_code(client_id, scopes,
+                                                       data_source_id)
+
+  def create_transfers_for_accounts(
+      self,
+      account_pairs: List[Tuple[str, str]],
+      merchant_dataset: str,
+      gads_dataset: str,
+      dataset_location: str,
+      service_account: str,
+      merchant_schedule: str,
+      gads_schedule: str,
+      max_workers: int = _DEFAULT_MAX_WORKERS
+      ) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """Creates or updates the transfers of many account pairs concurrently.
+    Every Merchant Center and Google Ads account is provisioned once even if it
+    belongs to several pairs, all the requests share this instance's client.
+    Args:
+      account_pairs: List of (merchant id, Google Ads customer id) pairs.
+      merchant_dataset: Merchant Center BigQuery dataset id.
+      gads_dataset: Google Ads BigQuery dataset id.
+      dataset_location: BigQuery dataset location.
+      service_account: Name of the service account to run the transfers.
+      merchant_schedule: Schedule to run the Merchant Center transfers.
+      gads_schedule: Schedule to run the Google Ads transfers.
+      max_workers: Maximum number of transfers created at the same time.
+    Returns:
+      Dictionary keyed by account pair with the Merchant Center and Google Ads
+      transfer configs, or the error raised while creating them.
+    """
+    merchant_ids = sorted({mc for mc, _ in account_pairs})
+    customer_ids = sorted({gads for _, gads in account_pairs})
+    outcomes = collections.defaultdict(dict)
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor, \
+        self._tracer.span('create_transfers', pairs=len(account_pairs),
+                          workers=max_workers):
+      tasks = {}
+      for merchant_id in merchant_ids:
+        task = executor.submit(self.create_merchant_center_transfer,
+                               merchant_id, merchant_dataset, dataset_location,
+                               service_account, merchant_schedule)
+        tasks[task] = (_MERCHANT_CENTER_ID, merchant_id)
+      for customer_id in customer_ids:
+        task = executor.submit(self.create_google_ads_transfer,
+                               customer_id, gads_dataset, dataset_location,
+                               service_account, gads_schedule)
+        tasks[task] = (_GOOGLE_ADS_ID, customer_id)
+      for task in futures.as_completed(tasks):
+        data_source_id, account_id = tasks[task]
+        try:
+          outcomes[data_source_id][account_id] = task.result()
+        except Exception as error:  # pylint: disable=broad-except
+          logging.error('Transfer creation for %s account %s failed: %s',
+                        data_source_id, account_id, error)
+          outcomes[data_source_id][account_id] = error
+    return {(mc, gads): {_MERCHANT_CENTER_ID: outcomes[_MERCHANT_CENTER_ID][mc],
+                         _GOOGLE_ADS_ID: outcomes[_GOOGLE_ADS_ID][gads]}
+            for mc, gads in account_pairs}
+
+
+def _get_account_id(data_source_id: str, params: Any) -> Optional[str]:
+  """Returns the merchant or customer id held by transfer parameters.
+  Args:
+    data_source_id: Data source id.
+    params: Data transfer specific parameters.
+  Returns:
+    The account id, None if the data source has no account parameter or it
+    is not set.
+  """
+  key = _ACCOUNT_ID_PARAMS.get(data_source_id)
+  if not key or not params or key not in params:
+    return None
+  return str(params[key])
+
+
+def _get_index_key(
+    transfer_config: types.TransferConfig
+    ) -> Tuple[str, str, Optional[str], str]:
+  """Returns the transfer index key of a transfer config."""
+  return (transfer_config.data_source_id,
+          transfer_config.destination_dataset_id,
+          _get_account_id(transfer_config.data_source_id,
+                          transfer_config.params),
+          transfer_config.display_name)
+
+
+def _print_transfers_summary(
+    results: Dict[Tuple[str, str], Dict[str, Any]]) -> bool:
+  """Prints the outcome of the transfers created for every account pair.
+  Args:
+    results: Output of CloudDataTransferUtils.create_transfers_for_accounts.
+  Returns:
+    True if all the transfers were created successfully, False otherwise.
+  """
+  all_succeeded = True
+  print('Merchant\tGAds\tMerchant transfer\tGAds transfer')
+  for (mc, gads), transfers in results.items():
+    columns = []
+    for data_source_id in (_MERCHANT_CENTER_ID, _GOOGLE_ADS_ID):
+      transfer = transfers[data_source_id]
+      if isinstance(transfer, Exception):
+        all_succeeded = False
+        columns.append(f'FAILED ({transfer})')
+      else:
+        columns.append(transfer.name)
+    print('\t'.join([mc, gads] + columns))
+  return all_succeeded
 
 def _get_args_parser():
 
     parser = argparse.ArgumentParser()
 
+    parser.add_argument('--config_file',
+      help='JSON artifact compiled from variables.tf by zombies_config.py. '
+           'Provides the arguments and account pairs not set explicitly.',
+      default=None)
+
     parser.add_argument('--project_id',
       help='GCP Project.',
-      default=None,
-      required=True)
+      default=None)
     parser.add_argument('--merchant_dataset_id',
       help='Merchant BigQuery dataset id.',
-      default=None,
-      required=True)
+      default=None)
 
     parser.add_argument('--gads_dataset_id',
       help='GAds BigQuery dataset id.',
-      default=None,
-      required=True)
+      default=None)
 
     parser.add_argument('--dataset_location',
       help='BigQuery dataset_location.',
-      default=None,
-      required=True)
+      default=None)
 
     parser.add_argument('--gads_account_id',
       help='GAds account id.',
-      default=None,
-      required=True)
+      default=None)
 
     parser.add_argument('--merchant_account_id',
       help='Merchant account id.',
-      default=None,
-      required=True)
+      default=None)
+
+    parser.add_argument('--account_pairs',
+      help='Merchant and GAds account pairs as MC,GADS values. When set, the '
+           'transfers of every pair are created concurrently.',
+      nargs='+',
+      default=None)
+
+    parser.add_argument('--wait_for_transfers',
+      help='Wait until the latest run of every transfer has finished.',
+      action='store_true')
+
+    parser.add_argument('--max_workers',
+      help='Maximum number of transfers created concurrently.',
+      type=int,
+      default=_DEFAULT_MAX_WORKERS)
+
+    parser.add_argument('--spans_exporter',
+      help='Exporter of the timing spans: jsonl, otel or none.',
+      default=spans.JSONL_EXPORTER)
+
+    parser.add_argument('--spans_file',
+      help='JSON lines file the jsonl exporter appends the spans to.',
+      default='zombies_spans.jsonl')
 
     parser.add_argument('--service_account',
       help='Service Account name.',
-      default=None,
-      required=True)
+      default=None)
 
     parser.add_argument('--merchant_schedule',
       help='Merchant Schedule config.',
-      default=None,
-      required=True)
+      default=None)
 
     parser.add_argument('--gads_schedule',
       help='GAds Schedule config.',
-      default=None,
-      required=True)
+      default=None)
     
     return parser
 
+# Arguments filled from the variables of the compiled configuration.
+_CONFIG_ARGUMENTS = (
+    ('project_id', 'gcp_project'),
+    ('merchant_dataset_id', 'merchant_dataset_name'),
+    ('gads_dataset_id', 'gads_dataset_name'),
+    ('dataset_location', 'zombies_data_location'),
+    ('merchant_schedule', 'merchant_schedule'),
+    ('gads_schedule', 'gads_schedule'),
+)
+
+def _apply_config_file(args):
+    """Fills the arguments not set on the command line from the config file."""
+    with open(args.config_file) as f:
+      config = json.load(f)
+    variables = config['variables']
+    for argument, variable in _CONFIG_ARGUMENTS:
+      if getattr(args, argument) is None:
+        setattr(args, argument, variables.get(variable))
+    if args.service_account is None:
+      args.service_account = zombies_config.get_service_account(config)
+    if (not args.account_pairs and not args.merchant_account_id and
+        not args.gads_account_id):
+      args.account_pairs = [f'{account.mc},{account.gads}'
+                            for account in zombies_config.get_accounts(config)]
+
+def _parse_account_pairs(account_pairs: List[str]) -> List[Tuple[str, str]]:
+    """Parses MC,GADS values into (merchant id, customer id) tuples."""
+    pairs = []
+    for account_pair in account_pairs:
+      mc, gads = account_pair.split(',')
+      pairs.append((mc.strip(), gads.strip()))
+    return pairs
+
+def _wait_for_transfers(data_transfer, transfer_configs):
+    """Waits for all the transfers and fails if any of them did not succeed."""
+    outcomes = data_transfer.wait_for_transfers_completion(transfer_configs)
+    failed = {name: outcome for name, outcome in outcomes.items()
+              if outcome not in (TRANSFER_SUCCEEDED, TRANSFER_NO_RUNS)}
+    if failed:
+      logging.error('If you have just created GMC transfer - you may need to'
+                    'wait for up to 90 minutes before the data of your Merchant'
+                    'account are prepared and available for the transfer.')
+      raise DataTransferError(f'Data transfers not successful: {failed}')
+    logging.info('The GMC and Google Ads data have been successfully '
+                 'transferred.')
+
+def _get_tracer(args):
+    """Returns the tracer of the spans configured on the command line."""
+    return spans.get_tracer(args.spans_exporter, args.spans_file,
+                            stage='data_transfers')
+
+def main_bulk(args):
+    """Creates the transfers of every account pair using a single client."""
+    data_transfer = CloudDataTransferUtils(args.project_id,
+                                           tracer=_get_tracer(args))
+    results = data_transfer.create_transfers_for_accounts(
+        _parse_account_pairs(args.account_pairs),
+        args.merchant_dataset_id,
+        args.gads_dataset_id,
+        args.dataset_location.lower(),
+        args.service_account,
+        args.merchant_schedule,
+        args.gads_schedule,
+        args.max_workers)
+    if not _print_transfers_summary(results):
+      raise DataTransferError('Some of the data transfers were not created.')
+    if args.wait_for_transfers:
+      transfer_configs = {transfer.name: transfer
+                          for transfers in results.values()
+                          for transfer in transfers.values()}
+      _wait_for_transfers(data_transfer, transfer_configs.values())
+
 def main(argv = None):
     parser = _get_args_parser();
     args, _ = parser.parse_known_args(argv)
-    data_transfer = CloudDataTransferUtils(args.project_id)
+    if args.config_file:
+      _apply_config_file(args)
+    missing = [f'--{argument}' for argument in (
+        'project_id', 'merchant_dataset_id', 'gads_dataset_id',
+        'dataset_location', 'service_account', 'merchant_schedule',
+        'gads_schedule') if not getattr(args, argument)]
+    if missing:
+      parser.error(f'missing {", ".join(missing)}, set them or --config_file.')
+    if args.account_pairs:
+      main_bulk(args)
+      return
+    if not args.merchant_account_id or not args.gads_account_id:
+      parser.error('--merchant_account_id and --gads_account_id are required '
+                   'when --account_pairs is not set.')
+    data_transfer = CloudDataTransferUtils(args.project_id,
+                                           tracer=_get_tracer(args))
     merchant_center_config = data_transfer.create_merchant_center_transfer(
         args.merchant_account_id,
         args.merchant_dataset_id,
@@ -418,21 +961,10 @@ def main(argv = None):
                                                             args.dataset_location.lower(),
                                                             args.service_account,
                                                             args.gads_schedule)
-    try:
-        logging.info('Checking the GMC data transfer status.')
-        #data_transfer.wait_for_transfer_completion(merchant_center_config, args.dataset_location)
-        logging.info('The GMC data have been successfully transferred.')
-        logging.info('Checking the Google Ads data transfer status.')
-        #data_transfer.wait_for_transfer_completion(ads_config, args.dataset_location)
-        logging.info('The Google Ads data have been successfully transferred.')
-    except DataTransferError:
-        logging.error('If you have just created GMC transfer - you may need to'
-                    'wait for up to 90 minutes before the data of your Merchant'
-                    'account are prepared and available for the transfer.')
-        raise
+    if args.wait_for_transfers:
+      _wait_for_transfers(data_transfer, [merchant_center_config, ads_config])
 
 
 if __name__ == '__main__':
 # execute only if run as the entry point into the program
     main()
-
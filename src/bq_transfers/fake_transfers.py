@@ -0,0 +1,137 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""In-memory data transfer service for local runs of the readiness scheduler.
+
+The fake holds the Merchant Center and Google Ads transfers and the low volume
+skus scheduled query of every account pair, and optionally its refresh
+scheduled queries. The runs of the run date finish at the times of a scenario,
+measured on a fake clock that only moves when the scheduler sleeps, so hours
+of waiting are replayed instantly. A scenario maps transfer display names to
+the second their run finishes and its state, e.g.:
+
+  {"Merchant_Transfer_1234": {"seconds": 5400, "state": "SUCCEEDED"},
+   "GAds_Transfer_5678": {"seconds": 900, "state": "FAILED"},
+   "GAds_Transfer_9012": {"state": "MISSING"},
+   "offer_daily_stats_1234_5678": {"seconds": 300, "state": "FAILED"}}
+
+A transfer absent from the scenario succeeds after 60 seconds, a MISSING one
+does not exist and a PENDING one never finishes. The scheduled queries only
+run once started, their seconds are counted from the start and default to 0.
+"""
+
+import datetime
+import types
+from typing import Any, Dict, List, Sequence, Tuple
+
+_DEFAULT_SECONDS = 60
+_STATES = {'PENDING': 2, 'RUNNING': 3, 'SUCCEEDED': 4, 'FAILED': 5,
+           'CANCELLED': 6}
+_MISSING = 'MISSING'
+
+
+class FakeClock(object):
+  """Monotonic clock advanced by its sleep function."""
+
+  def __init__(self):
+    self.now = 0.0
+
+  def time(self) -> float:
+    return self.now
+
+  def sleep(self, seconds: float) -> None:
+    self.now += max(0.0, seconds)
+
+
+class FakeDataTransferClient(object):
+  """Answers the data transfer service calls of the readiness scheduler."""
+
+  def __init__(self, project_id: str, location: str,
+               account_pairs: List[Tuple[str, str]], run_date: datetime.date,
+               scenario: Dict[str, Dict[str, Any]], clock: FakeClock,
+               refreshes: Sequence[str] = ()):
+    """Initialise new instance of FakeDataTransferClient.
+    Args:
+      project_id: GCP project id.
+      location: Location of the transfers.
+      account_pairs: List of (merchant id, Google Ads customer id) pairs.
+      run_date: Date of the runs of the scenario.
+      scenario: Finish time and state of the transfer runs by display name.
+      clock: Clock the finish times are measured on.
+      refreshes: Display name prefixes of the refresh scheduled queries of
+        every pair, e.g. offer_daily_stats.
+    """
+    self._parent = f'projects/{project_id}/locations/{location}'
+    self._run_time = datetime.datetime.combine(
+        run_date, datetime.time.min, tzinfo=datetime.timezone.utc)
+    self._scenario = scenario
+    self._clock = clock
+    self._configs = {}
+    self._runs = {}
+    self.started_runs = []
+    for mc, gads in account_pairs:
+      self._add_config(f'Merchant_Transfer_{mc}', 'merchant_center',
+                       {'merchant_id': mc})
+      self._add_config(f'GAds_Transfer_{gads}', 'google_ads',
+                       {'customer_id': gads})
+      self._add_config(f'low_volume_skus_{mc}_{gads}', 'scheduled_query', {})
+      for refresh in refreshes:
+        self._add_config(f'{refresh}_{mc}_{gads}', 'scheduled_query', {})
+
+  def _add_config(self, display_name: str, data_source_id: str,
+                  params: Dict[str, str]) -> None:
+    run = self._scenario.get(display_name, {})
+    if run.get('state') == _MISSING:
+      return
+    name = f'{self._parent}/transferConfigs/{display_name}'
+    self._configs[name] = types.SimpleNamespace(
+        name=name, display_name=display_name, data_source_id=data_source_id,
+        destination_dataset_id='', params=params, state=_STATES['SUCCEEDED'])
+    if data_source_id != 'scheduled_query':
+      self._runs[name] = (run.get('seconds', _DEFAULT_SECONDS),
+                          _STATES[run.get('state', 'SUCCEEDED')])
+
+  def common_location_path(self, project_id: str, location: str) -> str:
+    return f'projects/{project_id}/locations/{location}'
+
+  def list_transfer_configs(self, request: Dict[str, str]) -> List[Any]:
+    return [config for name, config in self._configs.items()
+            if name.startswith(request['parent'] + '/')]
+
+  def list_transfer_runs(self, request: Any) -> Any:
+    """Returns the run of the run date in its state at the fake time."""
+    transfer_runs = []
+    if request.parent in self._runs:
+      seconds, state = self._runs[request.parent]
+      finished = self._clock.time() >= seconds
+      end_time = self._run_time + datetime.timedelta(seconds=seconds)
+      transfer_runs.append(types.SimpleNamespace(
+          name=f'{request.parent}/runs/{self._run_time:%Y%m%d}',
+          run_time=self._run_time, start_time=self._run_time,
+          end_time=end_time if finished else None,
+          state=state if finished else _STATES['RUNNING'],
+          error_status=None))
+    return types.SimpleNamespace(transfer_runs=transfer_runs)
+
+  def start_manual_transfer_runs(self, request: Any) -> Any:
+    """Records the started scheduled query run, finished as in the scenario."""
+    run = self._scenario.get(self._configs[request.parent].display_name, {})
+    self.started_runs.append((request.parent, self._clock.time()))
+    self._runs[request.parent] = (self._clock.time() + run.get('seconds', 0),
+                                  _STATES[run.get('state', 'SUCCEEDED')])
+    return types.SimpleNamespace(runs=[types.SimpleNamespace(
+        name=f'{request.parent}/runs/manual', run_time=self._run_time,
+        state=_STATES['PENDING'])])
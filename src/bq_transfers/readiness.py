@@ -0,0 +1,458 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Starts the low volume skus query of every pair once its transfers landed.
+
+Instead of running at the fixed zombies_schedule, the scheduled query of an
+account pair is started as soon as the Merchant Center and Google Ads transfer
+runs of the run date both succeeded. The runs are polled with the backoff of
+CloudDataTransferUtils.wait_for_transfers_completion, so a pair whose
+transfers landed early does not wait for the slowest account. The refreshes
+the query reads, the targeted_products and offer_daily_stats scheduled queries
+of zombies_materialize_targeted_products and zombies_incremental_aggregates,
+are started first and the query once they succeeded. A transfer or refresh
+that fails, or is still running when --max_wait_seconds elapse, triggers the
+fallback: the query is either skipped or started on the data already there.
+With zombies_input_fingerprints, a pair whose source partitions and thresholds
+did not change since its previous run is not scored again, the previous
+LowVolumeSkus table is copied to the run date instead.
+The scheduled queries and their refreshes are only run this way when
+zombies_readiness_gating is true, which needs a zombies_readiness_trigger
+running this script every day, e.g.:
+
+  python src/bq_transfers/readiness.py --config_file zombies_config.json
+  python src/bq_transfers/readiness.py --fake_scenario scenario.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import pytz
+
+import data_transfers
+import fake_transfers
+import zombies_config
+
+# The timing spans and the input fingerprints are shared with the feed
+# generation Cloud Function.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'cfs', 'low_volume_skus_feed_generation'))
+import input_fingerprint  # pylint: disable=g-import-not-at-top,wrong-import-position
+import spans  # pylint: disable=g-import-not-at-top,wrong-import-position
+
+FALLBACK_SKIP = 'skip'  # The pair is not scored for the run date.
+FALLBACK_START = 'start'  # The pair is scored on the data already transferred.
+# Outcomes of a pair.
+PAIR_STARTED = 'STARTED'
+PAIR_STARTED_FALLBACK = 'STARTED_FALLBACK'
+PAIR_ALREADY_RUN = 'ALREADY_RUN'
+PAIR_REUSED = 'REUSED'  # The result of the previous run was copied.
+PAIR_SKIPPED = 'SKIPPED'
+PAIR_FAILED = 'FAILED'  # The query could not be started.
+_DEFAULT_MAX_WAIT_SECONDS = 6 * 3600
+_MERCHANT_CENTER_ID = 'merchant_center'
+_GOOGLE_ADS_ID = 'google_ads'
+_SCHEDULED_QUERY_ID = 'scheduled_query'
+# Display name prefixes of the scheduled queries refreshing the tables read by
+# the low volume skus query of a pair.
+_REFRESH_NAMES = ('targeted_products', 'offer_daily_stats')
+_SUCCEEDED_STATE = 4
+# Scheduled query runs that need to be started again, failed or cancelled.
+_RETRIED_STATES = (5, 6)
+
+
+class PairTransfers(NamedTuple):
+  """The source transfers and the scheduled queries of an account pair."""
+  mc: str
+  gads: str
+  merchant_center: Optional[object]
+  google_ads: Optional[object]
+  query: Optional[object]
+  # Scheduled queries to run after the transfers and before the query.
+  refreshes: Tuple[object, ...] = ()
+
+  @property
+  def sources(self) -> List[object]:
+    return [config for config in (self.merchant_center, self.google_ads)
+            if config is not None]
+
+
+class PairResult(NamedTuple):
+  """How the scheduled query of a pair was handled."""
+  outcome: str
+  merchant_center: str
+  google_ads: str
+  seconds: float
+
+
+def get_pair_transfers(data_transfer: data_transfers.CloudDataTransferUtils,
+                       account_pairs: List[Tuple[str, str]],
+                       dataset_location: str) -> List[PairTransfers]:
+  """Finds the transfers and the scheduled queries of every account pair.
+
+  Args:
+    data_transfer: Client of the data transfer service.
+    account_pairs: List of (merchant id, Google Ads customer id) pairs.
+    dataset_location: BigQuery dataset location.
+  Returns:
+    The transfers of every pair, None for those that do not exist, and the
+    refreshes that exist.
+  """
+  pairs = []
+  for mc, gads in account_pairs:
+    refreshes = (data_transfer.find_transfer_config(
+        _SCHEDULED_QUERY_ID, dataset_location, name=f'{name}_{mc}_{gads}')
+                 for name in _REFRESH_NAMES)
+    pairs.append(PairTransfers(
+        mc, gads,
+        data_transfer.find_transfer_config(_MERCHANT_CENTER_ID,
+                                           dataset_location, account_id=mc),
+        data_transfer.find_transfer_config(_GOOGLE_ADS_ID, dataset_location,
+                                           account_id=gads),
+        data_transfer.find_transfer_config(
+            _SCHEDULED_QUERY_ID, dataset_location,
+            name=f'low_volume_skus_{mc}_{gads}'),
+        tuple(config for config in refreshes if config is not None)))
+  return pairs
+
+
+class RunReuser(object):
+  """Copies the previous result of the pairs whose inputs did not change."""
+
+  def __init__(self, client, store, variables: Dict[str, object]):
+    """Initialise new instance of RunReuser.
+    Args:
+      client: bigquery.Client reading the partitions and copying the tables.
+      store: Fingerprint store of input_fingerprint.get_fingerprint_store.
+      variables: Variables of the compiled zombies configuration.
+    """
+    self._client = client
+    self._store = store
+    self._variables = variables
+    self._thresholds = {name: variables.get(name)
+                        for name in input_fingerprint.THRESHOLD_VARIABLES}
+
+  def reuse(self, pair: PairTransfers, run_date: datetime.date) -> bool:
+    """Copies the previous LowVolumeSkus table of a pair if still valid.
+    Args:
+      pair: Transfers and scheduled query of the account pair.
+      run_date: Date of the scheduled query run.
+    Returns:
+      Whether the previous result was copied to the run date.
+    """
+    variables = self._variables
+    date = f'{run_date:%Y%m%d}'
+    fingerprint = input_fingerprint.get_fingerprint(
+        self._client, variables['gcp_merchant_and_gads_dataset_project'],
+        variables['merchant_dataset_name'], variables['gads_dataset_name'],
+        pair.mc, pair.gads, date, self._thresholds,
+        pair.query.params.get('query'))
+    reused = input_fingerprint.find_reusable_run(
+        self._store, self._client, pair.mc, pair.gads, date, fingerprint)
+    if not reused:
+      return False
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    table = (f"{variables['gcp_project']}.{variables['zombies_dataset_name']}"
+             f'.LowVolumeSkus_{pair.mc}_{pair.gads}')
+    previous_date = reused['run_date'].replace('-', '')
+    # A table copy only duplicates the storage metadata, no slot is used.
+    self._client.copy_table(
+        f'{table}_{previous_date}', f'{table}_{date}',
+        job_config=bigquery.CopyJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    ).result()
+    self._store.record(input_fingerprint.get_record(
+        pair.mc, pair.gads, date, fingerprint, reused=reused))
+    logging.info('Inputs of %s %s unchanged since %s, copied %s_%s.', pair.mc,
+                 pair.gads, reused['source_run_date'], table, previous_date)
+    return True
+
+
+class ReadinessScheduler(object):
+  """Starts the scheduled query of every pair when its transfers are ready."""
+
+  def __init__(self, data_transfer: data_transfers.CloudDataTransferUtils,
+               fallback: str = FALLBACK_SKIP,
+               reuser: Optional[RunReuser] = None):
+    """Initialise new instance of ReadinessScheduler.
+    Args:
+      data_transfer: Client of the data transfer service.
+      fallback: FALLBACK_SKIP or FALLBACK_START, what to do with a pair whose
+        transfers or refreshes failed, timed out or do not exist.
+      reuser: Reuses the previous result of the ready pairs whose inputs did
+        not change, every ready pair is scored when None.
+    """
+    if fallback not in (FALLBACK_SKIP, FALLBACK_START):
+      raise ValueError(f'Unknown fallback {fallback}')
+    self._data_transfer = data_transfer
+    self._fallback = fallback
+    self._reuser = reuser
+
+  def run(self, pairs: List[PairTransfers], run_date: datetime.date,
+          max_wait_seconds: float = _DEFAULT_MAX_WAIT_SECONDS,
+          sleep: Callable[[float], None] = time.sleep,
+          clock: Callable[[], float] = time.monotonic
+          ) -> Dict[Tuple[str, str], PairResult]:
+    """Waits for the transfers of a run date and starts the ready pairs.
+    Args:
+      pairs: Transfers of the account pairs, see get_pair_transfers.
+      run_date: Date of the transfer runs and of the scheduled queries.
+      max_wait_seconds: Time after which the pending transfers time out.
+      sleep: Function used to wait between polls.
+      clock: Monotonic clock in seconds.
+    Returns:
+      Dictionary keyed by account pair with the outcome of its query.
+    """
+    start = clock()
+    outcomes = {}
+    waiting = {}
+    refreshing = {}
+    results = {}
+
+    def _settle(pair, outcome, source_outcomes):
+      results[(pair.mc, pair.gads)] = PairResult(outcome, *source_outcomes,
+                                                 clock() - start)
+
+    def _on_sources(pair):
+      source_outcomes = [
+          outcomes[config.name] if config is not None
+          else data_transfers.TRANSFER_MISSING
+          for config in (pair.merchant_center, pair.google_ads)]
+      try:
+        outcome = self._check(pair, run_date, source_outcomes)
+        if outcome is None:
+          started = self._start_refreshes(pair, run_date, outcomes)
+          if started:
+            refreshing[(pair.mc, pair.gads)] = source_outcomes
+            for config in started:
+              waiting.setdefault(config.name, []).append(pair)
+            return started
+          outcome = self._start(pair, run_date, source_outcomes, outcomes)
+      except Exception as error:  # pylint: disable=broad-except
+        logging.error('Scheduled query of %s %s not started: %s', pair.mc,
+                      pair.gads, error)
+        outcome = PAIR_FAILED
+      _settle(pair, outcome, source_outcomes)
+      return []
+
+    def _on_refreshes(pair):
+      source_outcomes = refreshing.pop((pair.mc, pair.gads))
+      try:
+        outcome = self._start(pair, run_date, source_outcomes, outcomes)
+      except Exception as error:  # pylint: disable=broad-except
+        logging.error('Scheduled query of %s %s not started: %s', pair.mc,
+                      pair.gads, error)
+        outcome = PAIR_FAILED
+      _settle(pair, outcome, source_outcomes)
+
+    def _on_outcome(transfer_config_name, outcome):
+      outcomes[transfer_config_name] = outcome
+      started = []
+      for pair in waiting.pop(transfer_config_name, []):
+        if (pair.mc, pair.gads) in refreshing:
+          if all(config.name in outcomes for config in pair.refreshes):
+            _on_refreshes(pair)
+        elif all(config.name in outcomes for config in pair.sources):
+          started.extend(_on_sources(pair))
+      return started
+
+    configs = {}
+    for pair in pairs:
+      if not pair.sources:
+        for config in _on_sources(pair):
+          configs[config.name] = config
+      for config in pair.sources:
+        configs[config.name] = config
+        waiting.setdefault(config.name, []).append(pair)
+    self._data_transfer.wait_for_transfers_completion(
+        configs.values(), max_wait_seconds, sleep, clock, run_date=run_date,
+        on_outcome=_on_outcome)
+    return results
+
+  def _check(self, pair: PairTransfers, run_date: datetime.date,
+             source_outcomes: List[str]) -> Optional[str]:
+    """Checks whether the query of a pair whose transfers finished should run.
+    Args:
+      pair: Transfers of the account pair.
+      run_date: Date of the scheduled query run.
+      source_outcomes: Outcomes of the Merchant Center and Google Ads transfers.
+    Returns:
+      The outcome of a pair whose query is not run, None otherwise.
+    """
+    ready = all(outcome == data_transfers.TRANSFER_SUCCEEDED
+                for outcome in source_outcomes)
+    if pair.query is None:
+      logging.error('No low_volume_skus_%s_%s scheduled query.', pair.mc,
+                    pair.gads)
+      return PAIR_SKIPPED
+    if not ready:
+      logging.error('Transfers of %s %s not ready for %s: %s, fallback %s.',
+                    pair.mc, pair.gads, run_date, source_outcomes,
+                    self._fallback)
+      if self._fallback == FALLBACK_SKIP:
+        return PAIR_SKIPPED
+    previous_run = self._data_transfer.get_transfer_run(pair.query.name,
+                                                        run_date)
+    if previous_run and previous_run.state not in _RETRIED_STATES:
+      logging.info('%s already ran for %s.', pair.query.name, run_date)
+      return PAIR_ALREADY_RUN
+    if ready and self._reuser and self._reuser.reuse(pair, run_date):
+      return PAIR_REUSED
+    return None
+
+  def _start_refreshes(self, pair: PairTransfers, run_date: datetime.date,
+                       outcomes: Dict[str, str]) -> List[object]:
+    """Starts the refreshes of a pair that did not succeed for the run date.
+    Args:
+      pair: Transfers of the account pair.
+      run_date: Date of the refresh runs.
+      outcomes: Outcomes by transfer config name, the refreshes that already
+        succeeded are added to it.
+    Returns:
+      The refreshes to wait for, started or still running.
+    """
+    started = []
+    for config in pair.refreshes:
+      previous_run = self._data_transfer.get_transfer_run(config.name,
+                                                          run_date)
+      if previous_run and previous_run.state == _SUCCEEDED_STATE:
+        outcomes[config.name] = data_transfers.TRANSFER_SUCCEEDED
+        continue
+      if not previous_run or previous_run.state in _RETRIED_STATES:
+        self._data_transfer.start_manual_run(config.name, run_date,
+                                             mc_id=pair.mc, gads_id=pair.gads)
+      started.append(config)
+    return started
+
+  def _start(self, pair: PairTransfers, run_date: datetime.date,
+             source_outcomes: List[str], outcomes: Dict[str, str]) -> str:
+    """Starts the scheduled query of a pair whose refreshes finished.
+    Args:
+      pair: Transfers of the account pair.
+      run_date: Date of the scheduled query run.
+      source_outcomes: Outcomes of the Merchant Center and Google Ads transfers.
+      outcomes: Outcomes by transfer config name, with those of the refreshes.
+    Returns:
+      The outcome of the pair.
+    """
+    refresh_outcomes = [outcomes[config.name] for config in pair.refreshes]
+    ready = all(outcome == data_transfers.TRANSFER_SUCCEEDED
+                for outcome in source_outcomes + refresh_outcomes)
+    if not all(outcome == data_transfers.TRANSFER_SUCCEEDED
+               for outcome in refresh_outcomes):
+      logging.error('Refreshes of %s %s not ready for %s: %s, fallback %s.',
+                    pair.mc, pair.gads, run_date, refresh_outcomes,
+                    self._fallback)
+      if self._fallback == FALLBACK_SKIP:
+        return PAIR_SKIPPED
+    self._data_transfer.start_manual_run(pair.query.name, run_date,
+                                         mc_id=pair.mc, gads_id=pair.gads)
+    return PAIR_STARTED if ready else PAIR_STARTED_FALLBACK
+
+
+def _print_results(results: Dict[Tuple[str, str], PairResult]) -> bool:
+  """Prints the outcome of every pair, returns whether all were started."""
+  all_started = True
+  print('Merchant\tGAds\tMerchant transfer\tGAds transfer\tQuery\tSeconds')
+  for (mc, gads), result in sorted(results.items()):
+    all_started &= result.outcome in (PAIR_STARTED, PAIR_ALREADY_RUN,
+                                      PAIR_REUSED)
+    print(f'{mc}\t{gads}\t{result.merchant_center}\t{result.google_ads}\t'
+          f'{result.outcome}\t{result.seconds:.0f}')
+  return all_started
+
+
+def _get_args_parser():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--config_file', default=zombies_config.CONFIG_FILE,
+                      help='JSON artifact compiled from variables.tf by '
+                      'zombies_config.py.')
+  parser.add_argument('--run_date', default=None,
+                      help='Run date as YYYYMMDD, today in UTC by default.')
+  parser.add_argument('--max_wait_seconds', type=float,
+                      default=_DEFAULT_MAX_WAIT_SECONDS,
+                      help='Time after which the pending transfers fall back.')
+  parser.add_argument('--fallback', choices=(FALLBACK_SKIP, FALLBACK_START),
+                      default=FALLBACK_SKIP,
+                      help='What to do with a pair whose transfers failed or '
+                      'timed out.')
+  parser.add_argument('--fake_scenario', default=None,
+                      help='JSON scenario of fake_transfers.py, runs against '
+                      'an in-memory data transfer service and clock.')
+  parser.add_argument('--fingerprints_jsonl', default=None,
+                      help='JSON lines file of input fingerprints, replaces '
+                      'the input_fingerprints table of '
+                      'zombies_input_fingerprints.')
+  parser.add_argument('--spans_exporter', default=spans.JSONL_EXPORTER,
+                      help='Exporter of the timing spans: jsonl, otel or none.')
+  parser.add_argument('--spans_file', default='zombies_spans.jsonl',
+                      help='JSON lines file the jsonl exporter appends the '
+                      'spans to.')
+  return parser
+
+
+def main(argv=None):
+  logging.basicConfig(level=logging.INFO)
+  args = _get_args_parser().parse_args(argv)
+  config = zombies_config.load_config(config_file=args.config_file)
+  variables = config['variables']
+  run_date = (datetime.datetime.strptime(args.run_date, '%Y%m%d').date()
+              if args.run_date else datetime.datetime.now(pytz.utc).date())
+  account_pairs = [(account.mc, account.gads)
+                   for account in zombies_config.get_accounts(config)]
+  location = variables['zombies_data_location'].lower()
+  tracer = spans.get_tracer(args.spans_exporter, args.spans_file,
+                            stage='readiness')
+  sleep, clock = time.sleep, time.monotonic
+  client = None
+  if args.fake_scenario:
+    with open(args.fake_scenario) as f:
+      scenario = json.load(f)
+    fake_clock = fake_transfers.FakeClock()
+    refreshes = [name for name, enabled in (
+        ('targeted_products',
+         variables.get('zombies_materialize_targeted_products')),
+        ('offer_daily_stats', variables.get('zombies_incremental_aggregates')))
+                 if enabled]
+    client = fake_transfers.FakeDataTransferClient(
+        variables['gcp_project'], location, account_pairs, run_date,
+        scenario, fake_clock, refreshes)
+    sleep, clock = fake_clock.sleep, fake_clock.time
+  data_transfer = data_transfers.CloudDataTransferUtils(
+      variables['gcp_project'], client=client, tracer=tracer)
+  pairs = get_pair_transfers(data_transfer, account_pairs, location)
+  reuser = None
+  if variables.get('zombies_input_fingerprints') or args.fingerprints_jsonl:
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    bigquery_client = bigquery.Client(project=variables['gcp_project'])
+    reuser = RunReuser(bigquery_client, input_fingerprint.get_fingerprint_store(
+        bigquery_client,
+        f"{variables['gcp_project']}.{variables['zombies_dataset_name']}"
+        '.input_fingerprints', args.fingerprints_jsonl), variables)
+  results = ReadinessScheduler(data_transfer, args.fallback, reuser).run(
+      pairs, run_date, args.max_wait_seconds, sleep, clock)
+  if not _print_results(results):
+    raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
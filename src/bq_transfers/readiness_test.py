@@ -0,0 +1,113 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Tests of ReadinessScheduler against the in-memory data transfer service."""
+
+import datetime
+from typing import Any, Dict, Sequence
+
+import pytest
+
+pytest.importorskip('pytz')
+pytest.importorskip('google.cloud.bigquery_datatransfer_v1')
+
+import data_transfers  # pylint: disable=g-import-not-at-top,wrong-import-position
+import fake_transfers  # pylint: disable=g-import-not-at-top,wrong-import-position
+import readiness  # pylint: disable=g-import-not-at-top,wrong-import-position
+
+_PROJECT = 'zombies-project'
+_LOCATION = 'eu'
+_PAIRS = [('1234', '5678'), ('4321', '8765')]
+_RUN_DATE = datetime.date(2024, 1, 15)
+
+
+def _run(scenario: Dict[str, Dict[str, Any]],
+         fallback: str = readiness.FALLBACK_SKIP,
+         max_wait_seconds: float = 3600,
+         refreshes: Sequence[str] = ()):
+  """Runs the scheduler on a scenario, returns its results and started runs."""
+  clock = fake_transfers.FakeClock()
+  client = fake_transfers.FakeDataTransferClient(
+      _PROJECT, _LOCATION, _PAIRS, _RUN_DATE, scenario, clock, refreshes)
+  data_transfer = data_transfers.CloudDataTransferUtils(_PROJECT,
+                                                        client=client)
+  pairs = readiness.get_pair_transfers(data_transfer, _PAIRS, _LOCATION)
+  results = readiness.ReadinessScheduler(data_transfer, fallback).run(
+      pairs, _RUN_DATE, max_wait_seconds, clock.sleep, clock.time)
+  started = {name.rsplit('/', 1)[1]: seconds
+             for name, seconds in client.started_runs}
+  return results, started
+
+
+def test_ready_pair_does_not_wait_for_the_slowest_one():
+  results, started = _run({'Merchant_Transfer_4321': {'seconds': 1800}})
+
+  assert results[('1234', '5678')].outcome == readiness.PAIR_STARTED
+  assert results[('4321', '8765')].outcome == readiness.PAIR_STARTED
+  assert started['low_volume_skus_1234_5678'] < 600
+  assert started['low_volume_skus_4321_8765'] >= 1800
+
+
+def test_pending_transfer_times_out_and_is_skipped():
+  results, started = _run({'GAds_Transfer_8765': {'state': 'PENDING'}})
+
+  result = results[('4321', '8765')]
+  assert result.outcome == readiness.PAIR_SKIPPED
+  assert result.google_ads == data_transfers.TRANSFER_TIMED_OUT
+  assert result.seconds >= 3600
+  assert 'low_volume_skus_4321_8765' not in started
+  assert results[('1234', '5678')].outcome == readiness.PAIR_STARTED
+
+
+@pytest.mark.parametrize('scenario', [
+    {'GAds_Transfer_8765': {'state': 'PENDING'}},
+    {'GAds_Transfer_8765': {'seconds': 900, 'state': 'FAILED'}},
+    {'GAds_Transfer_8765': {'state': 'MISSING'}},
+])
+def test_start_fallback_scores_the_data_already_there(scenario):
+  results, started = _run(scenario, readiness.FALLBACK_START)
+
+  assert results[('4321', '8765')].outcome == (
+      readiness.PAIR_STARTED_FALLBACK)
+  assert 'low_volume_skus_4321_8765' in started
+
+
+def test_query_starts_once_its_refreshes_succeeded():
+  results, started = _run(
+      {'offer_daily_stats_1234_5678': {'seconds': 600}},
+      refreshes=('targeted_products', 'offer_daily_stats'))
+
+  assert results[('1234', '5678')].outcome == readiness.PAIR_STARTED
+  assert (started['offer_daily_stats_1234_5678'] + 600 <=
+          started['low_volume_skus_1234_5678'])
+  assert (started['targeted_products_1234_5678'] <=
+          started['low_volume_skus_1234_5678'])
+
+
+def test_failed_refresh_falls_back():
+  scenario = {'targeted_products_1234_5678': {'seconds': 60,
+                                              'state': 'FAILED'}}
+
+  skipped, skipped_runs = _run(scenario, refreshes=('targeted_products',))
+  started, started_runs = _run(scenario, readiness.FALLBACK_START,
+                               refreshes=('targeted_products',))
+
+  assert skipped[('1234', '5678')].outcome == readiness.PAIR_SKIPPED
+  assert 'low_volume_skus_1234_5678' not in skipped_runs
+  assert started[('1234', '5678')].outcome == (
+      readiness.PAIR_STARTED_FALLBACK)
+  assert 'low_volume_skus_1234_5678' in started_runs
+  assert skipped[('4321', '8765')].outcome == readiness.PAIR_STARTED
@@ -0,0 +1,414 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Compiles the defaults of variables.tf into a validated JSON artifact.
+
+The variable blocks are parsed once, the account pairs of accounts_table are
+validated and the result is written as compact JSON next to the feed generation
+Cloud Function, which loads it at start up. The artifact records the digest of
+variables.tf and is only rebuilt when the file changes. It also records the
+digest of the accounts_table it holds, computed like the Terraform
+sha256(jsonencode(var.accounts_table)) given to the Cloud Function, so an
+accounts_table overridden at deploy time is not read from the artifact, e.g.:
+
+  python src/bq_transfers/zombies_config.py build
+  eval "$(python src/bq_transfers/zombies_config.py shell)"
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shlex
+import sys
+from typing import Any, Dict, List, NamedTuple, Optional
+
+_ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+VARIABLES_FILE = os.path.join(_ROOT_DIR, 'variables.tf')
+CONFIG_FILE = os.path.join(_ROOT_DIR, 'src', 'cfs',
+                           'low_volume_skus_feed_generation',
+                           'zombies_config.json')
+_ARTIFACT_VERSION = 2
+
+_TOKEN_RE = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*|//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\\n]|\\.)*")
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)
+  | (?P<ident>[A-Za-z_][A-Za-z0-9_-]*)
+  | (?P<punct>[{}\[\]()=:,])
+''', re.VERBOSE | re.DOTALL)
+_KEYWORDS = {'true': True, 'false': False, 'null': None}
+_ACCOUNT_FIELDS = ('mc', 'gads', 'gcs_url')
+
+# Variables exported by the shell command, with their shell names.
+_SHELL_VARIABLES = (
+    ('GCP_PROJECT', 'gcp_project'),
+    ('MERCHANT_DATASET_NAME', 'merchant_dataset_name'),
+    ('GADS_DATASET_NAME', 'gads_dataset_name'),
+    ('ZOMBIES_DATA_LOCATION', 'zombies_data_location'),
+    ('MERCHANT_SCHEDULE', 'merchant_schedule'),
+    ('GADS_SCHEDULE', 'gads_schedule'),
+    ('CREATE_MERCHANT_AND_GADS_TRANSFERS', 'create_merchant_and_gads_transfers'),
+    ('ZOMBIES_READINESS_GATING', 'zombies_readiness_gating'),
+    ('ZOMBIES_READINESS_TRIGGER', 'zombies_readiness_trigger'),
+)
+
+
+class Error(Exception):
+  """Base error for this module."""
+
+
+class ConfigError(Error):
+  """An exception raised when variables.tf is malformed or invalid."""
+
+
+class Account(NamedTuple):
+  """A merchant and Google Ads account pair and the bucket of its feed."""
+  mc: str
+  gads: str
+  gcs_url: str
+
+
+class _Parser(object):
+  """Parses the variable blocks of a Terraform file.
+
+  Only the subset of HCL used by variables.tf is supported: blocks, attributes,
+  literals, lists, maps and objects. Type constraints and other function calls
+  are skipped.
+  """
+
+  def __init__(self, text: str):
+    self._tokens = []
+    position = 0
+    line = 1
+    while position < len(text):
+      match = _TOKEN_RE.match(text, position)
+      if not match:
+        raise ConfigError(f'Unexpected character {text[position]!r} at line '
+                          f'{line}')
+      if match.lastgroup == 'space':
+        line += match.group().count('\n')
+      else:
+        self._tokens.append((match.lastgroup, match.group(), line))
+      position = match.end()
+    self._index = 0
+    self.duplicates = []  # (path, key) of the keys repeated in a map.
+
+  def _peek(self, offset: int = 0):
+    index = self._index + offset
+    return self._tokens[index] if index < len(self._tokens) else (None, None, 0)
+
+  def _next(self, expected: Optional[str] = None):
+    token = self._peek()
+    if token[0] is None:
+      raise ConfigError('Unexpected end of file')
+    if expected is not None and token[1] != expected:
+      raise ConfigError(f'Expected {expected!r} at line {token[2]}, '
+                        f'got {token[1]!r}')
+    self._index += 1
+    return token
+
+  def parse_variables(self) -> Dict[str, Any]:
+    """Returns the default of every variable block declaring one."""
+    variables = {}
+    while self._peek()[0] is not None:
+      kind, value, line = self._next()
+      if kind != 'ident':
+        raise ConfigError(f'Expected a block at line {line}, got {value!r}')
+      labels = []
+      while self._peek()[0] == 'string':
+        labels.append(json.loads(self._next()[1]))
+      self._next('{')
+      body = self._parse_body(labels[0] if labels else value)
+      if value == 'variable' and labels and 'default' in body:
+        variables[labels[0]] = body['default']
+    return variables
+
+  def _parse_body(self, path: str) -> Dict[str, Any]:
+    attributes = {}
+    while self._peek()[1] != '}':
+      kind, name, line = self._next()
+      if kind != 'ident':
+        raise ConfigError(f'Expected an attribute at line {line}, got {name!r}')
+      if self._peek()[1] == '=':
+        self._next()
+        attributes[name] = self._parse_value(f'{path}.{name}')
+      else:
+        # Nested block, e.g. the backend of the terraform block.
+        while self._peek()[0] == 'string':
+          self._next()
+        self._next('{')
+        self._parse_body(f'{path}.{name}')
+    self._next('}')
+    return attributes
+
+  def _parse_value(self, path: str) -> Any:
+    kind, value, line = self._next()
+    if kind == 'string':
+      if '${' in value or '%{' in value:
+        raise ConfigError(f'Templates are not supported at line {line}')
+      return json.loads(value)
+    if kind == 'number':
+      return json.loads(value)
+    if kind == 'ident':
+      if value in _KEYWORDS:
+        return _KEYWORDS[value]
+      if self._peek()[1] == '(':
+        self._skip_group()
+        return None
+      # Bare type keywords, e.g. string in a type constraint.
+      return None
+    if value == '[':
+      items = []
+      while self._peek()[1] != ']':
+        items.append(self._parse_value(f'{path}[{len(items)}]'))
+        if self._peek()[1] == ',':
+          self._next()
+      self._next(']')
+      return items
+    if value == '{':
+      items = {}
+      while self._peek()[1] != '}':
+        key_kind, key, key_line = self._next()
+        if key_kind == 'string':
+          key = json.loads(key)
+        elif key_kind not in ('ident', 'number'):
+          raise ConfigError(f'Expected a key at line {key_line}, got {key!r}')
+        separator = self._next()
+        if separator[1] not in ('=', ':'):
+          raise ConfigError(f'Expected = or : at line {separator[2]}')
+        if key in items:
+          self.duplicates.append((path, key))
+        items[key] = self._parse_value(f'{path}.{key}')
+        if self._peek()[1] == ',':
+          self._next()
+      self._next('}')
+      return items
+    raise ConfigError(f'Unexpected {value!r} at line {line}')
+
+  def _skip_group(self) -> None:
+    depth = 0
+    while True:
+      value = self._next()[1]
+      if value in ('(', '[', '{'):
+        depth += 1
+      elif value in (')', ']', '}'):
+        depth -= 1
+        if not depth:
+          return
+
+
+def parse_variables(text: str) -> Dict[str, Any]:
+  """Parses the defaults of the variable blocks of a Terraform file.
+
+  Args:
+    text: Content of the Terraform file.
+
+  Returns:
+    A dict from variable name to default value.
+
+  Raises:
+    ConfigError: If the file can not be parsed or a map repeats a key.
+  """
+  parser = _Parser(text)
+  variables = parser.parse_variables()
+  if parser.duplicates:
+    raise ConfigError('Duplicate keys: ' + ', '.join(
+        f'{path}.{key}' for path, key in parser.duplicates))
+  return variables
+
+
+def validate_accounts(accounts_table: Dict[str, Any]) -> List[Account]:
+  """Validates the account pairs of the accounts_table variable.
+
+  The ids are used in the names of the transfer tables, split on underscores
+  by the Cloud Function, so they must only hold digits. The targeting views
+  are created once per merchant account, so a merchant account is only
+  configured once.
+
+  Args:
+    accounts_table: Default of the accounts_table variable.
+
+  Returns:
+    The list of Account, in the order of accounts_table.
+
+  Raises:
+    ConfigError: Listing every invalid account line.
+  """
+  problems = []
+  accounts = []
+  keys = {}
+  for key, line in (accounts_table or {}).items():
+    if not isinstance(line, dict):
+      problems.append(f'{key}: expected an object with {_ACCOUNT_FIELDS}')
+      continue
+    values = {}
+    for field in _ACCOUNT_FIELDS:
+      value = line.get(field)
+      if value is None or not str(value).strip():
+        problems.append(f'{key}: missing {field}')
+        continue
+      values[field] = str(value).strip()
+    for field in ('mc', 'gads'):
+      value = values.get(field)
+      if value is None or value.isdigit():
+        continue
+      if value.replace('-', '').isdigit():
+        problems.append(f'{key}: {field} {value!r} has dashes, use the id '
+                        'without them')
+      else:
+        problems.append(f'{key}: {field} {value!r} is not a numeric id')
+      values.pop(field)
+    gcs_url = values.get('gcs_url')
+    if gcs_url is not None and not gcs_url.startswith('gs://'):
+      problems.append(f'{key}: gcs_url {gcs_url!r} does not start with gs://')
+      values.pop('gcs_url')
+    if len(values) < len(_ACCOUNT_FIELDS):
+      continue
+    if values['mc'] in keys:
+      problems.append(f'{key}: mc {values["mc"]} is already configured by '
+                      f'{keys[values["mc"]]}')
+      continue
+    keys[values['mc']] = key
+    accounts.append(Account(**values))
+  if problems:
+    raise ConfigError('Invalid accounts_table:\n  ' + '\n  '.join(problems))
+  return accounts
+
+
+def get_accounts_digest(accounts_table: Dict[str, Any]) -> str:
+  """Returns the sha256 of the Terraform jsonencode of an accounts_table.
+
+  Terraform sorts the keys, does not escape the non ASCII characters and
+  escapes <, >, & and the line and paragraph separators.
+
+  Args:
+    accounts_table: Value of the accounts_table variable.
+
+  Returns:
+    The hex digest matching sha256(jsonencode(var.accounts_table)).
+  """
+  encoded = json.dumps(accounts_table or {}, sort_keys=True,
+                       separators=(',', ':'), ensure_ascii=False)
+  for character in '<>&\u2028\u2029':
+    encoded = encoded.replace(character, f'\\u{ord(character):04x}')
+  return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def build_config(variables_file: str = VARIABLES_FILE) -> Dict[str, Any]:
+  """Parses and validates variables.tf into the artifact content."""
+  with open(variables_file, 'rb') as f:
+    content = f.read()
+  variables = parse_variables(content.decode('utf-8'))
+  accounts_table = variables.pop('accounts_table', {})
+  accounts = validate_accounts(accounts_table)
+  return {
+      'version': _ARTIFACT_VERSION,
+      'source_sha256': hashlib.sha256(content).hexdigest(),
+      'accounts_sha256': get_accounts_digest(accounts_table),
+      'variables': variables,
+      'accounts': [list(account) for account in accounts],
+  }
+
+
+def load_config(variables_file: str = VARIABLES_FILE,
+                config_file: str = CONFIG_FILE) -> Dict[str, Any]:
+  """Returns the compiled configuration, rebuilding a stale artifact.
+
+  Args:
+    variables_file: Path of variables.tf.
+    config_file: Path of the JSON artifact.
+
+  Returns:
+    A dict with the variable defaults under variables and the account pairs as
+    [mc, gads, gcs_url] lists under accounts.
+  """
+  with open(variables_file, 'rb') as f:
+    digest = hashlib.sha256(f.read()).hexdigest()
+  try:
+    with open(config_file) as f:
+      config = json.load(f)
+    if (config.get('version') == _ARTIFACT_VERSION and
+        config.get('source_sha256') == digest):
+      return config
+  except (FileNotFoundError, ValueError):
+    pass
+  config = build_config(variables_file)
+  with open(config_file, 'w') as f:
+    json.dump(config, f, separators=(',', ':'), sort_keys=True)
+  return config
+
+
+def get_accounts(config: Dict[str, Any]) -> List[Account]:
+  """Returns the account pairs of a compiled configuration."""
+  return [Account(*line) for line in config['accounts']]
+
+
+def get_service_account(config: Dict[str, Any]) -> str:
+  """Returns the email of the service account running the transfers."""
+  variables = config['variables']
+  return (f"{variables['zombies_sa']}@{variables['gcp_project']}"
+          '.iam.gserviceaccount.com')
+
+
+def _to_shell(value: Any) -> str:
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  return shlex.quote(str(value))
+
+
+def get_shell_assignments(config: Dict[str, Any], config_file: str) -> str:
+  """Renders the variables used by the shell scripts as bash assignments."""
+  variables = config['variables']
+  lines = [f'{name}={_to_shell(variables.get(variable, ""))}'
+           for name, variable in _SHELL_VARIABLES]
+  lines.append(f'SERVICE_ACCOUNT={_to_shell(get_service_account(config))}')
+  lines.append(f'ZOMBIES_CONFIG_FILE={_to_shell(config_file)}')
+  lines.append('ACCOUNTS=(' + ' '.join(
+      _to_shell(f'{account.mc},{account.gads}')
+      for account in get_accounts(config)) + ')')
+  return '\n'.join(lines)
+
+
+def _get_args_parser():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('command', nargs='?', choices=('build', 'shell'),
+                      default='build')
+  parser.add_argument('--variables_file', default=VARIABLES_FILE,
+                      help='Path of variables.tf.')
+  parser.add_argument('--config_file', default=CONFIG_FILE,
+                      help='Path of the JSON artifact.')
+  return parser
+
+
+def main(argv=None):
+  args = _get_args_parser().parse_args(argv)
+  try:
+    config = load_config(args.variables_file, args.config_file)
+  except ConfigError as e:
+    print(f'{args.variables_file}: {e}', file=sys.stderr)
+    raise SystemExit(1)
+  if args.command == 'shell':
+    print(get_shell_assignments(config, os.path.abspath(args.config_file)))
+    return
+  print(f'{len(config["accounts"])} account pairs and '
+        f'{len(config["variables"])} variables written to {args.config_file}',
+        file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
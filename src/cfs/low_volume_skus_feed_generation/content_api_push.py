@@ -0,0 +1,304 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Pushes the low volume sku labels to Merchant Center with the Content API.
+
+The label updates are grouped in numbered batches sent as products.custombatch
+requests by a bounded pool of threads sharing one HTTP session. Throttled
+requests and entries are retried with jittered exponential backoff, and every
+batch whose entries all succeeded is recorded in a progress store so an
+interrupted push skips the batches already sent when it resumes. A batch with
+entries rejected for good is left out of the store and sent again by the next
+push of the run.
+"""
+
+import collections
+import concurrent.futures
+import itertools
+import json
+import logging
+import random
+import time
+import requests
+from requests import adapters
+
+CONTENT_API_ENDPOINT = 'https://shoppingcontent.googleapis.com/content/v2.1'
+CONTENT_API_SCOPE = 'https://www.googleapis.com/auth/content'
+
+_RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+_RETRYABLE_REASONS = ('quotaExceeded', 'rateLimitExceeded', 'backendError',
+                      'internalError')
+_INITIAL_SLEEP_SECONDS = 1
+_MAX_SLEEP_SECONDS = 32
+
+LabelUpdate = collections.namedtuple(
+    'LabelUpdate', ['merchant_id', 'product_id', 'label'])
+
+PushStats = collections.namedtuple(
+    'PushStats', ['batches', 'skipped', 'updates', 'failed', 'requests',
+                  'complete'])
+
+class PushInterruptedError(RuntimeError):
+  """A push stopped by the time budget, resumed on the next delivery."""
+
+def is_transient_error(error):
+  """Checks whether a failed push may succeed when the event is delivered again.
+
+  Args:
+    error: Exception raised by the push
+
+  Returns:
+    True for an interrupted push, a network error or a throttled or failing
+    Content API, False for the errors a retry cannot fix
+  """
+  if isinstance(error, (PushInterruptedError, requests.ConnectionError,
+                        requests.Timeout)):
+    return True
+  if isinstance(error, requests.HTTPError):
+    return (error.response is not None and
+            error.response.status_code in _RETRYABLE_STATUSES)
+  return False
+
+def get_session(concurrency, credentials=None):
+  """Returns an HTTP session pooling a connection per worker.
+
+  Args:
+    concurrency: int representing the number of concurrent requests
+    credentials: google.auth credentials authorizing the requests, None for
+    an anonymous session
+
+  Returns:
+    A requests.Session
+  """
+  if credentials is None:
+    session = requests.Session()
+  else:
+    from google.auth.transport import requests as auth_requests  # pylint: disable=g-import-not-at-top
+    session = auth_requests.AuthorizedSession(credentials)
+  adapter = adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+def get_batches(updates, batch_size):
+  """Groups the label updates in numbered batches.
+
+  The updates must come in a stable order so a resumed push numbers the
+  batches the same way.
+
+  Args:
+    updates: iterable of LabelUpdate
+    batch_size: int representing the number of updates per batch
+
+  Yields:
+    (batch index, list of LabelUpdate) tuples
+  """
+  updates = iter(updates)
+  for index in itertools.count():
+    batch = list(itertools.islice(updates, batch_size))
+    if not batch:
+      return
+    yield index, batch
+
+class ContentApiPusher(object):
+  """Sends batches of custom label updates to products.custombatch."""
+
+  def __init__(self, session, label_index, feed_id=None,
+               endpoint=CONTENT_API_ENDPOINT, max_attempts=6,
+               sleep=time.sleep):
+    self._session = session
+    self._url = f'{endpoint.rstrip("/")}/products/batch'
+    self._field = f'customLabel{label_index}'
+    self._feed_id = feed_id
+    self._max_attempts = max_attempts
+    self._sleep = sleep
+
+  def _get_entry(self, batch_id, update):
+    entry = {
+        'batchId': batch_id,
+        'merchantId': update.merchant_id,
+        'method': 'update',
+        'productId': update.product_id,
+        'updateMask': self._field,
+        'product': {self._field: update.label},
+    }
+    if self._feed_id:
+      entry['feedId'] = self._feed_id
+    return entry
+
+  def _backoff(self, attempt):
+    delay = min(_INITIAL_SLEEP_SECONDS * 2 ** attempt, _MAX_SLEEP_SECONDS)
+    self._sleep(random.uniform(delay / 2, delay))
+
+  def push_batch(self, batch):
+    """Sends a batch, retrying the throttled requests and entries.
+
+    Args:
+      batch: list of LabelUpdate
+
+    Returns:
+      A (failed entries, requests sent) tuple
+
+    Raises:
+      requests.HTTPError: If a request fails with a non retryable status or
+      keeps being throttled
+    """
+    pending = dict(enumerate(batch))
+    failed = 0
+    requests_sent = 0
+    for attempt in range(self._max_attempts):
+      if attempt:
+        self._backoff(attempt - 1)
+      body = {'entries': [self._get_entry(batch_id, update)
+                          for batch_id, update in pending.items()]}
+      response = self._session.post(self._url, data=json.dumps(body),
+                                    headers={'Content-Type': 'application/json'})
+      requests_sent += 1
+      if (response.status_code in _RETRYABLE_STATUSES and
+          attempt < self._max_attempts - 1):
+        continue
+      response.raise_for_status()
+      retry = {}
+      for entry in response.json().get('entries', []):
+        errors = entry.get('errors', {}).get('errors', [])
+        batch_id = entry.get('batchId')
+        if not errors or batch_id not in pending:
+          continue
+        if any(error.get('reason') in _RETRYABLE_REASONS for error in errors):
+          retry[batch_id] = pending[batch_id]
+        else:
+          failed += 1
+          logging.error('Could not update %s: %s',
+                        pending[batch_id].product_id, errors)
+      pending = retry
+      if not pending:
+        return failed, requests_sent
+    logging.error('Gave up on %d throttled updates', len(pending))
+    return failed + len(pending), requests_sent
+
+  def push(self, batches, concurrency, progress, timeout_seconds=None,
+           clock=time.monotonic):
+    """Sends the batches with bounded concurrency and records the progress.
+
+    Args:
+      batches: iterable of (batch index, list of LabelUpdate) tuples
+      concurrency: int representing the number of batches sent at once
+      progress: progress store of the push, see get_progress_store
+      timeout_seconds: number of seconds after which no batch is started
+      clock: monotonic clock in seconds
+
+    Returns:
+      The PushStats of the push, complete is False when the timeout stopped it,
+      failed counts the entries of the batches left undone
+    """
+    deadline = None if timeout_seconds is None else clock() + timeout_seconds
+    done = progress.get_done()
+    sent = skipped = updates = failed = requests_sent = 0
+    complete = True
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+      in_flight = {}
+
+      def _collect(return_when):
+        nonlocal sent, updates, failed, requests_sent
+        finished, _ = concurrent.futures.wait(in_flight,
+                                              return_when=return_when)
+        for future in finished:
+          index, size = in_flight.pop(future)
+          batch_failed, batch_requests = future.result()
+          if batch_failed:
+            logging.error('Batch %d has %d failed updates, it is sent again '
+                          'by the next push', index, batch_failed)
+          else:
+            progress.mark_done(index)
+          sent += 1
+          updates += size
+          failed += batch_failed
+          requests_sent += batch_requests
+
+      for index, batch in batches:
+        if index in done:
+          skipped += 1
+          continue
+        if deadline is not None and clock() >= deadline:
+          complete = False
+          break
+        # Bounds the batches held in memory while the rows are streamed.
+        if len(in_flight) >= 2 * concurrency:
+          _collect(concurrent.futures.FIRST_COMPLETED)
+        in_flight[executor.submit(self.push_batch, batch)] = (index, len(batch))
+      _collect(concurrent.futures.ALL_COMPLETED)
+    return PushStats(sent, skipped, updates, failed, requests_sent, complete)
+
+class BigQueryProgressStore(object):
+  """Records the pushed batches of a run in a BigQuery table."""
+
+  def __init__(self, client, table, run_key):
+    self._client = client
+    self._table = table
+    self._run_key = run_key
+
+  def get_done(self):
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter(name, 'STRING', value)
+        for name, value in self._run_key.items()])
+    conditions = ' AND '.join(f'{name} = @{name}' for name in self._run_key)
+    rows = self._client.query(
+        f'SELECT DISTINCT batch FROM `{self._table}` WHERE {conditions}',
+        job_config=job_config).result()
+    return {row['batch'] for row in rows}
+
+  def mark_done(self, index):
+    errors = self._client.insert_rows_json(
+        self._table, [dict(self._run_key, batch=index, pushed=time.time())])
+    if errors:
+      logging.error('Could not record pushed batch %d: %s', index, errors)
+
+class JsonlProgressStore(object):
+  """Records the pushed batches of a run in a local JSON lines file."""
+
+  def __init__(self, path, run_key):
+    self._path = path
+    self._run_key = run_key
+
+  def get_done(self):
+    try:
+      with open(self._path) as store:
+        records = [json.loads(line) for line in store if line.strip()]
+    except FileNotFoundError:
+      return set()
+    return {record['batch'] for record in records
+            if all(record.get(name) == value
+                   for name, value in self._run_key.items())}
+
+  def mark_done(self, index):
+    with open(self._path, 'a') as store:
+      store.write(json.dumps(dict(self._run_key, batch=index)) + '\n')
+
+def get_progress_store(client, progress_table, progress_jsonl, run_key):
+  """Returns the store configured for the push progress.
+
+  Args:
+    client: bigquery.Client used by the BigQuery store
+    progress_table: string representing the fully qualified progress table
+    progress_jsonl: string representing the path of a local JSON lines file
+    run_key: dict of strings identifying the pushed run
+
+  Returns:
+    A store with get_done() and mark_done(index) methods
+  """
+  if progress_jsonl:
+    return JsonlProgressStore(progress_jsonl, run_key)
+  return BigQueryProgressStore(client, progress_table, run_key)
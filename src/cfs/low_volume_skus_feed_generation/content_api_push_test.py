@@ -0,0 +1,121 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Tests of ContentApiPusher against the Content API stand-in server."""
+
+import os
+import sys
+import threading
+import pytest
+import requests
+import content_api_push
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'tools'))
+import content_api_stand_in  # pylint: disable=g-import-not-at-top,wrong-import-position
+
+_MERCHANT_ID = 111111111
+
+@pytest.fixture(name='server')
+def _server():
+  server = content_api_stand_in.StandInServer(('127.0.0.1', 0),
+                                              error_rate=0.1)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+def _get_updates(count):
+  return [content_api_push.LabelUpdate(
+      _MERCHANT_ID, f'online:en:US:sku_{i:05d}',
+      'low_volume_sku' if i % 3 else '') for i in range(count)]
+
+def _get_pusher(endpoint):
+  return content_api_push.ContentApiPusher(
+      content_api_push.get_session(4), 4, endpoint=endpoint,
+      sleep=lambda seconds: None)
+
+def _get_labels(server, updates):
+  return [server.labels.get((update.merchant_id, update.product_id))
+          for update in updates]
+
+def test_push_retries_the_throttled_requests_and_entries(server, tmp_path):
+  updates = _get_updates(500)
+  progress = content_api_push.JsonlProgressStore(
+      str(tmp_path / 'progress.jsonl'), {'run_date': '20240101'})
+
+  stats = _get_pusher(server.endpoint).push(
+      content_api_push.get_batches(updates, 50), 4, progress)
+
+  assert stats.complete
+  assert (stats.batches, stats.updates, stats.failed) == (10, 500, 0)
+  assert stats.requests > stats.batches
+  assert _get_labels(server, updates) == [
+      {'customLabel4': update.label} for update in updates]
+
+def test_interrupted_push_resumes_after_the_batches_sent(server, tmp_path):
+  updates = _get_updates(500)
+  progress = content_api_push.JsonlProgressStore(
+      str(tmp_path / 'progress.jsonl'), {'run_date': '20240101'})
+  pusher = _get_pusher(server.endpoint)
+  ticks = iter([0.0, 0.0, 0.0, 0.0])
+
+  interrupted = pusher.push(
+      content_api_push.get_batches(updates, 50), 1, progress,
+      timeout_seconds=1, clock=lambda: next(ticks, 2.0))
+  resumed = pusher.push(content_api_push.get_batches(updates, 50), 4,
+                        progress)
+
+  assert not interrupted.complete
+  assert interrupted.batches == 3
+  assert resumed.complete
+  assert (resumed.skipped, resumed.batches) == (3, 7)
+  assert _get_labels(server, updates) == [
+      {'customLabel4': update.label} for update in updates]
+
+def test_batch_with_a_rejected_entry_is_sent_again(server, tmp_path):
+  updates = _get_updates(500)
+  server.invalid_ids = {updates[120].product_id, updates[130].product_id}
+  progress = content_api_push.JsonlProgressStore(
+      str(tmp_path / 'progress.jsonl'), {'run_date': '20240101'})
+  pusher = _get_pusher(server.endpoint)
+
+  failed = pusher.push(content_api_push.get_batches(updates, 50), 4, progress)
+  done = progress.get_done()
+  rejected = _get_labels(server, [updates[120], updates[130]])
+  server.invalid_ids = set()
+  resumed = pusher.push(content_api_push.get_batches(updates, 50), 4,
+                        progress)
+
+  assert failed.complete
+  assert (failed.batches, failed.failed) == (10, 2)
+  assert done == set(range(10)) - {2}
+  assert rejected == [None, None]
+  assert (resumed.skipped, resumed.batches, resumed.failed) == (9, 1, 0)
+  assert _get_labels(server, updates) == [
+      {'customLabel4': update.label} for update in updates]
+
+def _get_http_error(status_code):
+  response = requests.Response()
+  response.status_code = status_code
+  return requests.HTTPError(response=response)
+
+def test_only_throttling_and_server_errors_are_transient():
+  assert content_api_push.is_transient_error(_get_http_error(429))
+  assert content_api_push.is_transient_error(_get_http_error(503))
+  assert content_api_push.is_transient_error(
+      content_api_push.PushInterruptedError('time budget spent'))
+  assert not content_api_push.is_transient_error(_get_http_error(400))
+  assert not content_api_push.is_transient_error(KeyError('customLabel4'))
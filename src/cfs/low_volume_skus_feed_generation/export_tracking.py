@@ -0,0 +1,129 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Tracks the feed export jobs and records their statistics."""
+
+import datetime
+import json
+import logging
+import random
+import time
+
+_INITIAL_SLEEP_SECONDS = 1
+_MAX_SLEEP_SECONDS = 30
+
+def wait_for_job(job, timeout_seconds, sleep=time.sleep, clock=time.monotonic):
+  """Polls a BigQuery job with jittered exponential backoff.
+
+  Args:
+    job: bigquery.QueryJob to wait for
+    timeout_seconds: number of seconds after which the wait is abandoned
+    sleep: function used to wait between polls
+    clock: monotonic clock in seconds
+
+  Returns:
+    True if the job finished before the timeout, False otherwise
+  """
+  deadline = clock() + timeout_seconds
+  delay = _INITIAL_SLEEP_SECONDS
+  while not job.done():
+    remaining = deadline - clock()
+    if remaining <= 0:
+      return False
+    sleep(min(random.uniform(delay / 2, delay), remaining))
+    delay = min(delay * 2, _MAX_SLEEP_SECONDS)
+  return True
+
+def get_run_record(job, mc_id, gads_id, run_date, feed_mode,
+                   gcs_destination):
+  """Builds the run record of a feed export job.
+
+  Args:
+    job: bigquery.QueryJob running the EXPORT DATA statement
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+    feed_mode: string representing the feed mode of the export
+    gcs_destination: string representing the wildcard gcs uri of the files
+
+  Returns:
+    A dict with the job statistics, ready to be inserted in the feed runs table
+  """
+  # The EXPORT DATA statistics are not exposed by the client library.
+  export_stats = (job._properties.get('statistics', {})  # pylint: disable=protected-access
+                  .get('query', {}).get('exportDataStatistics', {}))
+  duration_ms = None
+  if job.started and job.ended:
+    duration_ms = int((job.ended - job.started).total_seconds() * 1000)
+  error = job.error_result
+  return {
+      'mc_id': mc_id,
+      'gads_id': gads_id,
+      'run_date': datetime.datetime.strptime(
+          run_date, '%Y%m%d').date().isoformat(),
+      'feed_mode': feed_mode,
+      'gcs_destination': gcs_destination,
+      'job_id': job.job_id,
+      'state': job.state,
+      'error': json.dumps(error) if error else None,
+      'created': job.created.isoformat() if job.created else None,
+      'duration_ms': duration_ms,
+      'total_bytes_processed': job.total_bytes_processed,
+      'total_slot_ms': job.slot_millis,
+      'rows_exported': _to_int(export_stats.get('rowCount')),
+      'files_exported': _to_int(export_stats.get('fileCount')),
+  }
+
+def _to_int(value):
+  return int(value) if value is not None else None
+
+class BigQueryRunSink(object):
+  """Writes the run records into a BigQuery table."""
+
+  def __init__(self, client, table):
+    self._client = client
+    self._table = table
+
+  def write(self, record):
+    errors = self._client.insert_rows_json(self._table, [record])
+    if errors:
+      logging.error('Could not record feed run %s: %s', record, errors)
+
+class JsonlRunSink(object):
+  """Appends the run records to a local JSON lines file."""
+
+  def __init__(self, path):
+    self._path = path
+
+  def write(self, record):
+    with open(self._path, 'a') as sink:
+      sink.write(json.dumps(record) + '\n')
+
+def get_run_sink(client, runs_table, runs_jsonl):
+  """Returns the sink configured for the run records.
+
+  Args:
+    client: bigquery.Client used by the BigQuery sink
+    runs_table: string representing the fully qualified feed runs table
+    runs_jsonl: string representing the path of a local JSON lines file
+
+  Returns:
+    A sink with a write(record) method, None if no sink is configured
+  """
+  if runs_jsonl:
+    return JsonlRunSink(runs_jsonl)
+  if runs_table:
+    return BigQueryRunSink(client, runs_table)
+  return None
@@ -0,0 +1,125 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Tests of the export job tracking with a stub job and clock."""
+
+import datetime
+import json
+import pytest
+import export_tracking
+
+_CREATED = datetime.datetime(2024, 1, 1, 6, tzinfo=datetime.timezone.utc)
+
+class _StubJob(object):
+  """An export job done after a number of polls."""
+
+  def __init__(self, polls=0, properties=None, error_result=None):
+    self.polls = 0
+    self._done_polls = polls
+    self._properties = properties or {}
+    self.job_id = 'zombies_feed_1234_5678_20240101_0'
+    self.state = 'DONE'
+    self.error_result = error_result
+    self.created = _CREATED
+    self.started = _CREATED + datetime.timedelta(seconds=2)
+    self.ended = _CREATED + datetime.timedelta(seconds=14, milliseconds=500)
+    self.total_bytes_processed = 2048
+    self.slot_millis = 3000
+
+  def done(self):
+    self.polls += 1
+    return self.polls > self._done_polls
+
+class _StubClock(object):
+  """A monotonic clock advanced by the sleeps."""
+
+  def __init__(self):
+    self.now = 0.0
+    self.sleeps = []
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+  def time(self):
+    return self.now
+
+@pytest.fixture(name='clock')
+def _clock(monkeypatch):
+  monkeypatch.setattr(export_tracking.random, 'uniform', lambda low, high: high)
+  return _StubClock()
+
+def test_wait_doubles_the_sleeps_up_to_their_cap(clock):
+  job = _StubJob(polls=7)
+
+  done = export_tracking.wait_for_job(job, 300, clock.sleep, clock.time)
+
+  assert done
+  assert clock.sleeps == [1, 2, 4, 8, 16, 30, 30]
+
+def test_wait_gives_up_at_the_timeout(clock):
+  job = _StubJob(polls=100)
+
+  done = export_tracking.wait_for_job(job, 20, clock.sleep, clock.time)
+
+  assert not done
+  assert clock.sleeps == [1, 2, 4, 8, 5]
+  assert clock.now == 20
+
+def test_wait_sleeps_are_jittered_within_the_delay(monkeypatch):
+  clock = _StubClock()
+  monkeypatch.setattr(export_tracking.random, 'uniform',
+                      lambda low, high: low)
+
+  export_tracking.wait_for_job(_StubJob(polls=3), 300, clock.sleep,
+                               clock.time)
+
+  assert clock.sleeps == [0.5, 1, 2]
+
+def test_run_record_maps_the_export_statistics():
+  job = _StubJob(properties={'statistics': {'query': {
+      'exportDataStatistics': {'rowCount': '1500', 'fileCount': '2'}}}})
+
+  record = export_tracking.get_run_record(
+      job, '1234', '5678', '20240101', 'delta', 'gs://bucket/feed_*.txt')
+
+  assert record == {
+      'mc_id': '1234',
+      'gads_id': '5678',
+      'run_date': '2024-01-01',
+      'feed_mode': 'delta',
+      'gcs_destination': 'gs://bucket/feed_*.txt',
+      'job_id': 'zombies_feed_1234_5678_20240101_0',
+      'state': 'DONE',
+      'error': None,
+      'created': '2024-01-01T06:00:00+00:00',
+      'duration_ms': 12500,
+      'total_bytes_processed': 2048,
+      'total_slot_ms': 3000,
+      'rows_exported': 1500,
+      'files_exported': 2,
+  }
+
+def test_run_record_of_a_job_without_statistics():
+  error = {'reason': 'invalidQuery', 'message': 'Table not found'}
+  job = _StubJob(error_result=error)
+  job.started = job.ended = None
+
+  record = export_tracking.get_run_record(
+      job, '1234', '5678', '20240101', 'full', 'gs://bucket/feed_*.txt')
+
+  assert json.loads(record['error']) == error
+  assert record['duration_ms'] is None
+  assert (record['rows_exported'], record['files_exported']) == (None, None)
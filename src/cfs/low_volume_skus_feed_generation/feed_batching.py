@@ -0,0 +1,263 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Batches the feed exports of the account pairs completed in a time window.
+
+Every completion event is recorded in the batch events table with the window
+its publish time falls in. The first invocation of a window claims it with a
+job whose id is derived from the run date and the window, and becomes its
+coordinator: it waits for the end of the window, or until every account pair
+has reported for the run date, and submits one script exporting all the pairs
+of the window. The other invocations only poll the metadata of the script job
+until it is submitted, then check that their pair is in the script. A pair
+recorded too late for the script, or whose window was never submitted, is
+exported on its own.
+"""
+
+import collections
+import re
+import time
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+_POLL_SECONDS = 5
+# Time left to the streaming inserts of the last events of a window.
+_GRACE_SECONDS = 2
+# Time the coordinator of a window is given to submit the script after the end
+# of the window, before the other invocations export their pair on their own.
+_SUBMIT_SECONDS = 60
+_STATEMENT_RE = re.compile(r'^-- Statement \d+: (\S+) (\S+)$', re.MULTILINE)
+
+PairExport = collections.namedtuple(
+    'PairExport', ['mc_id', 'gads_id', 'feed_mode', 'gcs_destination', 'query'])
+
+Statement = collections.namedtuple(
+    'Statement', ['index', 'start_line', 'end_line', 'export'])
+
+def get_max_window_seconds(timeout_seconds):
+  """Returns the longest batch window an invocation can wait for.
+
+  An event published at the start of a window waits for its end, the grace and
+  the submission of the script, then may still have to export its pair on its
+  own, all within the timeout of the function.
+
+  Args:
+    timeout_seconds: int representing the timeout of the function
+
+  Returns:
+    An int representing the longest batch window in seconds
+  """
+  return timeout_seconds - _GRACE_SECONDS - 2 * _SUBMIT_SECONDS
+
+def get_batch_window(timestamp, window_seconds):
+  """Returns the index of the batch window of a timestamp.
+
+  Args:
+    timestamp: float representing seconds since the epoch
+    window_seconds: int representing the length of a batch window
+
+  Returns:
+    An int identifying the window
+  """
+  return int(timestamp // window_seconds)
+
+def record_event(client, events_table, run_date, mc_id, gads_id, window):
+  """Records the completion of an account pair in a batch window.
+
+  Args:
+    client: bigquery.Client used to insert the event
+    events_table: string representing the fully qualified batch events table
+    run_date: string representing the run date in YYYYMMDD format
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    window: int identifying the batch window
+
+  Raises:
+    RuntimeError: If the event could not be inserted
+  """
+  errors = client.insert_rows_json(events_table, [{
+      'run_date': f'{run_date[:4]}-{run_date[4:6]}-{run_date[6:]}',
+      'mc_id': mc_id,
+      'gads_id': gads_id,
+      'batch_window': window,
+      'recorded': time.time(),
+  }])
+  if errors:
+    raise RuntimeError(f'Could not record batch event: {errors}')
+
+def _get_pairs(client, events_table, run_date, window=None):
+  """Returns the sorted account pairs reported for a run date and window."""
+  query = f"""
+      SELECT DISTINCT mc_id, gads_id
+      FROM `{events_table}`
+      WHERE
+        run_date = PARSE_DATE('%Y%m%d', @run_date)
+        AND (@batch_window IS NULL OR batch_window = @batch_window)
+      ORDER BY mc_id, gads_id
+    """
+  job_config = bigquery.QueryJobConfig(query_parameters=[
+      bigquery.ScalarQueryParameter('run_date', 'STRING', run_date),
+      bigquery.ScalarQueryParameter('batch_window', 'INT64', window),
+  ])
+  return [(row['mc_id'], row['gads_id'])
+          for row in client.query(query, job_config=job_config).result()]
+
+def get_window_pairs(client, events_table, run_date, window):
+  """Returns the account pairs reported in a batch window."""
+  return _get_pairs(client, events_table, run_date, window)
+
+def claim_window(client, job_id):
+  """Claims the coordination of a batch window.
+
+  Args:
+    client: bigquery.Client used to create the claim job
+    job_id: string representing the job id of the batch window
+
+  Returns:
+    True if the invocation coordinates the window, False if another one
+    claimed it first
+  """
+  try:
+    client.query('SELECT 1', job_id=f'{job_id}_coordinator')
+    return True
+  except exceptions.Conflict:
+    return False
+
+def wait_for_window(client, events_table, run_date, window_end, pairs_count,
+                    sleep=time.sleep, clock=time.time):
+  """Waits for the end of a batch window or for every pair to report.
+
+  Args:
+    client: bigquery.Client used to count the reported pairs
+    events_table: string representing the fully qualified batch events table
+    run_date: string representing the run date in YYYYMMDD format
+    window_end: float representing the end of the window in seconds since the
+    epoch
+    pairs_count: int representing the number of configured account pairs
+    sleep: function used to wait between polls
+    clock: wall clock in seconds since the epoch
+  """
+  while True:
+    remaining = window_end - clock()
+    if remaining <= 0:
+      sleep(_GRACE_SECONDS)
+      return
+    if len(_get_pairs(client, events_table, run_date)) >= pairs_count:
+      return
+    sleep(min(_POLL_SECONDS, remaining))
+
+def wait_for_script(client, job_id, window_end, sleep=time.sleep,
+                    clock=time.time):
+  """Waits for the coordinator of a batch window to submit its script.
+
+  Only the metadata of the script job is read, no query is run.
+
+  Args:
+    client: bigquery.Client used to look the script job up
+    job_id: string representing the job id of the batch window
+    window_end: float representing the end of the window in seconds since the
+    epoch
+    sleep: function used to wait between polls
+    clock: wall clock in seconds since the epoch
+
+  Returns:
+    The bigquery.QueryJob of the script, None if it was not submitted in time
+  """
+  deadline = window_end + _GRACE_SECONDS + _SUBMIT_SECONDS
+  while True:
+    try:
+      return client.get_job(job_id)
+    except exceptions.NotFound:
+      remaining = deadline - clock()
+      if remaining <= 0:
+        return None
+      sleep(min(_POLL_SECONDS, remaining))
+
+def get_script_pairs(job):
+  """Returns the (mc_id, gads_id) pairs exported by a batch script job."""
+  return set(_STATEMENT_RE.findall(job.query or ''))
+
+def build_script(exports):
+  """Builds the script running the export statements of several pairs.
+
+  Every pair runs in its own block so the failure of one pair is reported
+  without stopping the exports of the others.
+
+  Args:
+    exports: list of PairExport to run
+
+  Returns:
+    A (script, statements) tuple, statements lists the Statement of every
+    pair with the script lines it covers
+  """
+  lines = []
+  statements = []
+  for index, export in enumerate(exports):
+    start_line = len(lines) + 1
+    lines.append(f'-- Statement {index}: {export.mc_id} {export.gads_id}')
+    lines.append('BEGIN')
+    lines.extend(export.query.strip().rstrip(';').split('\n'))
+    lines[-1] += ';'
+    lines.append('EXCEPTION WHEN ERROR THEN')
+    lines.append(f"  SELECT {index} AS statement, '{export.mc_id}' AS mc_id, "
+                 f"'{export.gads_id}' AS gads_id, "
+                 '@@error.message AS error;')
+    lines.append('END;')
+    statements.append(Statement(index, start_line, len(lines), export))
+  return '\n'.join(lines), statements
+
+def submit_script(client, script, job_id):
+  """Submits the batch script unless the window was already submitted.
+
+  Args:
+    client: bigquery.Client used to run the script
+    script: string representing the batch script
+    job_id: string representing the job id of the batch window
+
+  Returns:
+    The bigquery.QueryJob of the script, None if the job id already exists
+  """
+  try:
+    return client.query(script, job_id=job_id)
+  except exceptions.Conflict:
+    return None
+
+def get_statement_jobs(client, job, statements):
+  """Maps the child jobs of a finished batch script to their statement.
+
+  Args:
+    client: bigquery.Client used to list the child jobs
+    job: bigquery.QueryJob of the batch script
+    statements: list of Statement returned by build_script
+
+  Returns:
+    A list of (child job, Statement) tuples, in script order
+  """
+  statement_jobs = []
+  for child in client.list_jobs(parent_job=job.job_id):
+    # The primary script frame is the last one of the stack.
+    frames = (child._properties.get('statistics', {})  # pylint: disable=protected-access
+              .get('scriptStatistics', {}).get('stackFrames', []))
+    if not frames:
+      continue
+    line = int(frames[-1].get('startLine', 0))
+    for statement in statements:
+      if statement.start_line <= line <= statement.end_line:
+        statement_jobs.append((child, statement))
+        break
+  # The jobs are listed from the most recent one.
+  statement_jobs.reverse()
+  statement_jobs.sort(key=lambda item: item[1].index)
+  return statement_jobs
@@ -0,0 +1,277 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Fingerprints the inputs of a low volume skus run to reuse unchanged runs.
+
+The fingerprint of an account pair and run date covers the partitions of the
+Merchant Center products and of the Google Ads statistics read by the scoring
+window, with their row counts and last modified times, the row counts of the
+latest snapshot of the Google Ads targeting tables, the threshold variables
+and the text of the scoring query. When it matches the fingerprint recorded
+for the previous run of the pair, the scoring and the export produce the same
+skus, so the previous result is reused instead. A targeting change keeping
+the row counts of the snapshot tables is picked up with the next change of the
+products or statistics.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import time
+
+# Variables the low volume skus depend on besides the source tables.
+THRESHOLD_VARIABLES = ('zombies_deciles', 'zombies_clicks_decil',
+                       'zombies_impressions_decil', 'zombies_sql_condition',
+                       'zombies_feed_label_index')
+# Days of products and statistics read by the scoring query.
+_WINDOW_DAYS = 31
+# Google Ads tables read as their latest snapshot by the targeting views.
+_SNAPSHOT_TABLES = ('Campaign', 'AdGroup', 'AdGroupCriterion', 'AssetGroup',
+                    'AssetGroupListingGroupFilter')
+
+def get_source_tables(mc_id, gads_id):
+  """Returns the windowed and the snapshot source tables of a pair.
+
+  Args:
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+
+  Returns:
+    A tuple of the merchant tables, the windowed gads tables and the snapshot
+    gads tables
+  """
+  return ([f'Products_{mc_id}'], [f'ads_ShoppingProductStats_{gads_id}'],
+          [f'ads_{name}_{gads_id}' for name in _SNAPSHOT_TABLES])
+
+def fetch_partitions(client, dataset, tables, window_start):
+  """Fetches the partitions of tables from the dataset INFORMATION_SCHEMA.
+
+  Args:
+    client: bigquery.Client running the query
+    dataset: string representing the fully qualified dataset
+    tables: list of table names of the dataset
+    window_start: string representing the first partition, YYYYMMDD
+
+  Returns:
+    A list of (table, partition id, rows, last modified ms) tuples, the
+    partitions before window_start left out
+  """
+  from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+  job_config = bigquery.QueryJobConfig(query_parameters=[
+      bigquery.ArrayQueryParameter('tables', 'STRING', tables),
+      bigquery.ScalarQueryParameter('window_start', 'STRING', window_start)])
+  rows = client.query(f"""
+      SELECT
+        table_name,
+        partition_id,
+        total_rows,
+        UNIX_MILLIS(last_modified_time) AS modified
+      FROM `{dataset}.INFORMATION_SCHEMA.PARTITIONS`
+      WHERE
+        table_name IN UNNEST(@tables)
+        AND (partition_id >= @window_start
+             OR NOT REGEXP_CONTAINS(partition_id, r'^[0-9]{{8}}$'))
+    """, job_config=job_config).result()
+  return [(row['table_name'], row['partition_id'], row['total_rows'],
+           row['modified']) for row in rows]
+
+def compute_fingerprint(partitions, snapshot_tables, thresholds, query=None):
+  """Computes the fingerprint of the inputs of a run.
+
+  Args:
+    partitions: list of (table, partition id, rows, last modified ms) tuples
+    snapshot_tables: list of the tables of which only the row count of the
+    latest partition is fingerprinted
+    thresholds: dict from the THRESHOLD_VARIABLES to their values
+    query: string representing the scoring query, if known
+
+  Returns:
+    A hex string identifying the inputs
+  """
+  latest = {}
+  windowed = []
+  for table, partition_id, rows, modified in partitions:
+    if table in snapshot_tables:
+      if table not in latest or latest[table][0] < partition_id:
+        latest[table] = (partition_id, rows)
+    else:
+      windowed.append([table, partition_id, rows, modified])
+  payload = {
+      'partitions': sorted(windowed),
+      'snapshots': {table: rows for table, (_, rows) in latest.items()},
+      'thresholds': {name: str(thresholds.get(name))
+                     for name in THRESHOLD_VARIABLES},
+      'query': hashlib.sha256((query or '').encode('utf-8')).hexdigest(),
+  }
+  return hashlib.sha256(
+      json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_fingerprint(client, sources_project, merchant_dataset, gads_dataset,
+                    mc_id, gads_id, run_date, thresholds, query=None):
+  """Fingerprints the inputs of the run of an account pair.
+
+  Args:
+    client: bigquery.Client reading the partitions
+    sources_project: string representing the project of the transfers
+    merchant_dataset: string representing the Merchant Center dataset
+    gads_dataset: string representing the Google Ads dataset
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+    thresholds: dict from the THRESHOLD_VARIABLES to their values
+    query: string representing the scoring query, if known
+
+  Returns:
+    A hex string identifying the inputs
+  """
+  window_start = (datetime.datetime.strptime(run_date, '%Y%m%d') -
+                  datetime.timedelta(days=_WINDOW_DAYS)).strftime('%Y%m%d')
+  merchant_tables, gads_tables, snapshot_tables = get_source_tables(
+      mc_id, gads_id)
+  partitions = fetch_partitions(
+      client, f'{sources_project}.{merchant_dataset}', merchant_tables,
+      window_start)
+  partitions += fetch_partitions(
+      client, f'{sources_project}.{gads_dataset}',
+      gads_tables + snapshot_tables, window_start)
+  return compute_fingerprint(partitions, snapshot_tables, thresholds, query)
+
+def get_record(mc_id, gads_id, run_date, fingerprint, job_id=None,
+               reused=None):
+  """Returns the record of a run.
+
+  Args:
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+    fingerprint: string returned by get_fingerprint
+    job_id: string representing the export job of the run, if any
+    reused: record of the run whose result is reused, if any
+
+  Returns:
+    A dict with the run date as YYYY-MM-DD, the run date whose result was
+    produced as source_run_date and the job id of its export
+  """
+  run_day = datetime.datetime.strptime(run_date, '%Y%m%d').date().isoformat()
+  return {
+      'mc_id': mc_id,
+      'gads_id': gads_id,
+      'run_date': run_day,
+      'fingerprint': fingerprint,
+      'source_run_date': reused['source_run_date'] if reused else run_day,
+      'job_id': reused['job_id'] if reused else job_id,
+      'recorded': time.time(),
+  }
+
+def find_reusable_run(store, client, mc_id, gads_id, run_date, fingerprint):
+  """Returns the previous run of a pair when its result can be reused.
+
+  Args:
+    store: store returned by get_fingerprint_store
+    client: bigquery.Client looking the export job up
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+    fingerprint: string returned by get_fingerprint
+
+  Returns:
+    The record of the previous run if it has the same fingerprint and its
+    export succeeded, None otherwise
+  """
+  previous = store.get_previous(mc_id, gads_id, run_date)
+  if not previous or previous['fingerprint'] != fingerprint:
+    return None
+  if previous['job_id']:
+    job = client.get_job(previous['job_id'])
+    if job.state != 'DONE' or job.error_result:
+      return None
+  return previous
+
+class BigQueryFingerprintStore(object):
+  """Records the fingerprints of the runs in a BigQuery table."""
+
+  def __init__(self, client, table):
+    self._client = client
+    self._table = table
+
+  def get_previous(self, mc_id, gads_id, run_date):
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('mc_id', 'STRING', mc_id),
+        bigquery.ScalarQueryParameter('gads_id', 'STRING', gads_id),
+        bigquery.ScalarQueryParameter('run_date', 'STRING', run_date)])
+    rows = list(self._client.query(f"""
+        SELECT
+          FORMAT_DATE('%F', run_date) AS run_date,
+          fingerprint,
+          FORMAT_DATE('%F', source_run_date) AS source_run_date,
+          job_id
+        FROM `{self._table}`
+        WHERE
+          mc_id = @mc_id
+          AND gads_id = @gads_id
+          AND run_date < PARSE_DATE('%Y%m%d', @run_date)
+        ORDER BY run_date DESC, recorded DESC
+        LIMIT 1
+      """, job_config=job_config).result())
+    return dict(rows[0].items()) if rows else None
+
+  def record(self, record):
+    errors = self._client.insert_rows_json(self._table, [record])
+    if errors:
+      logging.error('Could not record fingerprint %s: %s', record, errors)
+
+class JsonlFingerprintStore(object):
+  """Records the fingerprints of the runs in a local JSON lines file."""
+
+  def __init__(self, path):
+    self._path = path
+
+  def get_previous(self, mc_id, gads_id, run_date):
+    run_day = datetime.datetime.strptime(run_date, '%Y%m%d').date().isoformat()
+    try:
+      with open(self._path) as store:
+        records = [json.loads(line) for line in store if line.strip()]
+    except FileNotFoundError:
+      return None
+    records = [record for record in records
+               if record['mc_id'] == mc_id and record['gads_id'] == gads_id
+               and record['run_date'] < run_day]
+    return max(records, default=None,
+               key=lambda record: (record['run_date'], record['recorded']))
+
+  def record(self, record):
+    with open(self._path, 'a') as store:
+      store.write(json.dumps(record) + '\n')
+
+def get_fingerprint_store(client, fingerprints_table, fingerprints_jsonl):
+  """Returns the store configured for the fingerprints.
+
+  Args:
+    client: bigquery.Client used by the BigQuery store
+    fingerprints_table: string representing the fully qualified table
+    fingerprints_jsonl: string representing the path of a local JSON lines
+    file
+
+  Returns:
+    A store with get_previous(mc_id, gads_id, run_date) and record(record)
+    methods, None if the runs are not fingerprinted
+  """
+  if fingerprints_jsonl:
+    return JsonlFingerprintStore(fingerprints_jsonl)
+  if fingerprints_table:
+    return BigQueryFingerprintStore(client, fingerprints_table)
+  return None
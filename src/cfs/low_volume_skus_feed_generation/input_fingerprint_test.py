@@ -0,0 +1,131 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Tests of the input fingerprints with the JSON lines store."""
+
+import pytest
+import input_fingerprint
+
+_THRESHOLDS = {
+    'zombies_deciles': '10',
+    'zombies_clicks_decil': '1',
+    'zombies_impressions_decil': '1',
+    'zombies_sql_condition': 'TRUE',
+    'zombies_feed_label_index': '4',
+}
+_PARTITIONS = [
+    ('Products_1234', '20240101', 1000, 1704088800000),
+    ('Products_1234', '20240102', 1010, 1704175200000),
+    ('ads_ShoppingProductStats_5678', '20240101', 500, 1704092400000),
+    ('ads_Campaign_5678', '20240101', 3, 1704092400000),
+    ('ads_Campaign_5678', '20240102', 4, 1704178800000),
+]
+
+class _FakeJob(object):
+  """The state of an export job."""
+
+  def __init__(self, state, error_result=None):
+    self.state = state
+    self.error_result = error_result
+
+class _FakeClient(object):
+  """Returns the jobs it is given."""
+
+  def __init__(self, jobs):
+    self._jobs = jobs
+
+  def get_job(self, job_id):
+    return self._jobs[job_id]
+
+@pytest.fixture(name='partitions')
+def _partitions(monkeypatch):
+  partitions = list(_PARTITIONS)
+
+  def fetch_partitions(client, dataset, tables, window_start):
+    del client, dataset
+    return [partition for partition in partitions
+            if partition[0] in tables and partition[1] >= window_start]
+
+  monkeypatch.setattr(input_fingerprint, 'fetch_partitions', fetch_partitions)
+  return partitions
+
+def _get_fingerprint(run_date='20240103', thresholds=None):
+  return input_fingerprint.get_fingerprint(
+      None, 'sources', 'merchant', 'gads', '1234', '5678', run_date,
+      thresholds or _THRESHOLDS, 'SELECT 1')
+
+def test_unchanged_inputs_reuse_the_previous_run(partitions, tmp_path):
+  del partitions
+  store = input_fingerprint.JsonlFingerprintStore(
+      str(tmp_path / 'fingerprints.jsonl'))
+  client = _FakeClient({'export_0': _FakeJob('DONE')})
+  store.record(input_fingerprint.get_record(
+      '1234', '5678', '20240102', _get_fingerprint('20240102'), 'export_0'))
+
+  fingerprint = _get_fingerprint()
+  reused = input_fingerprint.find_reusable_run(
+      store, client, '1234', '5678', '20240103', fingerprint)
+  store.record(input_fingerprint.get_record(
+      '1234', '5678', '20240103', fingerprint, reused=reused))
+  reused_again = input_fingerprint.find_reusable_run(
+      store, client, '1234', '5678', '20240104', _get_fingerprint('20240104'))
+
+  assert reused['run_date'] == '2024-01-02'
+  assert reused_again['run_date'] == '2024-01-03'
+  assert (reused_again['source_run_date'], reused_again['job_id']) == (
+      '2024-01-02', 'export_0')
+
+def test_failed_export_is_not_reused(partitions, tmp_path):
+  del partitions
+  store = input_fingerprint.JsonlFingerprintStore(
+      str(tmp_path / 'fingerprints.jsonl'))
+  client = _FakeClient({'export_0': _FakeJob('DONE', {'reason': 'invalid'})})
+  store.record(input_fingerprint.get_record(
+      '1234', '5678', '20240102', _get_fingerprint('20240102'), 'export_0'))
+
+  assert input_fingerprint.find_reusable_run(
+      store, client, '1234', '5678', '20240103', _get_fingerprint()) is None
+
+@pytest.mark.parametrize('name, value', [
+    ('zombies_deciles', '5'),
+    ('zombies_sql_condition', 'offer_id_clicks = 0'),
+    ('zombies_feed_label_index', '3'),
+])
+def test_fingerprint_changes_with_a_threshold(partitions, name, value):
+  del partitions
+
+  assert _get_fingerprint(thresholds=dict(_THRESHOLDS, **{name: value})) != (
+      _get_fingerprint())
+
+@pytest.mark.parametrize('index, partition', [
+    (1, ('Products_1234', '20240102', 1011, 1704175200000)),
+    (1, ('Products_1234', '20240102', 1010, 1704175300000)),
+    (2, ('ads_ShoppingProductStats_5678', '20240101', 501, 1704092400000)),
+    (4, ('ads_Campaign_5678', '20240102', 5, 1704178800000)),
+])
+def test_fingerprint_changes_with_a_partition(partitions, index, partition):
+  fingerprint = _get_fingerprint()
+
+  partitions[index] = partition
+
+  assert _get_fingerprint() != fingerprint
+
+def test_older_snapshots_and_partitions_do_not_change_it(partitions):
+  fingerprint = _get_fingerprint()
+
+  partitions[3] = ('ads_Campaign_5678', '20240101', 30, 1704178900000)
+  partitions.append(('Products_1234', '20231101', 900, 1698796800000))
+
+  assert _get_fingerprint() == fingerprint
@@ -16,13 +16,43 @@
 
 import os
 import base64
+import datetime
 import json
+import string
+import time
+import traceback
 from google.api_core import datetime_helpers
+from google.api_core import exceptions
 from google.cloud import bigquery
+import content_api_push
+import export_tracking
+import feed_batching
+import input_fingerprint
+import run_ledger
+import spans
+
+_FULL_FEED_MODE = 'full'
+_DELTA_FEED_MODE = 'delta'
+_LOW_VOLUME_SKU_LABEL = 'low_volume_sku'
+_NO_FEED_SHARDING = 'none'
+_GZIP_COMPRESSION = 'gzip'
+_CONTENT_API_DELIVERY = 'content_api'
+# Timeout of the function when it waits on jobs, see cf_feed_generation.tf.
+_FUNCTION_TIMEOUT_SECONDS = 540
+
+# Accounts compiled from variables.tf by src/bq_transfers/zombies_config.py.
+_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'zombies_config.json')
+
+# Warm instances reuse the state built by the first invocation, see _get_state.
+_state = None
 
 def trigger_job(event, context):
     """Cloud Function to be triggered by PubSub after BigQuery Scheduled Query completion.
-       This function generates the low volume sku suplemental feed using SQL.
+       This function generates the low volume sku suplemental feed using SQL,
+       or pushes the labels with the Content API, see _trigger_job. In
+       content_api delivery mode only the transient errors fail the
+       invocation so the event is delivered again.
     Args:
         event (dict):  The dictionary with data specific to this type of event.
                        The `data` field contains a description of the event in
@@ -32,12 +62,38 @@ def trigger_job(event, context):
     Returns:
         None; the output is written to Stackdriver Logging
     """
+    try:
+      _trigger_job(event, context)
+    except Exception as e:  # pylint: disable=broad-except
+      if (os.environ.get('ZOMBIES_FEED_DELIVERY') != _CONTENT_API_DELIVERY
+          or _is_transient_error(e)):
+        raise
+      traceback.print_exc()
+      print(f'Permanent error, the event is not delivered again: {e!r}')
+
+def _is_transient_error(error):
+  """Checks whether an invocation may succeed when the event is delivered again.
+
+  Args:
+    error: Exception raised by the invocation
+
+  Returns:
+    True for the transient Content API and BigQuery errors
+  """
+  return (content_api_push.is_transient_error(error) or
+          isinstance(error, (exceptions.TooManyRequests,
+                             exceptions.ServerError)))
+
+def _trigger_job(event, context):
+    """Handles a scheduled query completion event, see trigger_job.
+
+    With input fingerprints, a run whose source partitions and thresholds did
+    not change since the previous run of the pair is skipped and the previous
+    result reused. With a run ledger, the export of a LowVolumeSkus table
+    version is only submitted once, duplicate deliveries are skipped.
+    """
 
-    GCP_PROJECT = os.environ.get('GCP_PROJECT')
-    ZOMBIES_DATASET_NAME = os.environ.get('ZOMBIES_DATASET_NAME')
-    ACCOUNTS_CONFIG = json.loads(os.environ.get('ACCOUNTS_CONFIG'))
-    ZOMBIES_SQL_CONDITION = os.environ.get('ZOMBIES_SQL_CONDITION')
-    ZOMBIES_FEED_LABEL_INDEX = os.environ.get('ZOMBIES_FEED_LABEL_INDEX')
+    state = _get_state()
 
     data = base64.b64decode(event['data']).decode('utf-8')
     msg = json.loads(data)
@@ -47,48 +103,979 @@ def trigger_job(event, context):
     gads_id = accounts_id[2]
     run_date = _get_date(msg)
 
-    zombies_bucket = _get_zombies_bucket(mc_id, gads_id,
-                                         ACCOUNTS_CONFIG)
-    gcs_destination = f'{zombies_bucket}/low_volume_skus_{mc_id}_{gads_id}_*.txt'
+    tracer = state['tracer'].with_attributes(run_date=run_date, mc_id=mc_id,
+                                             gads_id=gads_id)
+    _record_scheduled_query(tracer, msg)
+
+    with tracer.span('trigger_job', delivery=state['delivery']) as span:
+      source = _get_source_table(
+          state['client'],
+          f'{state["dataset"]}.LowVolumeSkus_{mc_id}_{gads_id}_{run_date}')
+      span.set(low_volume_rows=source.num_rows if source else None)
+
+      fingerprint = None
+      if state['fingerprint_store'] and not state['batch_window_seconds']:
+        fingerprint = input_fingerprint.get_fingerprint(
+            state['client'], state['sources_project'],
+            state['merchant_dataset'], state['gads_dataset'], mc_id, gads_id,
+            run_date, state['thresholds'], msg['params'].get('query'))
+        reused = input_fingerprint.find_reusable_run(
+            state['fingerprint_store'], state['client'], mc_id, gads_id,
+            run_date, fingerprint)
+        if reused:
+          print(f'Inputs of {mc_id} {gads_id} {run_date} unchanged since '
+                f'{reused["source_run_date"]}, skipping the export')
+          span.set(reused_run_date=reused['source_run_date'])
+          state['fingerprint_store'].record(input_fingerprint.get_record(
+              mc_id, gads_id, run_date, fingerprint, reused=reused))
+          return
+
+      if state['delivery'] == _CONTENT_API_DELIVERY:
+        _push_labels(state, tracer, mc_id, gads_id, run_date)
+        if fingerprint:
+          state['fingerprint_store'].record(input_fingerprint.get_record(
+              mc_id, gads_id, run_date, fingerprint))
+        return
+
+      if state['batch_window_seconds'] and _batch_export(
+          state, tracer, mc_id, gads_id, run_date, context):
+        return
+
+      export = _get_pair_export(state, mc_id, gads_id, run_date)
+
+      job_config = bigquery.job.QueryJobConfig()
+
+      if state['run_ledger'] and source and source.modified:
+        run_id = run_ledger.get_run_id(mc_id, gads_id, run_date,
+                                       source.modified)
+        job = state['run_ledger'].submit(run_id, export.query, job_config)
+        if job is None:
+          print(f'Export {run_id} already done or in progress, skipping')
+          span.set(duplicate=True, run_id=run_id)
+          return
+      else:
+        job = state['client'].query(export.query, job_config=job_config)
+      span.set(job_id=job.job_id, feed_mode=export.feed_mode)
+      if fingerprint:
+        state['fingerprint_store'].record(input_fingerprint.get_record(
+            mc_id, gads_id, run_date, fingerprint, job.job_id))
+
+      if state['track_export_jobs']:
+        _track_export_job(state, tracer, job, mc_id, gads_id, run_date,
+                          export.feed_mode, export.gcs_destination)
+
+def _record_scheduled_query(tracer, msg):
+  """Records the span of the scheduled query run that published the message.
+
+  The spans of the invocation and of its jobs follow it on the same timeline.
+
+  Args:
+    tracer: spans.Tracer of the invocation
+    msg: A JSON object representing the transfer run message
+  """
+  if not msg.get('startTime') or not msg.get('endTime'):
+    return
+  tracer.record(
+      'scheduled_query',
+      datetime_helpers.from_rfc3339(msg['startTime']).timestamp(),
+      datetime_helpers.from_rfc3339(msg['endTime']).timestamp(),
+      status='ok' if msg.get('state') == 'SUCCEEDED' else 'error',
+      state=msg.get('state'), transfer_run=msg.get('name'))
+
+def _get_source_table(client, table):
+  """Returns the metadata of the LowVolumeSkus table of a run.
+
+  Args:
+    client: bigquery.Client used to look the table up
+    table: string representing the fully qualified table id
+
+  Returns:
+    The bigquery.Table with its number of rows and last modified time, None
+    if the table does not exist
+  """
+  try:
+    return client.get_table(table)
+  except exceptions.NotFound:
+    return None
+
+def _record_job(tracer, job, name='export_job', **attributes):
+  """Records the span of a finished BigQuery job with its statistics.
+
+  Args:
+    tracer: spans.Tracer of the invocation
+    job: bigquery.QueryJob to record
+    name: string representing the name of the span
+    **attributes: attributes of the span
+  """
+  if not job.started or not job.ended:
+    return
+  tracer.record(name, job.started.timestamp(), job.ended.timestamp(),
+                status='error' if job.error_result else 'ok',
+                job_id=job.job_id,
+                total_bytes_processed=job.total_bytes_processed,
+                total_slot_ms=job.slot_millis, **attributes)
+
+def _get_previous_table(state, table_prefix, run_date):
+  """Returns the LowVolumeSkus table a delta is computed against.
+
+  Args:
+    state: dict returned by _get_state
+    table_prefix: string representing the LowVolumeSkus table of a pair
+    without the date suffix
+    run_date: string representing the run date in YYYYMMDD format
+
+  Returns:
+    The previous table id in delta mode when it exists and the run date is
+    not the snapshot day, None otherwise
+  """
+  if (state['feed_mode'] != _DELTA_FEED_MODE or
+      _is_snapshot_day(run_date, state['snapshot_weekday'])):
+    return None
+  return _get_existing_table(
+      state['client'], f'{table_prefix}_{_get_previous_date(run_date)}')
+
+def _push_labels(state, tracer, mc_id, gads_id, run_date):
+  """Pushes the labels of a run to Merchant Center with the Content API.
+
+  The updates are read in product id order so the batches keep their number
+  when an interrupted push is retried, the batches recorded in the progress
+  store are skipped. A push stopped by the time budget raises so the event is
+  delivered again.
+
+  Args:
+    state: dict returned by _get_state
+    tracer: spans.Tracer of the invocation
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+
+  Raises:
+    content_api_push.PushInterruptedError: If the push did not complete within
+    the time budget
+  """
+  client = state['client']
+  table_prefix = f'{state["dataset"]}.LowVolumeSkus_{mc_id}_{gads_id}'
+  previous_table = _get_previous_table(state, table_prefix, run_date)
+  product_table = f'{state["dataset"]}.product_view_{mc_id}'
+  if previous_table:
+    query = state['delta_push_query'].safe_substitute(
+        table=f'{table_prefix}_{run_date}', previous_table=previous_table,
+        product_table=product_table)
+  else:
+    query = state['full_push_query'].safe_substitute(
+        table=f'{table_prefix}_{run_date}', product_table=product_table)
+
+  rows = client.query(query).result(page_size=state['push_batch_size'])
+  updates = (content_api_push.LabelUpdate(row['merchant_id'],
+                                          row['product_id'], row['label'])
+             for row in rows)
+  run_key = {'run_date': run_date, 'mc_id': mc_id, 'gads_id': gads_id,
+             'feed_mode': _DELTA_FEED_MODE if previous_table
+                          else _FULL_FEED_MODE}
+  progress = content_api_push.get_progress_store(
+      client, state['push_progress_table'],
+      os.environ.get('ZOMBIES_PUSH_PROGRESS_JSONL'), run_key)
+  pusher = content_api_push.ContentApiPusher(
+      state['push_session'], state['feed_label_index'],
+      feed_id=state['content_api_feed_ids'].get(mc_id),
+      endpoint=state['content_api_endpoint'])
+  with tracer.span('content_api_push', feed_mode=run_key['feed_mode']) as span:
+    stats = pusher.push(
+        content_api_push.get_batches(updates, state['push_batch_size']),
+        state['push_concurrency'], progress,
+        timeout_seconds=state['push_timeout_seconds'])
+    span.set(**stats._asdict())
+  print(json.dumps(dict(run_key, **stats._asdict())))
+  if not stats.complete:
+    raise content_api_push.PushInterruptedError(
+        f'Push of {mc_id} {gads_id} {run_date} interrupted by the time '
+        'budget, it resumes on the next delivery')
+
+def _get_pair_export(state, mc_id, gads_id, run_date):
+  """Renders the export of the low volume skus of an account pair.
+
+  In delta mode only the offers added to or removed from the low volume skus
+  since the previous run are exported, except on the snapshot weekday when the
+  full feed is rewritten. Sharded full feeds are split per country and feed
+  label and only the shards whose content changed are rewritten, next to a
+  manifest of every shard.
+
+  Args:
+    state: dict returned by _get_state
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+
+  Returns:
+    A feed_batching.PairExport with the export query and its destination
+  """
+  zombies_bucket = _get_zombies_bucket(mc_id, gads_id,
+                                       state['accounts_index'])
+  table_prefix = f'{state["dataset"]}.LowVolumeSkus_{mc_id}_{gads_id}'
+  current_table = f'{table_prefix}_{run_date}'
+
+  previous_table = _get_previous_table(state, table_prefix, run_date)
+
+  extension = state['file_extension']
+  if previous_table:
+    gcs_destination = (f'{zombies_bucket}/low_volume_skus_{mc_id}_{gads_id}'
+                       f'_delta_{run_date}_*{extension}')
+    query = state['delta_query'].safe_substitute(
+        gcs_destination=gcs_destination, table=current_table,
+        previous_table=previous_table)
+  elif state['feed_sharding'] != _NO_FEED_SHARDING:
+    gcs_destination = f'{zombies_bucket}/low_volume_skus_{mc_id}_{gads_id}'
+    query = state['sharded_query'].safe_substitute(
+        gcs_prefix=gcs_destination, table=current_table, mc_id=mc_id,
+        gads_id=gads_id, run_date=run_date)
+  else:
+    gcs_destination = (f'{zombies_bucket}/low_volume_skus_{mc_id}_{gads_id}'
+                       f'_*{extension}')
+    query = state['full_query'].safe_substitute(
+        gcs_destination=gcs_destination, table=current_table)
+  return feed_batching.PairExport(
+      mc_id, gads_id, _DELTA_FEED_MODE if previous_table else _FULL_FEED_MODE,
+      gcs_destination, query)
+
+def _batch_export(state, tracer, mc_id, gads_id, run_date, context):
+  """Exports the account pairs completed in the batch window of the event.
+
+  The completion is recorded. The first invocation of the window coordinates
+  it: it waits for the end of the window, or for every configured pair to
+  report, and submits one script exporting every pair of the window, logging
+  which statement of the script covers which pair. The other invocations wait
+  for the script to be submitted and check that it covers their pair.
+
+  Args:
+    state: dict returned by _get_state
+    tracer: spans.Tracer of the invocation
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+    context: google.cloud.functions.Context of the event, its timestamp
+    places the event in a batch window
+
+  Returns:
+    True if the pair is exported by the batch script, False if it was recorded
+    too late for it, or the script was not submitted, and must be exported on
+    its own
+  """
+  # Unknown pairs are rejected before they can join a batch.
+  _get_zombies_bucket(mc_id, gads_id, state['accounts_index'])
+  client = state['client']
+  events_table = state['batch_events_table']
+  window_seconds = state['batch_window_seconds']
+  published = (datetime_helpers.from_rfc3339(context.timestamp).timestamp()
+               if context and getattr(context, 'timestamp', None)
+               else time.time())
+  window = feed_batching.get_batch_window(published, window_seconds)
+
+  window_end = (window + 1) * window_seconds
+  job_id = f'zombies_feed_batch_{run_date}_{window}'
+
+  feed_batching.record_event(client, events_table, run_date, mc_id, gads_id,
+                             window)
+  if not feed_batching.claim_window(client, job_id):
+    with tracer.span('batch_wait', batch_window=window):
+      job = feed_batching.wait_for_script(client, job_id, window_end)
+    return _is_batched(job, mc_id, gads_id, run_date, window)
+
+  with tracer.span('batch_wait', batch_window=window, coordinator=True):
+    feed_batching.wait_for_window(client, events_table, run_date, window_end,
+                                  len(state['accounts_index']))
+
+  exports = [_get_pair_export(state, pair_mc_id, pair_gads_id, run_date)
+             for pair_mc_id, pair_gads_id in feed_batching.get_window_pairs(
+                 client, events_table, run_date, window)]
+  script, statements = feed_batching.build_script(exports)
+  job = feed_batching.submit_script(client, script, job_id)
+  if job is None:
+    # A redelivered event of the coordinator, the script is already running.
+    return _is_batched(client.get_job(job_id), mc_id, gads_id, run_date,
+                       window)
+
+  print(json.dumps({
+      'job_id': job.job_id,
+      'statements': [{
+          'statement': statement.index,
+          'start_line': statement.start_line,
+          'end_line': statement.end_line,
+          'mc_id': statement.export.mc_id,
+          'gads_id': statement.export.gads_id,
+          'feed_mode': statement.export.feed_mode,
+          'gcs_destination': statement.export.gcs_destination,
+      } for statement in statements],
+  }))
+
+  if state['track_export_jobs']:
+    _track_batch_job(state, job, statements, run_date)
+  return _is_batched(job, mc_id, gads_id, run_date, window)
+
+def _is_batched(job, mc_id, gads_id, run_date, window):
+  """Checks whether the batch script of a window exports an account pair.
+
+  Args:
+    job: bigquery.QueryJob of the batch script, None if it was not submitted
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+    window: int identifying the batch window
+
+  Returns:
+    True if the script exports the pair
+  """
+  if job is None:
+    print(f'Batch {run_date} {window} not submitted, exporting {mc_id} '
+          f'{gads_id} alone')
+    return False
+  if (mc_id, gads_id) not in feed_batching.get_script_pairs(job):
+    print(f'{mc_id} {gads_id} recorded after batch {run_date} {window} was '
+          'submitted, exporting it alone')
+    return False
+  print(f'Batch {run_date} {window} exports {mc_id} {gads_id}')
+  return True
+
+def _track_batch_job(state, job, statements, run_date):
+  """Waits for the batch script and records the statistics of its exports.
+
+  Args:
+    state: dict returned by _get_state
+    job: bigquery.QueryJob running the batch script
+    statements: list of feed_batching.Statement of the script
+    run_date: string representing the run date in YYYYMMDD format
+  """
+  if not export_tracking.wait_for_job(job, state['export_timeout_seconds']):
+    print(f'Batch job {job.job_id} still running after '
+          f'{state["export_timeout_seconds"]} seconds')
+    return
+  for child, statement in feed_batching.get_statement_jobs(
+      state['client'], job, statements):
+    if child.statement_type != 'EXPORT_DATA':
+      continue
+    record = export_tracking.get_run_record(
+        child, statement.export.mc_id, statement.export.gads_id, run_date,
+        statement.export.feed_mode, statement.export.gcs_destination)
+    # The invocation submitting the script records the spans of every pair.
+    pair_tracer = state['tracer'].with_attributes(
+        run_date=run_date, mc_id=statement.export.mc_id,
+        gads_id=statement.export.gads_id)
+    _record_job(pair_tracer, child, feed_mode=statement.export.feed_mode,
+                rows_exported=record['rows_exported'], batch_job_id=job.job_id)
+    print(json.dumps(dict(record, statement=statement.index)))
+    if state['run_sink']:
+      state['run_sink'].write(record)
+
+def _track_export_job(state, tracer, job, mc_id, gads_id, run_date, feed_mode,
+                      gcs_destination):
+  """Waits for the export job and records its statistics.
+
+  The job is polled for at most export_timeout_seconds, its statistics are
+  then written as a feed run to the run sink and recorded as a span.
+
+  Args:
+    state: dict returned by _get_state
+    tracer: spans.Tracer of the invocation
+    job: bigquery.QueryJob running the EXPORT DATA statement
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+    feed_mode: string representing the feed mode of the export
+    gcs_destination: string representing the wildcard gcs uri of the files
+  """
+  if not export_tracking.wait_for_job(job, state['export_timeout_seconds']):
+    print(f'Export job {job.job_id} still running after '
+          f'{state["export_timeout_seconds"]} seconds')
+  record = export_tracking.get_run_record(job, mc_id, gads_id, run_date,
+                                          feed_mode, gcs_destination)
+  _record_job(tracer, job, feed_mode=feed_mode,
+              rows_exported=record['rows_exported'])
+  print(json.dumps(record))
+  if state['run_sink']:
+    state['run_sink'].write(record)
+
+def _get_state():
+  """Returns the state shared by the invocations of a function instance.
+
+  The environment configuration is parsed, the BigQuery client created and the
+  export queries rendered on the first invocation only.
+
+  Returns:
+    A dict with the configuration, the (mc, gads) to gcs url index, the
+    BigQuery client and the export query templates
+  """
+  global _state
+  if _state is None:
+    gcp_project = os.environ.get('GCP_PROJECT')
+    sql_condition = os.environ.get('ZOMBIES_SQL_CONDITION')
+    feed_label_index = os.environ.get('ZOMBIES_FEED_LABEL_INDEX')
+    location = os.environ.get('ZOMBIES_DATA_LOCATION') or None
+    # The jobs run and are looked up in the location of the dataset.
+    client = bigquery.Client(project=gcp_project, location=location)
+    runs_table = os.environ.get('ZOMBIES_FEED_RUNS_TABLE')
+    manifests_table = os.environ.get('ZOMBIES_FEED_MANIFESTS_TABLE')
+    batch_events_table = os.environ.get('ZOMBIES_FEED_BATCH_EVENTS_TABLE')
+    push_progress_table = os.environ.get('ZOMBIES_PUSH_PROGRESS_TABLE')
+    fingerprints_table = os.environ.get('ZOMBIES_INPUT_FINGERPRINTS_TABLE')
+    delivery = os.environ.get('ZOMBIES_FEED_DELIVERY', 'gcs').lower()
+    push_concurrency = int(os.environ.get('ZOMBIES_PUSH_CONCURRENCY', '8'))
+    compression = os.environ.get('ZOMBIES_FEED_COMPRESSION', 'none').lower()
+    extension = '.txt.gz' if compression == _GZIP_COMPRESSION else '.txt'
+    batch_window_seconds = int(
+        os.environ.get('ZOMBIES_FEED_BATCH_WINDOW_SECONDS', '0'))
+    max_window_seconds = feed_batching.get_max_window_seconds(
+        _FUNCTION_TIMEOUT_SECONDS)
+    if not 0 <= batch_window_seconds <= max_window_seconds:
+      raise ValueError(
+          f'ZOMBIES_FEED_BATCH_WINDOW_SECONDS {batch_window_seconds} must be '
+          f'between 0 and {max_window_seconds} to fit the '
+          f'{_FUNCTION_TIMEOUT_SECONDS}s timeout of the function')
+    _state = {
+        'dataset': f"{gcp_project}.{os.environ.get('ZOMBIES_DATASET_NAME')}",
+        'accounts_index': _load_accounts_index(
+            os.environ.get('ZOMBIES_ACCOUNTS_SHA256')),
+        'feed_mode': os.environ.get('ZOMBIES_FEED_MODE', _FULL_FEED_MODE),
+        'snapshot_weekday': int(
+            os.environ.get('ZOMBIES_FEED_SNAPSHOT_WEEKDAY', '7')),
+        'client': client,
+        'tracer': spans.get_tracer(
+            os.environ.get('ZOMBIES_SPANS_EXPORTER', spans.NO_EXPORTER),
+            os.environ.get('ZOMBIES_SPANS_JSONL'), stage='feed_generation'),
+        'run_ledger': run_ledger.get_ledger(
+            os.environ.get('ZOMBIES_RUN_LEDGER', run_ledger.BIGQUERY_LEDGER),
+            client, os.environ.get('ZOMBIES_RUN_LEDGER_SQLITE'), location),
+        'track_export_jobs': os.environ.get(
+            'ZOMBIES_TRACK_EXPORT_JOBS', 'false').lower() == 'true',
+        'export_timeout_seconds': int(
+            os.environ.get('ZOMBIES_EXPORT_TIMEOUT_SECONDS', '480')),
+        'run_sink': export_tracking.get_run_sink(
+            client,
+            f"{gcp_project}.{os.environ.get('ZOMBIES_DATASET_NAME')}.{runs_table}"
+            if runs_table else None,
+            os.environ.get('ZOMBIES_FEED_RUNS_JSONL')),
+        'batch_window_seconds': batch_window_seconds,
+        'batch_events_table': (
+            f"{gcp_project}.{os.environ.get('ZOMBIES_DATASET_NAME')}.{batch_events_table}"
+            if batch_events_table else None),
+        'delivery': delivery,
+        'feed_label_index': feed_label_index,
+        'content_api_endpoint': os.environ.get(
+            'ZOMBIES_CONTENT_API_ENDPOINT',
+            content_api_push.CONTENT_API_ENDPOINT),
+        'content_api_feed_ids': json.loads(
+            os.environ.get('ZOMBIES_CONTENT_API_FEED_IDS') or '{}'),
+        'push_batch_size': int(
+            os.environ.get('ZOMBIES_PUSH_BATCH_SIZE', '1000')),
+        'push_concurrency': push_concurrency,
+        'push_timeout_seconds': int(
+            os.environ.get('ZOMBIES_PUSH_TIMEOUT_SECONDS', '480')),
+        'push_progress_table': (
+            f"{gcp_project}.{os.environ.get('ZOMBIES_DATASET_NAME')}.{push_progress_table}"
+            if push_progress_table else None),
+        'push_session': (_get_push_session(push_concurrency)
+                         if delivery == _CONTENT_API_DELIVERY else None),
+        'full_push_query': string.Template(_build_full_push_query(
+            '${table}', '${product_table}', sql_condition)),
+        'delta_push_query': string.Template(_build_delta_push_query(
+            '${table}', '${previous_table}', '${product_table}',
+            sql_condition)),
+        'fingerprint_store': input_fingerprint.get_fingerprint_store(
+            client,
+            f"{gcp_project}.{os.environ.get('ZOMBIES_DATASET_NAME')}.{fingerprints_table}"
+            if fingerprints_table else None,
+            os.environ.get('ZOMBIES_INPUT_FINGERPRINTS_JSONL')),
+        'sources_project': os.environ.get(
+            'ZOMBIES_MERCHANT_AND_GADS_PROJECT', gcp_project),
+        'merchant_dataset': os.environ.get('ZOMBIES_MERCHANT_DATASET_NAME'),
+        'gads_dataset': os.environ.get('ZOMBIES_GADS_DATASET_NAME'),
+        'thresholds': {name: os.environ.get(name.upper())
+                       for name in input_fingerprint.THRESHOLD_VARIABLES},
+        'feed_sharding': os.environ.get(
+            'ZOMBIES_FEED_SHARDING', _NO_FEED_SHARDING).lower(),
+        'file_extension': extension,
+        'full_query': string.Template(_build_full_export_query(
+            '${gcs_destination}', '${table}', sql_condition,
+            feed_label_index, compression)),
+        'delta_query': string.Template(_build_delta_export_query(
+            '${gcs_destination}', '${table}', '${previous_table}',
+            sql_condition, feed_label_index, compression)),
+        'sharded_query': string.Template(_build_sharded_export_query(
+            '${gcs_prefix}', '${table}', '${mc_id}', '${gads_id}',
+            '${run_date}',
+            f"{gcp_project}.{os.environ.get('ZOMBIES_DATASET_NAME')}.{manifests_table}",
+            sql_condition, feed_label_index, compression, extension,
+            int(os.environ.get('ZOMBIES_FEED_SHARD_MAX_ROWS', '1000000')))),
+    }
+  return _state
+
+def _get_push_session(concurrency):
+  """Returns the HTTP session of the Content API, authorized unless the
+  endpoint is overridden by a local stand-in.
+
+  Args:
+    concurrency: int representing the number of concurrent requests
+
+  Returns:
+    A requests.Session
+  """
+  if os.environ.get('ZOMBIES_CONTENT_API_ENDPOINT'):
+    return content_api_push.get_session(concurrency)
+  import google.auth  # pylint: disable=g-import-not-at-top
+  credentials, _ = google.auth.default(
+      scopes=[content_api_push.CONTENT_API_SCOPE])
+  return content_api_push.get_session(concurrency, credentials)
+
+def _get_push_products(product_table):
+  """Returns the query of the product ids of the latest product snapshot.
+
+  Args:
+    product_table: string representing the fully qualified product_view
+
+  Returns:
+    A string representing the subquery
+  """
+  return f"""
+        SELECT DISTINCT
+          merchant_id,
+          product_id,
+          TRIM(LOWER(offer_id)) AS offer_id,
+          LOWER(target_country) AS country
+        FROM `{product_table}`
+        WHERE _DATA_DATE = _LATEST_DATE
+    """
+
+def _build_full_push_query(table, product_table, sql_condition):
+  """Builds the query of the label of every product of a run.
+
+  The products out of the low volume skus get an empty label, which clears the
+  label pushed by an earlier run, as a row dropped from a feed file would.
+
+  Args:
+    table: string representing the fully qualified LowVolumeSkus table
+    product_table: string representing the fully qualified product_view
+    sql_condition: string representing the condition to select the skus
+
+  Returns:
+    A string representing the query, ordered by product id
+  """
+  return f"""
+      WITH
+        current_run AS (
+          SELECT DISTINCT offer_id, country
+          FROM `{table}`
+          WHERE
+            {sql_condition}
+        ),
+        products AS ({_get_push_products(product_table)})
+      SELECT
+        products.merchant_id,
+        products.product_id,
+        IF(LOGICAL_OR(current_run.offer_id IS NOT NULL),
+           '{_LOW_VOLUME_SKU_LABEL}', '') AS label
+      FROM products
+      LEFT JOIN current_run
+        ON
+        products.offer_id = TRIM(LOWER(current_run.offer_id))
+        AND products.country = LOWER(current_run.country)
+      GROUP BY
+        merchant_id,
+        product_id
+      ORDER BY product_id
+    """
+
+def _build_delta_push_query(table, previous_table, product_table,
+                            sql_condition):
+  """Builds the query of the labels changed since the previous run.
+
+  Args:
+    table: string representing the fully qualified LowVolumeSkus table
+    previous_table: string representing the LowVolumeSkus table of the
+    previous run
+    product_table: string representing the fully qualified product_view
+    sql_condition: string representing the condition to select the skus
+
+  Returns:
+    A string representing the query, ordered by product id
+  """
+  return f"""
+      WITH
+        current_run AS (
+          SELECT DISTINCT offer_id, country
+          FROM `{table}`
+          WHERE
+            {sql_condition}
+        ),
+        previous_run AS (
+          SELECT DISTINCT offer_id, country
+          FROM `{previous_table}`
+          WHERE
+            {sql_condition}
+        ),
+        changes AS (
+          SELECT *, '{_LOW_VOLUME_SKU_LABEL}' AS label
+          FROM (
+            SELECT * FROM current_run
+            EXCEPT DISTINCT
+            SELECT * FROM previous_run
+          )
+          UNION ALL
+          SELECT *, '' AS label
+          FROM (
+            SELECT * FROM previous_run
+            EXCEPT DISTINCT
+            SELECT * FROM current_run
+          )
+        ),
+        products AS ({_get_push_products(product_table)})
+      SELECT DISTINCT
+        products.merchant_id,
+        products.product_id,
+        changes.label
+      FROM changes
+      INNER JOIN products
+        ON
+        products.offer_id = TRIM(LOWER(changes.offer_id))
+        AND products.country = LOWER(changes.country)
+      ORDER BY product_id
+    """
+
+def _get_export_options(compression):
+  """Returns the EXPORT DATA options of the feed files.
 
-    query = f"""
+  Args:
+    compression: string representing the compression of the files, gzip or
+    none
+
+  Returns:
+    A string with the options following the uri
+  """
+  options = "format='CSV', overwrite=true, header=true, field_delimiter='\t'"
+  if compression == _GZIP_COMPRESSION:
+    options += ", compression='GZIP'"
+  return options
+
+def _build_full_export_query(gcs_destination, table, sql_condition,
+                             feed_label_index, compression):
+  """Builds the query exporting every low volume sku of a run.
+
+  An offer listed under several feed labels has a row per feed label in the
+  LowVolumeSkus table, the feed gets a single row per offer and country.
+
+  Args:
+    gcs_destination: string representing the wildcard gcs uri of the files
+    table: string representing the fully qualified LowVolumeSkus table
+    sql_condition: string representing the condition to select the skus
+    feed_label_index: string representing the custom label index to use
+    compression: string representing the compression of the files
+
+  Returns:
+    A string representing the EXPORT DATA query
+  """
+  return f"""
+      EXPORT DATA OPTIONS(
+        uri='{gcs_destination}',
+        {_get_export_options(compression)})
+      AS
+        SELECT offer_id, MIN(item_group_id) AS item_group_id, country, '{_LOW_VOLUME_SKU_LABEL}' as custom_label_{feed_label_index}
+        FROM `{table}`
+        WHERE
+          {sql_condition}
+        GROUP BY offer_id, country
+    """
+
+def _build_delta_export_query(gcs_destination, table, previous_table,
+                              sql_condition, feed_label_index, compression):
+  """Builds the query exporting the low volume skus changed since a run.
+
+  The runs are compared by offer and country. Offers that became low volume
+  are exported with the label set and the item group of the current run,
+  offers that are no longer low volume are exported with an empty label so it
+  is cleared.
+
+  Args:
+    gcs_destination: string representing the wildcard gcs uri of the files
+    table: string representing the fully qualified LowVolumeSkus table
+    previous_table: string representing the LowVolumeSkus table of the
+    previous run
+    sql_condition: string representing the condition to select the skus
+    feed_label_index: string representing the custom label index to use
+    compression: string representing the compression of the files
+
+  Returns:
+    A string representing the EXPORT DATA query
+  """
+  return f"""
       EXPORT DATA OPTIONS(
         uri='{gcs_destination}',
-        format='CSV',
-        overwrite=true,
-        header=true,
-        field_delimiter='\t')
+        {_get_export_options(compression)})
       AS
-        SELECT DISTINCT * FROM (
-          SELECT offer_id, item_group_id, country, 'low_volume_sku' as custom_label_{ZOMBIES_FEED_LABEL_INDEX}
-          FROM `{GCP_PROJECT}.{ZOMBIES_DATASET_NAME}.LowVolumeSkus_{mc_id}_{gads_id}_{run_date}`
-          WHERE        
-            {ZOMBIES_SQL_CONDITION}
-        )
+        WITH
+          current_run AS (
+            SELECT offer_id, MIN(item_group_id) AS item_group_id, country
+            FROM `{table}`
+            WHERE
+              {sql_condition}
+            GROUP BY offer_id, country
+          ),
+          previous_run AS (
+            SELECT offer_id, MIN(item_group_id) AS item_group_id, country
+            FROM `{previous_table}`
+            WHERE
+              {sql_condition}
+            GROUP BY offer_id, country
+          )
+        SELECT
+          current_run.offer_id,
+          current_run.item_group_id,
+          current_run.country,
+          '{_LOW_VOLUME_SKU_LABEL}' as custom_label_{feed_label_index}
+        FROM current_run
+        LEFT JOIN previous_run
+          ON
+          current_run.offer_id = previous_run.offer_id
+          AND current_run.country = previous_run.country
+        WHERE previous_run.offer_id IS NULL
+        UNION ALL
+        SELECT
+          previous_run.offer_id,
+          previous_run.item_group_id,
+          previous_run.country,
+          '' as custom_label_{feed_label_index}
+        FROM previous_run
+        LEFT JOIN current_run
+          ON
+          previous_run.offer_id = current_run.offer_id
+          AND previous_run.country = current_run.country
+        WHERE current_run.offer_id IS NULL
     """
 
-    job_config = bigquery.job.QueryJobConfig()
+def _build_sharded_export_query(gcs_prefix, table, mc_id, gads_id, run_date,
+                                manifests_table, sql_condition,
+                                feed_label_index, compression, extension,
+                                shard_max_rows):
+  """Builds the script exporting the low volume skus in shards.
+
+  An offer listed under several feed labels is only exported in the partition
+  of the first one. The skus are split per country and feed label, and each
+  partition in as many shards as needed to stay under shard_max_rows rows, by
+  the remainder of the fingerprint of the offer id, taken before ABS as the
+  ABS of the smallest INT64 overflows. A shard is only rewritten when its
+  checksum differs from the one recorded in the manifest of the previous run,
+  the shards of the previous run that no longer exist are emptied. The
+  manifest of the run is recorded in the manifests table and exported as a
+  JSON lines file next to the shards.
 
-    bigquery.Client(project=GCP_PROJECT).query(query, job_config=job_config)
+  Args:
+    gcs_prefix: string representing the gcs uri prefix of the files
+    table: string representing the fully qualified LowVolumeSkus table
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+    manifests_table: string representing the fully qualified manifests table
+    sql_condition: string representing the condition to select the skus
+    feed_label_index: string representing the custom label index to use
+    compression: string representing the compression of the files
+    extension: string representing the extension of the files
+    shard_max_rows: int representing the target number of rows of a shard
 
-def _get_zombies_bucket(merchant_acc, gads_acc, accounts_config):
+  Returns:
+    A string representing the multi-statement query
+  """
+  return f"""
+      DECLARE feed_run_date DATE DEFAULT PARSE_DATE('%Y%m%d', '{run_date}');
+
+      CREATE OR REPLACE TEMP TABLE feed AS
+        SELECT
+          IFNULL(offer_id, '') AS offer_id,
+          MIN(item_group_id) AS item_group_id,
+          country,
+          MIN(IFNULL(feed_label, '')) AS feed_label
+        FROM `{table}`
+        WHERE
+          {sql_condition}
+        GROUP BY 1, 3;
+
+      CREATE OR REPLACE TEMP TABLE shards AS
+        WITH
+          partitions AS (
+            SELECT
+              country,
+              feed_label,
+              CAST(CEIL(COUNT(*) / {shard_max_rows}) AS INT64) AS shard_count
+            FROM feed
+            GROUP BY country, feed_label
+          ),
+          current_shards AS (
+            SELECT
+              feed.country,
+              feed.feed_label,
+              ABS(MOD(FARM_FINGERPRINT(feed.offer_id), partitions.shard_count)) AS shard,
+              partitions.shard_count,
+              COUNT(*) AS row_count,
+              BIT_XOR(FARM_FINGERPRINT(
+                TO_JSON_STRING(STRUCT(feed.offer_id, feed.item_group_id)))) AS checksum
+            FROM feed
+            INNER JOIN partitions
+              USING (country, feed_label)
+            GROUP BY 1, 2, 3, 4
+          ),
+          previous_shards AS (
+            SELECT country, feed_label, shard, shard_count, checksum
+            FROM `{manifests_table}`
+            WHERE
+              mc_id = '{mc_id}'
+              AND gads_id = '{gads_id}'
+              AND status != 'removed'
+              AND run_date = (
+                SELECT MAX(run_date)
+                FROM `{manifests_table}`
+                WHERE
+                  mc_id = '{mc_id}'
+                  AND gads_id = '{gads_id}'
+                  AND run_date < feed_run_date)
+          )
+        SELECT
+          country,
+          feed_label,
+          shard,
+          shard_count,
+          IFNULL(current_shards.row_count, 0) AS row_count,
+          current_shards.checksum,
+          FORMAT(
+            '{gcs_prefix}/%s/%s/part_%05d_of_%05d_*{extension}',
+            IFNULL(NULLIF(REGEXP_REPLACE(LOWER(country), r'[^a-z0-9_-]', '_'), ''), 'default'),
+            IFNULL(NULLIF(REGEXP_REPLACE(LOWER(feed_label), r'[^a-z0-9_-]', '_'), ''), 'default'),
+            shard,
+            shard_count) AS uri,
+          CASE
+            WHEN current_shards.checksum IS NULL THEN 'removed'
+            WHEN current_shards.checksum = previous_shards.checksum THEN 'unchanged'
+            ELSE 'changed'
+          END AS status
+        FROM current_shards
+        FULL OUTER JOIN previous_shards
+          USING (country, feed_label, shard, shard_count);
+
+      FOR changed_shard IN (SELECT * FROM shards WHERE status != 'unchanged') DO
+        EXECUTE IMMEDIATE FORMAT('''
+          EXPORT DATA OPTIONS(
+            uri=%T,
+            {_get_export_options(compression)})
+          AS
+            SELECT offer_id, item_group_id, country, '{_LOW_VOLUME_SKU_LABEL}' as custom_label_{feed_label_index}
+            FROM feed
+            WHERE
+              @status != 'removed'
+              AND country = @country
+              AND feed_label = @feed_label
+              AND ABS(MOD(FARM_FINGERPRINT(offer_id), @shard_count)) = @shard
+        ''', changed_shard.uri)
+        USING
+          changed_shard.status AS status,
+          changed_shard.country AS country,
+          changed_shard.feed_label AS feed_label,
+          changed_shard.shard_count AS shard_count,
+          changed_shard.shard AS shard;
+      END FOR;
+
+      INSERT INTO `{manifests_table}`
+        (run_date, mc_id, gads_id, country, feed_label, shard, shard_count,
+         uri, row_count, checksum, status)
+      SELECT
+        feed_run_date, '{mc_id}', '{gads_id}', country, feed_label, shard,
+        shard_count, uri, row_count, checksum, status
+      FROM shards;
+
+      EXPORT DATA OPTIONS(
+        uri='{gcs_prefix}/manifest_*.json',
+        format='JSON',
+        overwrite=true)
+      AS
+        SELECT
+          feed_run_date AS run_date,
+          country,
+          feed_label,
+          shard,
+          shard_count,
+          uri,
+          row_count,
+          checksum,
+          status
+        FROM shards
+        ORDER BY country, feed_label, shard_count, shard;
+    """
+
+def _get_existing_table(client, table):
+  """Checks whether a BigQuery table exists.
+
+  Args:
+    client: bigquery.Client used to look the table up
+    table: string representing the fully qualified table id
+
+  Returns:
+    The table id if the table exists, None otherwise
+  """
+  try:
+    client.get_table(table)
+  except exceptions.NotFound:
+    return None
+  return table
+
+def _load_accounts_index(accounts_sha256, config_file=_CONFIG_FILE):
+  """Loads the accounts index from the compiled configuration.
+
+  The artifact is only used when it holds the deployed accounts_table, which
+  may differ from the default of variables.tf when it is set with a tfvars
+  file or -var, the ACCOUNTS_CONFIG environment variable is parsed otherwise.
+
+  Args:
+    accounts_sha256: string representing the digest of the jsonencode of the
+    deployed accounts_table
+    config_file: string representing the path of the compiled configuration
+
+  Returns:
+    A dict from (merchant_acc, gads_acc) to gcs url
+  """
+  try:
+    with open(config_file) as f:
+      config = json.load(f)
+  except FileNotFoundError:
+    config = None
+  if (config and accounts_sha256 and
+      config.get('accounts_sha256') == accounts_sha256):
+    return {(mc, gads): gcs_url for mc, gads, gcs_url in config['accounts']}
+  if config:
+    print(f'{config_file} is stale, using ACCOUNTS_CONFIG')
+  return _get_accounts_index(json.loads(os.environ.get('ACCOUNTS_CONFIG')))
+
+def _get_accounts_index(accounts_config):
+  """Indexes the gcs url of every merchant and gads account pair.
+
+  Args:
+    accounts_config: javascript object with the configuration per each
+    merchant_acc & gads_acc pairs
+
+  Returns:
+    A dict from (merchant_acc, gads_acc) to gcs url
+  """
+  return {(line["mc"], line["gads"]): line["gcs_url"]
+          for line in accounts_config.values()}
+
+def _get_zombies_bucket(merchant_acc, gads_acc, accounts_index):
   """Extracts the right url for the merchant and gads account pair.
 
   Args:
     merchant_acc: string representing the merchant account id
     gads_acc: string representing the gads account id
-    accounts_config: javascript object with the configuration per each
-    merchant_acc & gads_acc pairs
+    accounts_index: dict from (merchant_acc, gads_acc) to gcs url, as built
+    by _get_accounts_index
 
   Returns:
     A string representing gcs url
   """
-  for index, line in accounts_config.items():
-    print(index, line)
-    if line["mc"] == merchant_acc and line["gads"] == gads_acc:
-        return line["gcs_url"]
-
-  raise Exception("No account match found in config")
+  try:
+    return accounts_index[(merchant_acc, gads_acc)]
+  except KeyError:
+    raise Exception("No account match found in config") from None
 
 def _get_date(msg):
   """Extracts the date from the message.
@@ -103,4 +1090,30 @@ def _get_date(msg):
 
   runtime = msg['runTime']
   date = datetime_helpers.from_rfc3339(runtime)
-  return date.strftime('%Y%m%d')
\ No newline at end of file
+  return date.strftime('%Y%m%d')
+
+def _get_previous_date(run_date):
+  """Computes the date of the run preceding the given one.
+
+  Args:
+    run_date: string representing a run date in YYYYMMDD format
+
+  Returns:
+    A string representing the previous day in YYYYMMDD format
+  """
+  date = datetime.datetime.strptime(run_date, '%Y%m%d')
+  return (date - datetime.timedelta(days=1)).strftime('%Y%m%d')
+
+def _is_snapshot_day(run_date, snapshot_weekday):
+  """Checks whether the full feed must be exported for the run date.
+
+  Args:
+    run_date: string representing a run date in YYYYMMDD format
+    snapshot_weekday: int representing the ISO weekday (1 is Monday) of the
+    full snapshot
+
+  Returns:
+    True if the run date falls on the snapshot weekday
+  """
+  date = datetime.datetime.strptime(run_date, '%Y%m%d')
+  return date.isoweekday() == snapshot_weekday
@@ -0,0 +1,168 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Submits every feed export once per version of its LowVolumeSkus table.
+
+A run is identified by the account pair, the run date and the last modified
+time of the LowVolumeSkus table, so a duplicate Pub/Sub delivery or a backfill
+notification of an unchanged table maps to the same run. The ledger only
+submits the export of a run when no previous attempt is running or succeeded.
+A failed attempt does not block the run, the next delivery submits a new one.
+"""
+
+import sqlite3
+import time
+from google.api_core import exceptions
+
+BIGQUERY_LEDGER = 'bigquery'
+SQLITE_LEDGER = 'sqlite'
+NO_LEDGER = 'none'
+_MAX_ATTEMPTS = 10
+
+def get_run_id(mc_id, gads_id, run_date, modified):
+  """Returns the id of a run, usable as a BigQuery job id prefix.
+
+  Args:
+    mc_id: string representing the merchant account id
+    gads_id: string representing the gads account id
+    run_date: string representing the run date in YYYYMMDD format
+    modified: datetime representing the last modified time of the
+    LowVolumeSkus table
+
+  Returns:
+    A string identifying the run
+  """
+  return (f'zombies_feed_{mc_id}_{gads_id}_{run_date}_'
+          f'{int(modified.timestamp() * 1000)}')
+
+def _is_settled(job):
+  """Tells whether an attempt is running or succeeded."""
+  return job.state != 'DONE' or not job.error_result
+
+class BigQueryJobLedger(object):
+  """Records the runs as the job ids of their exports.
+
+  BigQuery rejects a job id already used in the project, so concurrent
+  duplicates collapse into the first submission without any extra table. The
+  attempts of a run are numbered, a failed attempt is followed by the next one.
+  The jobs are looked up in the location of the dataset, outside of the US and
+  EU multi-regions BigQuery does not find them otherwise.
+  """
+
+  def __init__(self, client, max_attempts=_MAX_ATTEMPTS, location=None):
+    self._client = client
+    self._max_attempts = max_attempts
+    self._location = location
+
+  def submit(self, run_id, query, job_config=None):
+    """Submits the export of a run unless an attempt is running or succeeded.
+
+    Args:
+      run_id: string returned by get_run_id
+      query: string representing the export query
+      job_config: bigquery.QueryJobConfig of the export
+
+    Returns:
+      The bigquery.QueryJob of the export, None if the run is already done or
+      in progress
+
+    Raises:
+      RuntimeError: If every attempt of the run failed
+    """
+    for attempt in range(self._max_attempts):
+      job_id = f'{run_id}_{attempt}'
+      try:
+        return self._client.query(query, job_config=job_config, job_id=job_id)
+      except exceptions.Conflict:
+        if _is_settled(self._client.get_job(job_id,
+                                            location=self._location)):
+          return None
+    raise RuntimeError(f'{self._max_attempts} attempts of {run_id} failed')
+
+class SqliteLedger(object):
+  """Records the runs and their latest job in a local SQLite database.
+
+  Used for local runs and tests, the claims of concurrent processes are
+  serialized by the database lock.
+  """
+
+  def __init__(self, client, path, location=None):
+    self._client = client
+    self._path = path
+    self._location = location
+    conn = sqlite3.connect(self._path, timeout=60)
+    conn.execute('CREATE TABLE IF NOT EXISTS runs ('
+                 'run_id TEXT PRIMARY KEY, job_id TEXT, attempts INTEGER, '
+                 'submitted REAL)')
+    conn.close()
+
+  def submit(self, run_id, query, job_config=None):
+    """Submits the export of a run unless an attempt is running or succeeded.
+
+    Args:
+      run_id: string returned by get_run_id
+      query: string representing the export query
+      job_config: bigquery.QueryJobConfig of the export
+
+    Returns:
+      The bigquery.QueryJob of the export, None if the run is already done or
+      in progress
+    """
+    conn = sqlite3.connect(self._path, timeout=60, isolation_level=None)
+    try:
+      conn.execute('BEGIN IMMEDIATE')
+      row = conn.execute('SELECT job_id, attempts FROM runs WHERE run_id = ?',
+                         (run_id,)).fetchone()
+      if row and _is_settled(self._client.get_job(row[0],
+                                                  location=self._location)):
+        conn.execute('ROLLBACK')
+        return None
+      attempts = row[1] + 1 if row else 1
+      job = self._client.query(query, job_config=job_config,
+                               job_id=f'{run_id}_{attempts - 1}')
+      conn.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                   (run_id, job.job_id, attempts, time.time()))
+      conn.execute('COMMIT')
+      return job
+    finally:
+      if conn.in_transaction:
+        conn.execute('ROLLBACK')
+      conn.close()
+
+def get_ledger(kind, client, sqlite_path=None, location=None):
+  """Returns the configured run ledger.
+
+  Args:
+    kind: string representing the ledger, bigquery, sqlite or none
+    client: bigquery.Client submitting the exports
+    sqlite_path: string representing the database of the sqlite ledger
+    location: string representing the location of the dataset the exports
+    run in, the default location of the client if None
+
+  Returns:
+    A ledger with a submit(run_id, query, job_config) method, None when the
+    exports are not deduplicated
+
+  Raises:
+    ValueError: If the ledger is unknown
+  """
+  kind = (kind or BIGQUERY_LEDGER).lower()
+  if kind == BIGQUERY_LEDGER:
+    return BigQueryJobLedger(client, location=location)
+  if kind == SQLITE_LEDGER:
+    return SqliteLedger(client, sqlite_path, location)
+  if kind == NO_LEDGER:
+    return None
+  raise ValueError(f'Unknown run ledger {kind}')
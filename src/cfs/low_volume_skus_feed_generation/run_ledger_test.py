@@ -0,0 +1,110 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Tests of the run ledgers against an in-memory BigQuery client."""
+
+import datetime
+import pytest
+from google.api_core import exceptions
+import run_ledger
+
+_RUN_ID = 'zombies_feed_1234_5678_20240101_1704088800000'
+
+class _FakeJob(object):
+  """The state of a submitted job."""
+
+  def __init__(self, job_id):
+    self.job_id = job_id
+    self.state = 'RUNNING'
+    self.error_result = None
+
+  def fail(self):
+    self.state = 'DONE'
+    self.error_result = {'reason': 'invalidQuery'}
+
+class _FakeClient(object):
+  """Rejects the job ids already used, as BigQuery does."""
+
+  def __init__(self):
+    self.jobs = {}
+    self.locations = []
+
+  def query(self, query, job_config=None, job_id=None):
+    del query, job_config
+    if job_id in self.jobs:
+      raise exceptions.Conflict(f'Already Exists: Job {job_id}')
+    self.jobs[job_id] = _FakeJob(job_id)
+    return self.jobs[job_id]
+
+  def get_job(self, job_id, location=None):
+    self.locations.append(location)
+    return self.jobs[job_id]
+
+@pytest.fixture(name='client')
+def _client():
+  return _FakeClient()
+
+def _get_ledger(kind, client, tmp_path):
+  return run_ledger.get_ledger(kind, client, str(tmp_path / 'ledger.db'),
+                               'europe-west1')
+
+def test_run_id_changes_with_the_table_last_modified_time():
+  modified = datetime.datetime(2024, 1, 1, 6,
+                               tzinfo=datetime.timezone.utc)
+
+  run_id = run_ledger.get_run_id('1234', '5678', '20240101', modified)
+
+  assert run_id == _RUN_ID
+  assert run_id == run_ledger.get_run_id('1234', '5678', '20240101',
+                                         modified)
+  assert run_id != run_ledger.get_run_id(
+      '1234', '5678', '20240101', modified + datetime.timedelta(seconds=1))
+
+@pytest.mark.parametrize(
+    'kind', [run_ledger.BIGQUERY_LEDGER, run_ledger.SQLITE_LEDGER])
+def test_duplicate_of_a_running_or_succeeded_run_is_not_submitted(
+    client, tmp_path, kind):
+  ledger = _get_ledger(kind, client, tmp_path)
+
+  job = ledger.submit(_RUN_ID, 'EXPORT DATA')
+  running = ledger.submit(_RUN_ID, 'EXPORT DATA')
+  job.state = 'DONE'
+  succeeded = ledger.submit(_RUN_ID, 'EXPORT DATA')
+
+  assert job.job_id == f'{_RUN_ID}_0'
+  assert (running, succeeded) == (None, None)
+  assert list(client.jobs) == [f'{_RUN_ID}_0']
+  assert set(client.locations) == {'europe-west1'}
+
+@pytest.mark.parametrize(
+    'kind', [run_ledger.BIGQUERY_LEDGER, run_ledger.SQLITE_LEDGER])
+def test_failed_attempt_is_followed_by_the_next_one(client, tmp_path, kind):
+  ledger = _get_ledger(kind, client, tmp_path)
+
+  ledger.submit(_RUN_ID, 'EXPORT DATA').fail()
+  retry = ledger.submit(_RUN_ID, 'EXPORT DATA')
+  duplicate = ledger.submit(_RUN_ID, 'EXPORT DATA')
+
+  assert retry.job_id == f'{_RUN_ID}_1'
+  assert duplicate is None
+  assert list(client.jobs) == [f'{_RUN_ID}_0', f'{_RUN_ID}_1']
+
+def test_bigquery_ledger_gives_up_after_its_attempts(client):
+  ledger = run_ledger.BigQueryJobLedger(client, max_attempts=2)
+  ledger.submit(_RUN_ID, 'EXPORT DATA').fail()
+  ledger.submit(_RUN_ID, 'EXPORT DATA').fail()
+
+  with pytest.raises(RuntimeError):
+    ledger.submit(_RUN_ID, 'EXPORT DATA')
@@ -0,0 +1,170 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# -*- coding: utf-8 -*-
+"""Records timing spans of the pipeline stages.
+
+A span is a named interval with attributes: the latency of an API call, the
+duration and bytes processed of a BigQuery job, the rows classified as low
+volume for an account pair. The spans carry the run_date, mc_id and gads_id
+attributes they belong to so src/tools/span_report.py can rebuild the
+critical path of every pair. They are dropped unless an exporter is chosen,
+one writing JSON lines or one handing them to OpenTelemetry when its SDK is
+installed and configured.
+"""
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+JSONL_EXPORTER = 'jsonl'
+OPENTELEMETRY_EXPORTER = 'otel'
+NO_EXPORTER = 'none'
+
+class Span(object):
+  """A span being recorded, its attributes can be set until it ends."""
+
+  def __init__(self, name, start, attributes):
+    self.name = name
+    self.start = start
+    self.end = None
+    self.status = 'ok'
+    self.attributes = attributes
+
+  def set(self, **attributes):
+    self.attributes.update(attributes)
+
+  def to_record(self):
+    return {
+        'span': self.name,
+        'start': self.start,
+        'end': self.end,
+        'duration_ms': int(round((self.end - self.start) * 1000)),
+        'status': self.status,
+        'attributes': self.attributes,
+    }
+
+class Tracer(object):
+  """Creates spans and hands them to an exporter when they end."""
+
+  def __init__(self, exporter, attributes=None, clock=time.time):
+    self._exporter = exporter
+    self._attributes = dict(attributes or {})
+    self._clock = clock
+
+  def with_attributes(self, **attributes):
+    """Returns a tracer adding attributes to every span it creates."""
+    return Tracer(self._exporter, dict(self._attributes, **attributes),
+                  self._clock)
+
+  @contextlib.contextmanager
+  def span(self, name, **attributes):
+    """Times the enclosed block, an exception marks the span as an error."""
+    span = Span(name, self._clock(), dict(self._attributes, **attributes))
+    try:
+      yield span
+    except Exception as e:
+      span.status = 'error'
+      span.set(error=str(e))
+      raise
+    finally:
+      span.end = self._clock()
+      self._exporter.export(span.to_record())
+
+  def record(self, name, start, end, status='ok', **attributes):
+    """Records a span whose bounds were measured elsewhere, e.g. a job.
+
+    Args:
+      name: string representing the name of the span
+      start: float representing the start in seconds since the epoch
+      end: float representing the end in seconds since the epoch
+      status: string representing the outcome, ok or error
+      **attributes: attributes of the span
+    """
+    if start is None or end is None:
+      return
+    span = Span(name, start, dict(self._attributes, **attributes))
+    span.end = end
+    span.status = status
+    self._exporter.export(span.to_record())
+
+class JsonlExporter(object):
+  """Writes every span as a JSON line, to a file or to stdout."""
+
+  def __init__(self, path=None):
+    self._path = path
+    self._lock = threading.Lock()
+
+  def export(self, record):
+    line = json.dumps(record, default=str) + '\n'
+    with self._lock:
+      if self._path:
+        with open(self._path, 'a') as sink:
+          sink.write(line)
+      else:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+class OpenTelemetryExporter(object):
+  """Creates an OpenTelemetry span per record.
+
+  The spans go through the global tracer provider, the application sets the
+  OpenTelemetry SDK and its exporters up, e.g. with opentelemetry-instrument.
+  """
+
+  def __init__(self):
+    from opentelemetry import trace  # pylint: disable=g-import-not-at-top
+    self._trace = trace
+    self._tracer = trace.get_tracer('low_volume_skus')
+
+  def export(self, record):
+    attributes = {key: value for key, value in record['attributes'].items()
+                  if isinstance(value, (bool, int, float, str))}
+    span = self._tracer.start_span(record['span'],
+                                   start_time=int(record['start'] * 1e9),
+                                   attributes=attributes)
+    if record['status'] == 'error':
+      span.set_status(self._trace.Status(self._trace.StatusCode.ERROR))
+    span.end(end_time=int(record['end'] * 1e9))
+
+class _NoExporter(object):
+
+  def export(self, record):
+    pass
+
+def get_tracer(exporter, path=None, **attributes):
+  """Returns a tracer using the configured exporter.
+
+  Args:
+    exporter: string representing the exporter, jsonl, otel or none, none
+    when not set
+    path: string representing the JSON lines file, stdout when not set
+    **attributes: attributes added to every span
+
+  Returns:
+    A Tracer
+
+  Raises:
+    ValueError: If the exporter is unknown
+  """
+  exporter = (exporter or NO_EXPORTER).lower()
+  if exporter == JSONL_EXPORTER:
+    return Tracer(JsonlExporter(path), attributes)
+  if exporter == OPENTELEMETRY_EXPORTER:
+    return Tracer(OpenTelemetryExporter(), attributes)
+  if exporter == NO_EXPORTER:
+    return Tracer(_NoExporter(), attributes)
+  raise ValueError(f'Unknown spans exporter {exporter}')
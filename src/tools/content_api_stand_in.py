@@ -0,0 +1,200 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Runs the Content API label push against a local stand-in server.
+
+The stand-in answers products.custombatch requests, throttles a share of the
+requests and entries with quota errors, rejects the entries of the invalid
+product ids for good and records the labels it received. The
+push is interrupted after some batches and resumed from its progress file, then
+every label is checked, e.g.:
+
+  python src/tools/content_api_stand_in.py --updates 100000 --concurrency 8
+
+`serve` only starts the stand-in, to point the Cloud Function at it with the
+ZOMBIES_CONTENT_API_ENDPOINT environment variable.
+"""
+
+import argparse
+import http.server
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+_FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'cfs', 'low_volume_skus_feed_generation')
+sys.path.insert(0, _FUNCTION_DIR)
+
+import content_api_push  # pylint: disable=g-import-not-at-top,wrong-import-position
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+  """Content API stand-in storing the custom labels per product."""
+
+  def __init__(self, address, error_rate: float, seed: int = 0,
+               invalid_ids: Iterable[str] = ()):
+    super().__init__(address, _Handler)
+    self.error_rate = error_rate
+    self.invalid_ids = set(invalid_ids)
+    self.labels = {}  # type: Dict[Tuple[int, str], Dict[str, str]]
+    self.requests = 0
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def throttle(self) -> bool:
+    with self._lock:
+      return self._random.random() < self.error_rate
+
+  def record(self, entry) -> None:
+    with self._lock:
+      self.labels.setdefault(
+          (entry['merchantId'], entry['productId']), {}).update(
+              entry['product'])
+
+  @property
+  def endpoint(self) -> str:
+    return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  """Handles the POST /products/batch requests."""
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    server = self.server
+    with server._lock:  # pylint: disable=protected-access
+      server.requests += 1
+    body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+    if not self.path.endswith('/products/batch'):
+      self._reply(404, {'error': {'code': 404, 'message': self.path}})
+      return
+    if server.throttle():
+      self._reply(429, {'error': {'code': 429, 'message': 'Quota exceeded'}})
+      return
+    entries = []
+    for entry in body['entries']:
+      if entry['productId'] in server.invalid_ids:
+        entries.append({'batchId': entry['batchId'], 'errors': {
+            'code': 400,
+            'errors': [{'reason': 'invalid', 'message': 'Invalid product'}]}})
+        continue
+      if server.throttle():
+        entries.append({'batchId': entry['batchId'], 'errors': {
+            'code': 429,
+            'errors': [{'reason': 'quotaExceeded', 'message': 'Quota'}]}})
+        continue
+      server.record(entry)
+      entries.append({'batchId': entry['batchId'],
+                      'product': {'id': entry['productId']}})
+    self._reply(200, {'kind': 'content#productsCustomBatchResponse',
+                      'entries': entries})
+
+  def _reply(self, status: int, payload) -> None:
+    data = json.dumps(payload).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, *unused_args):
+    pass
+
+
+def _get_updates(updates: int):
+  """Yields label updates in product id order."""
+  for i in range(updates):
+    yield content_api_push.LabelUpdate(
+        111111111, f'online:en:US:sku_{i:09d}',
+        'low_volume_sku' if i % 3 else '')
+
+
+class _InterruptedClock(object):
+  """Monotonic clock jumping past the deadline after some batches."""
+
+  def __init__(self, batches: int):
+    self._calls = 0
+    self._batches = batches
+
+  def __call__(self) -> float:
+    self._calls += 1
+    # The first call sets the deadline.
+    return float('inf') if self._calls > self._batches + 1 else 0.0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('command', nargs='?', choices=('check', 'serve'),
+                      default='check')
+  parser.add_argument('--port', type=int, default=0,
+                      help='Port of the stand-in, any free port by default.')
+  parser.add_argument('--updates', type=int, default=10000,
+                      help='Number of label updates to push.')
+  parser.add_argument('--batch_size', type=int, default=1000,
+                      help='Updates per custombatch request.')
+  parser.add_argument('--concurrency', type=int, default=8,
+                      help='Concurrent custombatch requests.')
+  parser.add_argument('--error_rate', type=float, default=0.05,
+                      help='Share of the requests and entries throttled.')
+  parser.add_argument('--interrupt_after', type=int, default=3,
+                      help='Batches sent before the push is interrupted.')
+  args = parser.parse_args(argv)
+
+  server = StandInServer(('127.0.0.1', args.port), args.error_rate)
+  if args.command == 'serve':
+    print(f'Serving the Content API stand-in on {server.endpoint}')
+    server.serve_forever()
+    return
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  session = content_api_push.get_session(args.concurrency)
+  pusher = content_api_push.ContentApiPusher(
+      session, 4, endpoint=server.endpoint, sleep=lambda seconds: None)
+  with tempfile.TemporaryDirectory() as progress_dir:
+    progress = content_api_push.JsonlProgressStore(
+        os.path.join(progress_dir, 'progress.jsonl'), {'run_date': 'check'})
+    start = time.perf_counter()
+    interrupted = pusher.push(
+        content_api_push.get_batches(_get_updates(args.updates),
+                                     args.batch_size),
+        args.concurrency, progress, timeout_seconds=1,
+        clock=_InterruptedClock(args.interrupt_after))
+    resumed = pusher.push(
+        content_api_push.get_batches(_get_updates(args.updates),
+                                     args.batch_size),
+        args.concurrency, progress)
+    seconds = time.perf_counter() - start
+  server.shutdown()
+
+  print(f'interrupted: {interrupted}')
+  print(f'resumed: {resumed}')
+  print(f'{server.requests} requests in {seconds:.3f}s, '
+        f'{args.updates / seconds:.0f} updates/s')
+  wrong = [update.product_id for update in _get_updates(args.updates)
+           if server.labels.get((update.merchant_id, update.product_id))
+           != {'customLabel4': update.label}]
+  if interrupted.complete or not resumed.complete or resumed.failed or wrong:
+    print(f'{len(wrong)} products without their label, e.g. {wrong[:5]}')
+    raise SystemExit(1)
+  print(f'{args.updates} labels received')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,123 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Measures the per invocation overhead of the feed generation function.
+
+The BigQuery client is replaced by a fake one so only the work done by the
+function itself is measured, e.g.:
+
+  python src/tools/feed_generation_benchmark.py --pairs 500 --invocations 1000
+"""
+
+import argparse
+import base64
+import json
+import os
+import statistics
+import sys
+import time
+
+_FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'cfs', 'low_volume_skus_feed_generation')
+sys.path.insert(0, _FUNCTION_DIR)
+
+import main  # pylint: disable=g-import-not-at-top,wrong-import-position
+
+
+class FakeBigQueryClient(object):
+  """Stand-in for bigquery.Client recording the submitted queries."""
+
+  def __init__(self, project=None, location=None):
+    self.project = project
+    self.location = location
+    self.queries = []
+
+  def query(self, query, job_config=None):
+    self.queries.append(query)
+
+  def get_table(self, table):
+    raise main.exceptions.NotFound(table)
+
+
+def _get_accounts_config(pairs: int):
+  """Returns an ACCOUNTS_CONFIG value with the given number of pairs."""
+  return {str(i): {'mc': str(100000000 + i), 'gads': str(200000000 + i),
+                   'gcs_url': f'gs://zombies-bucket-{i}'}
+          for i in range(pairs)}
+
+
+def _get_event(mc: str, gads: str):
+  """Returns a Pub/Sub event as sent on scheduled query completion."""
+  msg = {
+      'params': {
+          'destination_table_name_template':
+              f'LowVolumeSkus_{mc}_{gads}_{{run_time|"%Y%m%d"}}'
+      },
+      'runTime': '2023-06-01T03:00:00Z',
+  }
+  return {'data': base64.b64encode(json.dumps(msg).encode('utf-8'))}
+
+
+def _run(invocations: int, events, cold: bool):
+  """Invokes the function and returns the latency of every invocation."""
+  latencies = []
+  for i in range(invocations):
+    if cold:
+      main._state = None  # pylint: disable=protected-access
+    event = events[i % len(events)]
+    start = time.perf_counter()
+    main.trigger_job(event, None)
+    latencies.append(time.perf_counter() - start)
+  return latencies
+
+
+def _print_latencies(name: str, latencies):
+  latencies = sorted(latencies)
+  p95 = latencies[int(len(latencies) * 0.95) - 1]
+  print(f'{name}\tmean={statistics.mean(latencies) * 1e6:.1f}us\t'
+        f'p50={statistics.median(latencies) * 1e6:.1f}us\t'
+        f'p95={p95 * 1e6:.1f}us')
+
+
+def main_benchmark(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--pairs', type=int, default=500,
+                      help='Number of account pairs in ACCOUNTS_CONFIG.')
+  parser.add_argument('--invocations', type=int, default=1000,
+                      help='Number of invocations per scenario.')
+  args = parser.parse_args(argv)
+
+  accounts_config = _get_accounts_config(args.pairs)
+  os.environ.update({
+      'GCP_PROJECT': 'zombies-project',
+      'ZOMBIES_DATASET_NAME': 'zombies',
+      'ACCOUNTS_CONFIG': json.dumps(accounts_config),
+      'ZOMBIES_SQL_CONDITION': 'offer_id_clicks = 0',
+      'ZOMBIES_FEED_LABEL_INDEX': '4',
+      # The spans would be printed on every invocation.
+      'ZOMBIES_SPANS_EXPORTER': 'none',
+  })
+  main.bigquery.Client = FakeBigQueryClient
+  events = [_get_event(line['mc'], line['gads'])
+            for line in accounts_config.values()]
+
+  print(f'{args.pairs} account pairs, {args.invocations} invocations')
+  _print_latencies('cold', _run(args.invocations, events, cold=True))
+  _print_latencies('warm', _run(args.invocations, events, cold=False))
+
+
+if __name__ == '__main__':
+  main_benchmark()
@@ -0,0 +1,503 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Staggers the start of the low volume skus queries under a slot budget.
+
+Every account pair runs its scheduled query at zombies_schedule, so all the
+31 days scoring queries compete for the slots of the project at once. The
+planner estimates the cost of the query of every pair from its past runs,
+taken from the scheduled_query spans or from the BigQuery jobs of the
+project, or from the size of its source tables, and delays the pairs by whole
+steps of minutes so that at most --concurrency queries, or queries averaging
+at most --slots slots, run at the same time.
+
+The strategies are compared by replaying the recorded runs of every run date
+on a model of the budget: a query progresses at its recorded speed, the
+queries beyond --concurrency wait in a queue, and --slots are shared fairly
+once the running queries average more. The offsets of --strategy are written
+as the zombies_schedule_offsets variable, e.g.:
+
+  python src/tools/schedule_planner.py --spans zombies_spans.jsonl \
+      --concurrency 20 --output zombies_schedule.auto.tfvars.json
+  python src/tools/schedule_planner.py --jobs_days 14 --table_sizes \
+      --slots 2000
+"""
+
+import argparse
+import collections
+import json
+import math
+import os
+import re
+import statistics
+import sys
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import span_report
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bq_transfers'))
+import zombies_config  # pylint: disable=g-import-not-at-top,wrong-import-position
+
+SIMULTANEOUS = 'simultaneous'  # All the queries start at zombies_schedule.
+ROUND_ROBIN = 'round_robin'  # Waves of pairs assumed to cost the same.
+# Waves of pairs ordered by estimated cost, the longest first shortens the
+# makespan and the shortest first the median completion.
+LONGEST_FIRST = 'longest_first'
+SHORTEST_FIRST = 'shortest_first'
+STRATEGIES = (SIMULTANEOUS, ROUND_ROBIN, LONGEST_FIRST, SHORTEST_FIRST)
+# Same pattern as the zombies_schedule_time local of bq_scheduled_query.tf.
+_SCHEDULE_RE = re.compile(r'^(.* )(\d{2}):(\d{2})$')
+_TABLE_RE = re.compile(r'^LowVolumeSkus_(\d+)_(\d+)_(\d{8})$')
+# Cost of a pair when neither its runs nor its tables are known.
+_DEFAULT_SECONDS = 600.0
+# Rough scan speed of the query when no run at all is known.
+_DEFAULT_BYTES_PER_SECOND = 64 * 2**20
+_EPSILON = 1e-9
+
+Pair = Tuple[str, str]
+
+
+class Run(NamedTuple):
+  """A recorded run of the low volume skus query of a pair."""
+  run_date: str
+  mc: str
+  gads: str
+  seconds: float
+  slot_seconds: Optional[float]
+
+
+class Cost(NamedTuple):
+  """Estimated duration and average slots of the query of a pair."""
+  seconds: float
+  slots: float
+  source: str  # history, table_size, median or default.
+
+
+class Simulation(NamedTuple):
+  """Replay of a run date with the offsets of a strategy."""
+  makespan: float
+  completions: Dict[Pair, float]  # Seconds after zombies_schedule.
+  stretches: Dict[Pair, float]  # Simulated over recorded duration.
+
+
+def get_span_runs(records: List[dict]) -> List[Run]:
+  """Returns the scheduled query runs of span records, the last one per date.
+
+  Args:
+    records: Span records as read by span_report.read_spans.
+  Returns:
+    The runs without slot statistics, the spans do not carry them.
+  """
+  latest = {}
+  for record in records:
+    attributes = record.get('attributes', {})
+    if record['span'] != 'scheduled_query' or not attributes.get('mc_id'):
+      continue
+    key = (attributes.get('run_date'), str(attributes['mc_id']),
+           str(attributes.get('gads_id')))
+    if key not in latest or latest[key]['end'] < record['end']:
+      latest[key] = record
+  return [Run(*key, record['end'] - record['start'], None)
+          for key, record in latest.items()]
+
+
+def fetch_job_runs(project: str, location: str, days: int,
+                   client=None) -> List[Run]:
+  """Fetches the runs of the LowVolumeSkus tables from the project jobs.
+
+  Args:
+    project: Project running the scheduled queries.
+    location: BigQuery location of the zombies dataset, e.g. EU.
+    days: Number of past days to fetch.
+    client: bigquery.Client to use, created when not given.
+  Returns:
+    The last successful run of every pair and run date.
+  """
+  if client is None:
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    client = bigquery.Client(project=project)
+  query = f"""
+      SELECT
+        destination_table.table_id AS table_id,
+        TIMESTAMP_DIFF(end_time, start_time, MILLISECOND) / 1000 AS seconds,
+        total_slot_ms / 1000 AS slot_seconds
+      FROM
+        `{project}`.`region-{location.lower()}`.INFORMATION_SCHEMA.JOBS_BY_PROJECT
+      WHERE
+        creation_time >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(days)} DAY)
+        AND job_type = 'QUERY'
+        AND state = 'DONE'
+        AND error_result IS NULL
+        AND STARTS_WITH(destination_table.table_id, 'LowVolumeSkus_')
+      ORDER BY
+        end_time
+  """
+  latest = {}
+  for row in client.query(query).result():
+    match = _TABLE_RE.match(row['table_id'] or '')
+    if match:
+      mc, gads, run_date = match.groups()
+      latest[(run_date, mc, gads)] = Run(run_date, mc, gads, row['seconds'],
+                                         row['slot_seconds'])
+  return list(latest.values())
+
+
+def fetch_table_bytes(variables: Dict[str, object], pairs: List[Pair],
+                      client=None) -> Dict[Pair, int]:
+  """Fetches the size of the Merchant Center and Google Ads tables of pairs.
+
+  Args:
+    variables: Variables of the compiled zombies configuration.
+    pairs: List of (merchant id, Google Ads customer id) pairs.
+    client: bigquery.Client to use, created when not given.
+  Returns:
+    The bytes of the Products and ShoppingProductStats tables of every pair.
+  """
+  project = variables['gcp_merchant_and_gads_dataset_project']
+  if client is None:
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    client = bigquery.Client(project=variables['gcp_project'])
+  sizes = {}
+  for dataset in (variables['merchant_dataset_name'],
+                  variables['gads_dataset_name']):
+    rows = client.query(
+        f'SELECT table_id, size_bytes FROM `{project}.{dataset}.__TABLES__`'
+    ).result()
+    sizes.update((row['table_id'], row['size_bytes']) for row in rows)
+  return {(mc, gads): sizes.get(f'Products_{mc}', 0) +
+                     sizes.get(f'ads_ShoppingProductStats_{gads}', 0)
+          for mc, gads in pairs
+          if f'Products_{mc}' in sizes
+          or f'ads_ShoppingProductStats_{gads}' in sizes}
+
+
+def _get_slots(run: Run) -> Optional[float]:
+  if run.slot_seconds is None or run.seconds <= 0:
+    return None
+  return max(run.slot_seconds / run.seconds, _EPSILON)
+
+
+def estimate_costs(pairs: List[Pair], runs: Iterable[Run],
+                   table_bytes: Optional[Dict[Pair, int]] = None
+                   ) -> Dict[Pair, Cost]:
+  """Estimates the cost of the query of every pair.
+
+  A pair with past runs costs its median run. The others are scaled from
+  their table sizes at the median seconds per byte of the pairs with runs, or
+  get the median cost of the pairs with runs.
+
+  Args:
+    pairs: List of (merchant id, Google Ads customer id) pairs.
+    runs: Recorded runs of the queries.
+    table_bytes: Size of the source tables of the pairs, if fetched.
+  Returns:
+    The cost of every pair.
+  """
+  table_bytes = table_bytes or {}
+  history = collections.defaultdict(list)
+  for run in runs:
+    history[(run.mc, run.gads)].append(run)
+  costs = {}
+  for pair in pairs:
+    if history[pair]:
+      slots = [_get_slots(run) for run in history[pair]
+               if _get_slots(run) is not None]
+      costs[pair] = Cost(
+          statistics.median(run.seconds for run in history[pair]),
+          statistics.median(slots) if slots else 1.0, 'history')
+  if costs:
+    median_seconds = statistics.median(cost.seconds for cost in costs.values())
+    median_slots = statistics.median(cost.slots for cost in costs.values())
+    rates = [cost.seconds / table_bytes[pair] for pair, cost in costs.items()
+             if table_bytes.get(pair)]
+    seconds_per_byte = statistics.median(rates) if rates else None
+  else:
+    median_seconds, median_slots = _DEFAULT_SECONDS, 1.0
+    seconds_per_byte = 1.0 / _DEFAULT_BYTES_PER_SECOND
+  for pair in pairs:
+    if pair in costs:
+      continue
+    if table_bytes.get(pair) and seconds_per_byte:
+      costs[pair] = Cost(max(table_bytes[pair] * seconds_per_byte, 1.0),
+                         median_slots, 'table_size')
+    else:
+      costs[pair] = Cost(median_seconds, median_slots,
+                         'median' if history else 'default')
+  return costs
+
+
+def get_max_offset_minutes(schedule: str) -> int:
+  """Returns the largest offset keeping the start on the day of a schedule.
+
+  Args:
+    schedule: zombies_schedule, of the form "every day HH:MM".
+  Raises:
+    ValueError: If the schedule can not be offset.
+  """
+  match = _SCHEDULE_RE.match(schedule)
+  if not match:
+    raise ValueError(f'zombies_schedule "{schedule}" is not of the form '
+                     '"every day HH:MM", it can not be staggered')
+  start = int(match.group(2)) * 60 + int(match.group(3))
+  # A start after midnight would run with the @run_date of the next day.
+  return 24 * 60 - 1 - start
+
+
+def _get_peak(placed: List[Tuple[float, float, float]], start: float,
+              end: float) -> float:
+  """Returns the highest demand of the placed queries within [start, end)."""
+  peak = 0.0
+  for time in [start] + [s for s, _, _ in placed if start < s < end]:
+    peak = max(peak, sum(demand for s, e, demand in placed
+                         if s <= time < e))
+  return peak
+
+
+def plan_offsets(costs: Dict[Pair, Cost], strategy: str, capacity: float,
+                 use_slots: bool, step_minutes: int = 1,
+                 max_offset_minutes: int = 24 * 60 - 1) -> Dict[Pair, int]:
+  """Assigns a start offset to the query of every pair.
+
+  The pairs are placed one after the other at the earliest step where the
+  demand of the queries already placed leaves room for theirs, in the order
+  of the strategy. A pair that fits
+  nowhere before max_offset_minutes gets the least loaded step.
+
+  Args:
+    costs: Estimated cost of every pair.
+    strategy: One of STRATEGIES.
+    capacity: Number of concurrent queries, or of slots with use_slots.
+    use_slots: Whether the demand of a query is its slots rather than 1.
+    step_minutes: Granularity of the offsets.
+    max_offset_minutes: Largest offset allowed.
+  Returns:
+    The offset in minutes after zombies_schedule of every pair.
+  """
+  if strategy not in STRATEGIES:
+    raise ValueError(f'Unknown strategy {strategy}')
+  if strategy == SIMULTANEOUS:
+    return {pair: 0 for pair in costs}
+  if strategy == ROUND_ROBIN:
+    uniform = Cost(statistics.median(cost.seconds for cost in costs.values()),
+                   statistics.median(cost.slots for cost in costs.values()),
+                   'median')
+    costs = {pair: uniform for pair in costs}
+    order = sorted(costs)
+  else:
+    sign = -1 if strategy == LONGEST_FIRST else 1
+    order = sorted(costs, key=lambda pair: (sign * costs[pair].seconds, pair))
+  step = step_minutes * 60
+  placed = []
+  offsets = {}
+  for pair in order:
+    cost = costs[pair]
+    demand = min(cost.slots if use_slots else 1.0, capacity)
+    candidates = sorted({0.0} | {math.ceil(end / step - _EPSILON) * step
+                                 for _, end, _ in placed})
+    candidates = [start for start in candidates
+                  if start <= max_offset_minutes * 60]
+    peaks = [(_get_peak(placed, start, start + cost.seconds), start)
+             for start in candidates]
+    fitting = [start for peak, start in peaks
+               if peak + demand <= capacity + _EPSILON]
+    start = fitting[0] if fitting else min(peaks)[1]
+    placed.append((start, start + cost.seconds, demand))
+    offsets[pair] = int(round(start / 60))
+  return offsets
+
+
+def _get_rates(caps: Dict[Pair, float], capacity: float) -> Dict[Pair, float]:
+  """Shares the capacity fairly among queries running at most at their cap."""
+  rates = {}
+  remaining = capacity
+  pending = sorted(caps.items(), key=lambda item: item[1])
+  while pending:
+    share = remaining / len(pending)
+    pair, cap = pending[0]
+    if cap > share:
+      rates.update((pair, share) for pair, _ in pending)
+      break
+    rates[pair] = cap
+    remaining -= cap
+    pending.pop(0)
+  return rates
+
+
+def simulate(offsets: Dict[Pair, int], costs: Dict[Pair, Cost],
+             capacity: float, use_slots: bool) -> Simulation:
+  """Replays the queries of a run date on a budget.
+
+  Beyond the concurrency the queries queue in the order they were started,
+  as BigQuery queues interactive queries, whereas a slot budget is shared
+  fairly by all the running queries.
+
+  Args:
+    offsets: Start offset in minutes of every pair.
+    costs: Recorded duration and slots of the query of every pair.
+    capacity: Number of concurrent queries, or of slots with use_slots.
+    use_slots: Whether a query uses its slots of the budget rather than 1.
+  Returns:
+    The completion time of every pair.
+  """
+  starts = sorted((offsets[pair] * 60.0, pair) for pair in costs)
+  caps = {pair: min(cost.slots if use_slots else 1.0, capacity)
+          for pair, cost in costs.items()}
+  queue = []
+  remaining = {}
+  completions = {}
+  now = 0.0
+  while starts or queue or remaining:
+    while starts and starts[0][0] <= now + _EPSILON:
+      queue.append(starts.pop(0)[1])
+    while queue and (use_slots or len(remaining) < capacity):
+      pair = queue.pop(0)
+      remaining[pair] = costs[pair].seconds * caps[pair]
+    if not remaining:
+      now = starts[0][0]
+      continue
+    rates = _get_rates({pair: caps[pair] for pair in remaining}, capacity)
+    step = min(work / rates[pair] for pair, work in remaining.items())
+    if starts:
+      step = min(step, starts[0][0] - now)
+    now += step
+    for pair in list(remaining):
+      remaining[pair] -= rates[pair] * step
+      if remaining[pair] <= _EPSILON * max(1.0, caps[pair]):
+        del remaining[pair]
+        completions[pair] = now
+  stretches = {pair: (completions[pair] - offsets[pair] * 60.0) /
+                     max(costs[pair].seconds, _EPSILON)
+               for pair in completions}
+  return Simulation(max(completions.values(), default=0.0), completions,
+                    stretches)
+
+
+def replay(offsets: Dict[Pair, int], costs: Dict[Pair, Cost],
+           runs: List[Run], capacity: float,
+           use_slots: bool) -> List[Simulation]:
+  """Simulates every recorded run date, estimated costs fill missing runs."""
+  by_date = collections.defaultdict(dict)
+  for run in runs:
+    if (run.mc, run.gads) in costs:
+      by_date[run.run_date][(run.mc, run.gads)] = Cost(
+          run.seconds, _get_slots(run) or 1.0, 'history')
+  simulations = []
+  for run_date in sorted(by_date) or [None]:
+    date_costs = dict(costs)
+    date_costs.update(by_date.get(run_date, {}))
+    simulations.append(simulate(offsets, date_costs, capacity, use_slots))
+  return simulations
+
+
+def _print_comparison(results: Dict[str, List[Simulation]]) -> None:
+  print('strategy\tdates\tmakespan_min\tp50_min\tp95_min\tmax_min\t'
+        'mean_stretch')
+  for strategy, simulations in results.items():
+    completions = [seconds / 60 for simulation in simulations
+                   for seconds in simulation.completions.values()]
+    stretches = [stretch for simulation in simulations
+                 for stretch in simulation.stretches.values()]
+    makespan = statistics.mean(simulation.makespan / 60
+                               for simulation in simulations)
+    print(f'{strategy}\t{len(simulations)}\t{makespan:.1f}\t'
+          f'{span_report._percentile(completions, 0.5):.1f}\t'  # pylint: disable=protected-access
+          f'{span_report._percentile(completions, 0.95):.1f}\t'  # pylint: disable=protected-access
+          f'{max(completions):.1f}\t{statistics.mean(stretches):.2f}')
+
+
+def _get_args_parser():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--config_file', default=zombies_config.CONFIG_FILE,
+                      help='JSON artifact compiled from variables.tf by '
+                      'zombies_config.py.')
+  parser.add_argument('--spans', nargs='+', default=[],
+                      help='JSON lines files with scheduled_query spans.')
+  parser.add_argument('--jobs_days', type=int, default=0,
+                      help='Days of BigQuery jobs of the project to fetch the '
+                      'runs and their slots from.')
+  parser.add_argument('--table_sizes', action='store_true',
+                      help='Estimate the pairs without runs from the size of '
+                      'their source tables.')
+  budget = parser.add_mutually_exclusive_group(required=True)
+  budget.add_argument('--concurrency', type=int,
+                      help='Number of queries running at the same time.')
+  budget.add_argument('--slots', type=float,
+                      help='Slots shared by the queries running at the same '
+                      'time.')
+  parser.add_argument('--step_minutes', type=int, default=1,
+                      help='Granularity of the offsets.')
+  parser.add_argument('--max_offset_minutes', type=int, default=None,
+                      help='Largest offset, up to the minute before midnight '
+                      'by default.')
+  parser.add_argument('--strategy', choices=STRATEGIES, default=LONGEST_FIRST,
+                      help='Strategy whose offsets are printed and written.')
+  parser.add_argument('--output', default=None,
+                      help='Terraform variables JSON file the offsets are '
+                      'written to, e.g. zombies_schedule.auto.tfvars.json.')
+  return parser
+
+
+def main(argv=None):
+  args = _get_args_parser().parse_args(argv)
+  config = zombies_config.load_config(config_file=args.config_file)
+  variables = config['variables']
+  pairs = sorted({(account.mc, account.gads)
+                  for account in zombies_config.get_accounts(config)})
+  max_offset_minutes = get_max_offset_minutes(variables['zombies_schedule'])
+  if args.max_offset_minutes is not None:
+    max_offset_minutes = min(max_offset_minutes, args.max_offset_minutes)
+  if variables.get('zombies_readiness_gating'):
+    print('zombies_readiness_gating is true, the offsets only apply once it '
+          'is turned off.', file=sys.stderr)
+
+  runs = get_span_runs(span_report.read_spans(args.spans))
+  if args.jobs_days:
+    runs += fetch_job_runs(variables['gcp_project'],
+                           variables['zombies_data_location'], args.jobs_days)
+  table_bytes = fetch_table_bytes(variables, pairs) if args.table_sizes else {}
+  costs = estimate_costs(pairs, runs, table_bytes)
+  use_slots = args.slots is not None
+  capacity = args.slots if use_slots else args.concurrency
+  if capacity <= 0:
+    raise ValueError('--concurrency and --slots must be positive')
+  sources = collections.Counter(cost.source for cost in costs.values())
+  print(f'{len(pairs)} pairs, {len(runs)} recorded runs, costs from '
+        f'{dict(sources)}')
+
+  plans = {strategy: plan_offsets(costs, strategy, capacity, use_slots,
+                                  args.step_minutes, max_offset_minutes)
+           for strategy in STRATEGIES}
+  _print_comparison({
+      strategy: replay(offsets, costs, runs, capacity, use_slots)
+      for strategy, offsets in plans.items()})
+
+  offsets = plans[args.strategy]
+  print('Merchant\tGAds\tSeconds\tSlots\tSource\tOffset')
+  for pair in sorted(pairs, key=lambda pair: (offsets[pair], pair)):
+    cost = costs[pair]
+    print(f'{pair[0]}\t{pair[1]}\t{cost.seconds:.0f}\t{cost.slots:.1f}\t'
+          f'{cost.source}\t{offsets[pair]}')
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'zombies_schedule_offsets': {
+          f'{mc}_{gads}': offset for (mc, gads), offset in sorted(
+              offsets.items())}}, f, indent=2, sort_keys=True)
+      f.write('\n')
+
+
+if __name__ == '__main__':
+  main()
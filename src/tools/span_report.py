@@ -0,0 +1,203 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Reports the critical path of every account pair and run date from spans.
+
+The spans are the JSON lines written by data_transfers.py and by the feed
+generation Cloud Function, other lines of the files (e.g. the rest of an
+exported Cloud Function log) are ignored. For every pair and run date the
+Merchant Center and Google Ads transfer runs, the scheduled query, the
+function invocation and its export job are chained, and the time between two
+stages is reported as a wait, e.g.:
+
+  python src/tools/span_report.py zombies_spans.jsonl feed_generation.jsonl
+"""
+
+import argparse
+import collections
+import json
+import sys
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+_MERCHANT_CENTER_ID = 'merchant_center'
+_GOOGLE_ADS_ID = 'google_ads'
+# Spans of a pair, the export job of a tracked invocation runs within it.
+_PAIR_STAGES = ('scheduled_query', 'trigger_job', 'export_job')
+
+
+class Stage(NamedTuple):
+  """A stage of the critical path of a pair."""
+  name: str
+  start: float
+  end: float
+
+
+class PairPath(NamedTuple):
+  """The critical path of an account pair for a run date."""
+  run_date: str
+  mc_id: str
+  gads_id: str
+  stages: List[Stage]
+  low_volume_rows: Optional[int]
+  bytes_processed: Optional[int]
+
+  @property
+  def seconds(self) -> float:
+    return (max(stage.end for stage in self.stages) -
+            min(stage.start for stage in self.stages))
+
+  def get_waits(self) -> List[Tuple[str, float]]:
+    """Returns the idle time between the end of a stage and the next start.
+
+    A stage starting before the previous one ended, e.g. the export job of a
+    tracked invocation, has no wait.
+    """
+    return [(f'{previous.name}>{stage.name}',
+             max(0.0, stage.start - previous.end))
+            for previous, stage in zip(self.stages, self.stages[1:])]
+
+
+def read_spans(paths: Iterable[str]) -> List[dict]:
+  """Reads the span records of JSON lines files, '-' reads stdin."""
+  records = []
+  for path in paths:
+    stream = sys.stdin if path == '-' else open(path)
+    with stream:
+      for line in stream:
+        line = line.strip()
+        if not line.startswith('{'):
+          continue
+        try:
+          record = json.loads(line)
+        except ValueError:
+          continue
+        if isinstance(record, dict) and 'span' in record:
+          records.append(record)
+  return records
+
+
+def get_paths(records: List[dict]) -> List[PairPath]:
+  """Chains the spans of every account pair and run date.
+
+  Args:
+    records: Span records as written by the spans module.
+  Returns:
+    The critical paths, the slowest first.
+  """
+  transfers = {}
+  pairs = collections.defaultdict(dict)
+  for record in records:
+    attributes = record.get('attributes', {})
+    run_date = attributes.get('run_date')
+    if record['span'] == 'transfer_run':
+      key = (run_date, attributes.get('data_source_id'),
+             attributes.get('account_id'))
+      # A transfer rerun for the same date replaces the previous run.
+      if key not in transfers or transfers[key]['end'] < record['end']:
+        transfers[key] = record
+    elif record['span'] in _PAIR_STAGES and attributes.get('mc_id'):
+      key = (run_date, attributes['mc_id'], attributes.get('gads_id'))
+      stage = pairs[key].get(record['span'])
+      if stage is None or stage['end'] < record['end']:
+        pairs[key][record['span']] = record
+  paths = []
+  for (run_date, mc_id, gads_id), spans in pairs.items():
+    stages = []
+    for data_source_id, account_id in ((_MERCHANT_CENTER_ID, mc_id),
+                                       (_GOOGLE_ADS_ID, gads_id)):
+      record = transfers.get((run_date, data_source_id, account_id))
+      if record:
+        stages.append(Stage(f'{data_source_id}_transfer', record['start'],
+                            record['end']))
+    # Both transfers run in parallel, only the last one to finish delays the
+    # scheduled query.
+    stages.sort(key=lambda stage: stage.end)
+    stages = stages[-1:]
+    for name in _PAIR_STAGES:
+      if name in spans:
+        stages.append(Stage(name, spans[name]['start'], spans[name]['end']))
+    if not stages:
+      continue
+    stages.sort(key=lambda stage: stage.start)
+    trigger = spans.get('trigger_job', {}).get('attributes', {})
+    export = spans.get('export_job', {}).get('attributes', {})
+    paths.append(PairPath(run_date, mc_id, gads_id, stages,
+                          trigger.get('low_volume_rows'),
+                          export.get('total_bytes_processed')))
+  paths.sort(key=lambda path: path.seconds, reverse=True)
+  return paths
+
+
+def _format_path(path: PairPath) -> str:
+  durations = ' '.join(f'{stage.name}={stage.end - stage.start:.1f}s'
+                       for stage in path.stages)
+  waits = ' '.join(f'{name}={seconds:.1f}s'
+                   for name, seconds in path.get_waits())
+  return (f'{path.run_date}\t{path.mc_id}\t{path.gads_id}\t'
+          f'{path.seconds:.1f}\t{path.low_volume_rows}\t'
+          f'{path.bytes_processed}\t{durations}\t{waits}')
+
+
+def _get_stage_totals(paths: List[PairPath]) -> Dict[str, List[float]]:
+  totals = collections.defaultdict(list)
+  for path in paths:
+    for stage in path.stages:
+      totals[stage.name].append(stage.end - stage.start)
+    for name, seconds in path.get_waits():
+      totals[f'wait {name}'].append(seconds)
+  return totals
+
+
+def _percentile(values: List[float], share: float) -> float:
+  values = sorted(values)
+  return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('files', nargs='+',
+                      help='JSON lines files of spans, - reads stdin.')
+  parser.add_argument('--run_date', default=None,
+                      help='Only report this run date, YYYYMMDD.')
+  parser.add_argument('--top', type=int, default=None,
+                      help='Only report the slowest pairs.')
+  parser.add_argument('--json', action='store_true',
+                      help='Print the paths as JSON lines.')
+  args = parser.parse_args(argv)
+
+  paths = [path for path in get_paths(read_spans(args.files))
+           if args.run_date is None or path.run_date == args.run_date]
+  if args.top:
+    paths = paths[:args.top]
+  if args.json:
+    for path in paths:
+      print(json.dumps(dict(path._asdict(), seconds=path.seconds,
+                            stages=[stage._asdict() for stage in path.stages],
+                            waits=dict(path.get_waits()))))
+    return
+  print('run_date\tmc_id\tgads_id\tcritical_path_s\tlow_volume_rows\t'
+        'bytes_processed\tstages\twaits')
+  for path in paths:
+    print(_format_path(path))
+  if paths:
+    print(f'\n{len(paths)} pairs\tp50\tp95\tmax')
+    for name, values in sorted(_get_stage_totals(paths).items()):
+      print(f'{name}\t{_percentile(values, 0.5):.1f}\t'
+            f'{_percentile(values, 0.95):.1f}\t{max(values):.1f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,422 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Runs the pipeline SQL embedded in the Terraform files on a local DuckDB.
+
+The queries are extracted from the Terraform heredocs, the `${var...}`
+placeholders are rendered with the defaults of variables.tf and the BigQuery
+only syntax is translated to DuckDB. Every stage is materialized as a table so
+it can be timed on its own, e.g.:
+
+  python src/tools/sql_harness.py run --offers 10000
+  python src/tools/sql_harness.py benchmark --scales 10000 1000000 10000000
+  python src/tools/sql_harness.py ctes --offers 100000 --feed_label EU
+"""
+
+import argparse
+import datetime
+import os
+import re
+import resource
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import duckdb
+import synthetic_data
+
+_ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+
+class Stage(NamedTuple):
+  """A pipeline query and the Terraform file holding it."""
+  name: str
+  tf_file: str
+
+
+# Stages in dependency order, each one reads the tables of the previous ones.
+STAGES = (
+    Stage('product_view', 'targeted_product_view.tf'),
+    Stage('adgroup_criteria_view', 'targeted_adgroup_criteria_view.tf'),
+    Stage('pmax_criteria_view', 'targeted_pmax_criteria_view.tf'),
+    Stage('criteria_view', 'targeted_criteria_view.tf'),
+    Stage('targeted_products_view', 'targeted_products_view.tf'),
+    Stage('low_volume_skus', 'bq_scheduled_query.tf'),
+)
+
+
+class StageResult(NamedTuple):
+  """Measurements of a stage run."""
+  name: str
+  rows: int
+  seconds: float
+  peak_memory_mb: float
+
+
+def load_variables(variables_tf: str) -> Dict[str, str]:
+  """Returns the scalar default values declared in a variables.tf file.
+
+  Args:
+    variables_tf: Path of the Terraform variables file.
+  Returns:
+    Dictionary from variable name to its default value as a string.
+  """
+  with open(variables_tf) as tf_file:
+    content = tf_file.read()
+  variables = {}
+  for match in re.finditer(r'variable\s+"(\w+)"\s*\{(.*?)\n\}', content,
+                           re.DOTALL):
+    default = re.search(r'^\s*default\s*=\s*"?([^"\n{]*)"?\s*$',
+                        match.group(2), re.MULTILINE)
+    if default:
+      variables[match.group(1)] = default.group(1).strip()
+  return variables
+
+
+def extract_query(tf_path: str) -> str:
+  """Returns the query of the first `query = <<EOF` heredoc of a file."""
+  with open(tf_path) as tf_file:
+    content = tf_file.read()
+  match = re.search(r'query\s*=\s*<<EOF\n(.*?)\n\s*EOF', content, re.DOTALL)
+  if not match:
+    raise ValueError(f'No query heredoc found in {tf_path}')
+  return match.group(1)
+
+
+def render(query: str, variables: Dict[str, str], mc: str, gads: str) -> str:
+  """Replaces the Terraform placeholders and `%{ if }` directives of a query.
+
+  Args:
+    query: Query extracted from a Terraform file.
+    variables: Terraform variable values.
+    mc: Merchant Center account id of the pair.
+    gads: Google Ads account id of the pair.
+  Returns:
+    The rendered query.
+  Raises:
+    KeyError: If the query uses an unknown placeholder.
+  """
+  values = dict(variables)
+  values['each.value.mc'] = mc
+  values['each.value.gads'] = gads
+
+  def _value(name):
+    return values[name[len('var.'):] if name.startswith('var.') else name]
+
+  def _directive(match):
+    enabled = _value(match.group(1)).lower() == 'true'
+    return match.group(2) if enabled else (match.group(3) or '')
+
+  query = re.sub(
+      r'^%\{ if ([\w.]+) ~\}\n(.*?)(?:^%\{ else ~\}\n(.*?))?^%\{ endif ~\}\n',
+      _directive, query, flags=re.DOTALL | re.MULTILINE)
+  return re.sub(r'\$\{([\w.]+)\}', lambda match: _value(match.group(1)),
+                query)
+
+
+def _last_instr(match) -> str:
+  """Translates INSTR(value, search, -1, 1), the last occurrence position."""
+  value, search = match.group(1), match.group(2)
+  return (f'(CASE WHEN instr({value}, {search}) = 0 THEN 0 ELSE '
+          f'length({value}) - instr(reverse({value}), reverse({search})) '
+          f'- length({search}) + 2 END)')
+
+
+def _approx_quantiles(match) -> str:
+  """Translates APPROX_QUANTILES(value, n) into an exact quantile list."""
+  buckets = int(match.group(2))
+  fractions = ', '.join(str(i / buckets) for i in range(buckets + 1))
+  return f'quantile_disc({match.group(1)}, [{fractions}])'
+
+
+# BigQuery only constructs and their DuckDB equivalent, applied in order.
+_TRANSLATIONS = (
+    # Comments.
+    (r'^\s*#.*$', ''),
+    # `project.dataset.table` names, every table name is unique locally.
+    (r'`[\w-]+\.\w+\.(\w+)`', r'"\1"'),
+    (r'DATE_ADD\(([^,()]+),\s*INTERVAL\s+(-?\d+)\s+DAY\)',
+     r'CAST(\1 + INTERVAL (\2) DAY AS DATE)'),
+    (r'APPROX_QUANTILES\(([^,()]+),\s*(\d+)\)', _approx_quantiles),
+    # Zero based array accessors, DuckDB lists are one based.
+    (r'\[\s*(?:SAFE_)?OFFSET\s*\(\s*([^\]]+?)\s*\)\s*\]', r'[(\1) + 1]'),
+    (r'\[ARRAY_LENGTH\(SPLIT\([^()]*\)\)\s*-\s*1\]', '[-1]'),
+    (r'\bSPLIT\(', 'string_split('),
+    (r'ARRAY_AGG\(DISTINCT ([^()]+?) IGNORE NULLS\)',
+     r'list(DISTINCT \1) FILTER (WHERE \1 IS NOT NULL)'),
+    (r'ARRAY_CONCAT_AGG\(([^()]+)\)', r'flatten(list(\1))'),
+    # Correlated subqueries are not supported in DuckDB join conditions.
+    (r'(TRIM\(LOWER\([\w.]+\)\)|[\w.]+)\s+(NOT\s+)?IN\s+UNNEST\(([^()]+)\)',
+     r'\2COALESCE(list_contains(\3, \1), FALSE)'),
+    (r'UNNEST\((\w+)\) AS (\w+)', r'UNNEST(\1) AS _\2(\2)'),
+    (r"CONTAINS_SUBSTR\((\w+),\s*('[^']*')\)", r'contains(lower(\1), \2)'),
+    (r"INSTR\(([\w.]+),\s*('[^']*'),\s*-1,\s*1\)", _last_instr),
+    # Correlated comma joins over repeated fields.
+    (r'AS (\w+),\s*\1\.(\w+),\s*\2\.(\w+) AS (\w+)',
+     r'AS \1, LATERAL (SELECT UNNEST(\1.\2, max_depth := 2)) AS \2, '
+     r'UNNEST(\2.\3) AS _\3(\4)'),
+    # BigQuery evaluates `FROM a, b LEFT JOIN c` from left to right.
+    (r',\s*\n\s*(\w+)\s*\n(\s*)LEFT JOIN', r' CROSS JOIN \1\n\2LEFT JOIN'),
+    (r'CREATE OR REPLACE VIEW', 'CREATE OR REPLACE TABLE'),
+)
+
+
+def translate(query: str, run_date: datetime.date) -> str:
+  """Translates a rendered BigQuery query into DuckDB SQL.
+
+  Args:
+    query: Rendered BigQuery query.
+    run_date: Value of the @run_date scheduled query parameter.
+  Returns:
+    The DuckDB query, views are created as tables.
+  """
+  query = query.replace('@run_date', f"DATE '{run_date.isoformat()}'")
+  for pattern, replacement in _TRANSLATIONS:
+    query = re.sub(pattern, replacement, query, flags=re.MULTILINE)
+  return query
+
+
+def get_stage_query(stage: Stage, variables: Dict[str, str], mc: str,
+                    gads: str, run_date: datetime.date) -> str:
+  """Returns the DuckDB statement materializing a stage."""
+  query = translate(
+      render(extract_query(os.path.join(_ROOT_DIR, stage.tf_file)),
+             variables, mc, gads), run_date)
+  if not re.search(r'CREATE OR REPLACE TABLE', query):
+    query = (f'CREATE OR REPLACE TABLE "{get_stage_table(stage, mc, gads, run_date)}" '
+             f'AS {query}')
+  return query
+
+
+def get_stage_table(stage: Stage, mc: str, gads: str,
+                    run_date: datetime.date) -> str:
+  """Returns the name of the table written by a stage."""
+  if stage.name == 'low_volume_skus':
+    return f'LowVolumeSkus_{mc}_{gads}_{run_date:%Y%m%d}'
+  account = mc if stage.name == 'product_view' else gads
+  return f'{stage.name}_{account}'
+
+
+class _PeakMemorySampler(object):
+  """Samples the resident memory of the process in a background thread."""
+
+  def __init__(self, interval_seconds: float = 0.01):
+    self._interval_seconds = interval_seconds
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._sample, daemon=True)
+    self.peak_bytes = _get_rss_bytes()
+
+  def _sample(self):
+    while not self._stop.wait(self._interval_seconds):
+      self.peak_bytes = max(self.peak_bytes, _get_rss_bytes())
+
+  def __enter__(self):
+    self._thread.start()
+    return self
+
+  def __exit__(self, *unused_args):
+    self._stop.set()
+    self._thread.join()
+    self.peak_bytes = max(self.peak_bytes, _get_rss_bytes())
+
+
+def _get_rss_bytes() -> int:
+  """Returns the resident memory, or the peak one without /proc."""
+  try:
+    with open('/proc/self/statm') as statm:
+      return int(statm.read().split()[1]) * resource.getpagesize()
+  except OSError:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_stages(conn: duckdb.DuckDBPyConnection, variables: Dict[str, str],
+               mc: str, gads: str,
+               run_date: datetime.date) -> List[StageResult]:
+  """Runs every stage of the pipeline on fixture tables already loaded.
+
+  Args:
+    conn: DuckDB connection holding the source tables.
+    variables: Terraform variable values.
+    mc: Merchant Center account id of the pair.
+    gads: Google Ads account id of the pair.
+    run_date: Run date of the scheduled query.
+  Returns:
+    The measurements of every stage.
+  """
+  results = []
+  for stage in STAGES:
+    query = get_stage_query(stage, variables, mc, gads, run_date)
+    with _PeakMemorySampler() as sampler:
+      start = time.perf_counter()
+      conn.execute(query)
+      seconds = time.perf_counter() - start
+    table = get_stage_table(stage, mc, gads, run_date)
+    rows = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    results.append(StageResult(stage.name, rows, seconds,
+                               sampler.peak_bytes / 2**20))
+  return results
+
+
+# Tokens of a translated query that matter to find its common table expressions.
+_CTE_TOKEN_RE = re.compile(r"'(?:[^'\\]|\\.)*'|(\w+)\s+AS\s*\(|\(|\)")
+
+
+def get_ctes(query: str) -> Tuple[List[str], str]:
+  """Splits the top level WITH clause of a translated query.
+
+  Args:
+    query: DuckDB query starting with a WITH clause.
+  Returns:
+    The names of the common table expressions, in order, and the WITH clause
+    up to the closing parenthesis of the last one.
+  """
+  names = []
+  depth = 0
+  end = 0
+  for match in _CTE_TOKEN_RE.finditer(query):
+    token = match.group(0)
+    if token.startswith("'"):
+      continue
+    if token == ')':
+      depth -= 1
+      if depth == 0:
+        end = match.end()
+      continue
+    if depth == 0:
+      if not match.group(1):
+        # The first top level parenthesis of the final SELECT.
+        break
+      names.append(match.group(1))
+    depth += 1
+  return names, query[:end]
+
+
+def count_cte_rows(conn: duckdb.DuckDBPyConnection,
+                   variables: Dict[str, str], mc: str, gads: str,
+                   run_date: datetime.date) -> List[StageResult]:
+  """Counts the rows of every intermediate of the low volume skus query.
+
+  The stages preceding the query must already be materialized.
+
+  Args:
+    conn: DuckDB connection holding the source tables.
+    variables: Terraform variable values.
+    mc: Merchant Center account id of the pair.
+    gads: Google Ads account id of the pair.
+    run_date: Run date of the scheduled query.
+  Returns:
+    The rows and time of every common table expression, computed on its own.
+  """
+  stage = STAGES[-1]
+  query = translate(
+      render(extract_query(os.path.join(_ROOT_DIR, stage.tf_file)),
+             variables, mc, gads), run_date)
+  names, with_clause = get_ctes(query)
+  results = []
+  for name in names:
+    with _PeakMemorySampler() as sampler:
+      start = time.perf_counter()
+      rows = conn.execute(
+          f'{with_clause} SELECT COUNT(*) FROM {name}').fetchone()[0]
+      seconds = time.perf_counter() - start
+    results.append(StageResult(name, rows, seconds,
+                               sampler.peak_bytes / 2**20))
+  return results
+
+
+def _get_args_parser():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  subparsers = parser.add_subparsers(dest='command', required=True)
+  for command in ('run', 'benchmark', 'ctes'):
+    subparser = subparsers.add_parser(command)
+    subparser.add_argument('--mc', default=synthetic_data.DEFAULT_MC,
+                           help='Merchant Center account id.')
+    subparser.add_argument('--gads', default=synthetic_data.DEFAULT_GADS,
+                           help='Google Ads account id.')
+    subparser.add_argument('--run_date', default=None,
+                           help='Run date as YYYY-MM-DD, today by default.')
+    subparser.add_argument('--memory_limit', default=None,
+                           help='DuckDB memory limit, e.g. 8GB.')
+    synthetic_data.get_options_parser(subparser)
+  subparsers.choices['run'].add_argument(
+      '--data_dir', default=None,
+      help='Directory of the tables written by synthetic_data.py, the tables '
+      'are generated in memory otherwise.')
+  subparsers.choices['run'].add_argument(
+      '--output', default=None,
+      help='CSV file to write the LowVolumeSkus table to.')
+  subparsers.choices['run'].add_argument(
+      '--print_sql', action='store_true',
+      help='Print the translated queries instead of running them.')
+  subparsers.choices['benchmark'].add_argument(
+      '--scales', type=int, nargs='+', default=[10000, 1000000, 10000000],
+      help='Numbers of offers to benchmark, overrides --offers.')
+  return parser
+
+
+def _connect(memory_limit: Optional[str]) -> duckdb.DuckDBPyConnection:
+  conn = duckdb.connect()
+  if memory_limit:
+    conn.execute(f"SET memory_limit = '{memory_limit}'")
+  return conn
+
+
+def _print_results(offers: int, results: List[StageResult]) -> None:
+  for result in results:
+    print(f'{offers}\t{result.name}\t{result.rows}\t{result.seconds:.3f}\t'
+          f'{result.peak_memory_mb:.0f}')
+
+
+def main(argv=None):
+  args = _get_args_parser().parse_args(argv)
+  run_date = (datetime.date.fromisoformat(args.run_date) if args.run_date
+              else datetime.date.today())
+  variables = load_variables(os.path.join(_ROOT_DIR, 'variables.tf'))
+
+  if args.command == 'run' and args.print_sql:
+    for stage in STAGES:
+      print(f'-- {stage.name}')
+      print(get_stage_query(stage, variables, args.mc, args.gads, run_date))
+    return
+
+  options = synthetic_data.get_options(args)
+  scales = args.scales if args.command == 'benchmark' else [args.offers]
+  print('offers\tstage\trows\tseconds\tpeak_memory_mb')
+  for offers in scales:
+    conn = _connect(args.memory_limit)
+    with _PeakMemorySampler() as sampler:
+      start = time.perf_counter()
+      if args.command == 'run' and args.data_dir:
+        synthetic_data.attach_tables(conn, args.data_dir)
+      else:
+        synthetic_data.create_tables(conn, options._replace(offers=offers),
+                                     args.mc, args.gads, run_date)
+      fixture_seconds = time.perf_counter() - start
+    print(f'{offers}\tfixtures\t-\t{fixture_seconds:.3f}\t'
+          f'{sampler.peak_bytes / 2**20:.0f}')
+    _print_results(offers,
+                   run_stages(conn, variables, args.mc, args.gads, run_date))
+    if args.command == 'ctes':
+      _print_results(offers, count_cte_rows(conn, variables, args.mc,
+                                            args.gads, run_date))
+    if args.command == 'run' and args.output:
+      table = get_stage_table(STAGES[-1], args.mc, args.gads, run_date)
+      conn.execute(f"COPY \"{table}\" TO '{args.output}' (HEADER, DELIMITER '\t')")
+    conn.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,477 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Generates synthetic Merchant Center and Google Ads transfer tables.
+
+The tables have the shape of the ones read by the pipeline queries. Every value
+is derived from a hash of the seed and the row coordinates, so the output is
+deterministic and the rows are streamed by DuckDB to partitioned Parquet or CSV
+files without being held in memory, e.g.:
+
+  python src/tools/synthetic_data.py --output_dir /tmp/zombies_data \
+    --offers 10000000 --days 30 --memory_limit 4GB
+"""
+
+import argparse
+import datetime
+import os
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import duckdb
+
+DEFAULT_MC = '111111111'
+DEFAULT_GADS = '222222222'
+
+# Criteria ids of the country geo targets.
+_COUNTRY_CRITERIA_IDS = {
+    'AU': '2036', 'BR': '2076', 'CA': '2124', 'DE': '2276', 'ES': '2724',
+    'FR': '2250', 'GB': '2826', 'IN': '2356', 'IT': '2380', 'JP': '2392',
+    'MX': '2484', 'NL': '2528', 'PL': '2616', 'SE': '2752', 'US': '2840',
+}
+_BRANDS = 50
+_PRODUCT_TYPES = 10
+_SHOPPING_CAMPAIGNS = 2
+_PMAX_CAMPAIGN_OFFSET = 1000
+# Pareto shape of the offer popularity, lower values give a longer tail.
+_POPULARITY_SHAPE = 1.2
+
+
+class Options(NamedTuple):
+  """Knobs of the generated dataset."""
+  offers: int = 10000
+  variants_per_group: int = 4
+  countries: Tuple[str, ...] = ('US', 'FR', 'DE', 'GB', 'ES')
+  zero_click_share: float = 0.6
+  days: int = 7
+  asset_groups: int = 4
+  seed: int = 0
+  feed_label: str = ''  # Shared by all the countries, the country if empty.
+  # Share of the offers also listed under a second feed label.
+  multi_label_share: float = 0.01
+
+
+class Table(NamedTuple):
+  """A generated table and the column its files are partitioned by."""
+  name: str
+  query: str
+  partition_by: Optional[str]
+
+
+def _uniform(options: Options, *parts: str) -> str:
+  """Returns the SQL of a deterministic uniform value in [0, 1)."""
+  return (f"(hash({options.seed}, {', '.join(parts)}) % 1000000 "
+          f'/ 1000000.0)')
+
+
+def _pick(options: Options, values: Tuple[str, ...], *parts: str) -> str:
+  """Returns the SQL picking one of the values from a hash of the parts."""
+  literals = ', '.join(f"'{value}'" for value in values)
+  return (f'[{literals}][CAST(hash({options.seed}, {", ".join(parts)}) '
+          f'% {len(values)} AS BIGINT) + 1]')
+
+
+def get_tables(options: Options, mc: str, gads: str,
+               run_date: datetime.date) -> Tuple[Table, ...]:
+  """Returns the queries generating every source table of the pipeline.
+
+  Offers of a group share their country, brand, product type and first custom
+  label. A share of the offers never gets a click, the others get daily clicks
+  following a Pareto distributed popularity.
+
+  Args:
+    options: Knobs of the dataset.
+    mc: Merchant Center account id.
+    gads: Google Ads account id.
+    run_date: Run date of the scheduled query, the generated days precede it.
+  Returns:
+    The tables, in the order they should be written.
+  """
+  first_date = run_date - datetime.timedelta(days=options.days)
+  latest_date = run_date - datetime.timedelta(days=1)
+  criteria_ids = {
+      country: _COUNTRY_CRITERIA_IDS.get(country, str(3000 + i))
+      for i, country in enumerate(options.countries)}
+  geo_targets = ', '.join(f"('{country}', '{criteria_id}')"
+                          for country, criteria_id in criteria_ids.items())
+  group = f'i // {options.variants_per_group}'
+  offers = f"""
+      SELECT
+        i,
+        {group} AS g,
+        d,
+        CAST(DATE '{first_date}' + CAST(d AS INTEGER) AS DATE) AS day,
+        {_pick(options, options.countries, "'country'", group)} AS country,
+        {_pick(options, tuple(criteria_ids.values()), "'country'", group)}
+          AS criteria_id
+      FROM range({options.offers}) AS offers(i)
+      CROSS JOIN range({options.days}) AS days(d)
+  """
+  feed_label = f"'{options.feed_label}'" if options.feed_label else 'country'
+  # The offers listed under two feed labels share their performance rows.
+  labelled_offers = f"""
+      SELECT *, {feed_label} AS feed_label, '' AS product_suffix
+      FROM ({offers})
+      UNION ALL
+      SELECT *, {feed_label} || '_2' AS feed_label, ':2' AS product_suffix
+      FROM ({offers})
+      WHERE
+        {_uniform(options, "'multi_label'", 'i')} < {options.multi_label_share}
+  """
+  pmax_campaigns = ', '.join(
+      f"'{_PMAX_CAMPAIGN_OFFSET + a}'" for a in range(options.asset_groups))
+  campaign_ids = ', '.join(
+      [f"'{c + 1}'" for c in range(_SHOPPING_CAMPAIGNS)] + [pmax_campaigns])
+  days = f"""
+      SELECT
+        CAST(DATE '{first_date}' + CAST(d AS INTEGER) AS DATE) AS _DATA_DATE,
+        DATE '{latest_date}' AS _LATEST_DATE
+      FROM range({options.days}) AS days(d)
+  """
+  return (
+      Table('geo_targets', f"""
+          SELECT
+            criteria_id || '1' AS criteria_id,
+            country AS name,
+            country AS canonical_name,
+            criteria_id AS parent_id,
+            country AS country_code,
+            'City' AS target_type,
+            'Active' AS status
+          FROM (VALUES {geo_targets}) AS countries(country, criteria_id)
+      """, None),
+      Table(f'Products_{mc}', f"""
+          SELECT
+            day AS _PARTITIONDATE,
+            'online:en:' || country || ':sku_' || i || product_suffix
+              AS product_id,
+            CAST({mc} AS BIGINT) AS merchant_id,
+            NULL::BIGINT AS aggregator_id,
+            'sku_' || i AS offer_id,
+            'Title ' || i AS title,
+            NULL::VARCHAR AS description,
+            NULL::VARCHAR AS link,
+            NULL::VARCHAR AS mobile_link,
+            NULL::VARCHAR AS image_link,
+            []::VARCHAR[] AS additional_image_links,
+            'en' AS content_language,
+            'online' AS channel,
+            NULL::DATE AS expiration_date,
+            NULL::DATE AS google_expiration_date,
+            FALSE AS adult,
+            NULL::VARCHAR AS age_group,
+            IF({_uniform(options, "'stock'", 'i', 'd')} < 0.9,
+               'in stock', 'out of stock') AS availability,
+            NULL::TIMESTAMP AS availability_date,
+            'brand_' || hash({options.seed}, 'brand', g) % {_BRANDS} AS brand,
+            NULL::VARCHAR AS color,
+            'new' AS condition,
+            {{'label_0': 'cl0_' || hash({options.seed}, 'label_0', g) % 5,
+              'label_1': 'cl1_' || hash({options.seed}, 'label_1', i) % 7,
+              'label_2': NULL::VARCHAR, 'label_3': NULL::VARCHAR,
+              'label_4': NULL::VARCHAR}} AS custom_labels,
+            NULL::VARCHAR AS gender,
+            NULL::VARCHAR AS gtin,
+            'grp_' || g AS item_group_id,
+            NULL::VARCHAR AS material,
+            NULL::VARCHAR AS mpn,
+            NULL::VARCHAR AS pattern,
+            {{'value': 10.0 + hash({options.seed}, 'price', g) % 100,
+              'currency': 'EUR'}} AS price,
+            NULL::STRUCT(value DOUBLE, currency VARCHAR) AS sale_price,
+            NULL::TIMESTAMP AS sale_price_effective_start_date,
+            NULL::TIMESTAMP AS sale_price_effective_end_date,
+            NULL::VARCHAR AS google_product_category,
+            'Cat ' || hash({options.seed}, 'type', g) % {_PRODUCT_TYPES}
+              || ' > Sub ' || hash({options.seed}, 'type', g) % 100
+              AS google_product_category_path,
+            'type_' || hash({options.seed}, 'type', g) % {_PRODUCT_TYPES}
+              || ' > subtype_' || hash({options.seed}, 'type', g) % 100
+              || ' > leaf_' || hash({options.seed}, 'type', g) % 1000
+              AS product_type,
+            []::VARCHAR[] AS additional_product_types,
+            [{{'name': 'Shopping', 'approved_countries': [country],
+               'pending_countries': []::VARCHAR[],
+               'disapproved_countries': []::VARCHAR[]}}] AS destinations,
+            []::STRUCT(servability VARCHAR, short_description VARCHAR,
+                       applicable_countries VARCHAR[])[] AS issues,
+            feed_label
+          FROM ({labelled_offers})
+      """, '_PARTITIONDATE'),
+      Table(f'ads_ShoppingProductStats_{gads}', f"""
+          SELECT
+            day AS _DATA_DATE,
+            DATE '{latest_date}' AS _LATEST_DATE,
+            CAST([{campaign_ids}][CAST(hash({options.seed}, 'campaign', g)
+                 % {_SHOPPING_CAMPAIGNS + options.asset_groups} AS BIGINT) + 1]
+                 AS BIGINT) AS campaign_id,
+            'sku_' || i AS segments_product_item_id,
+            'geoTargetConstants/' || criteria_id AS segments_product_country,
+            CAST({mc} AS BIGINT) AS segments_product_merchant_id,
+            metrics_clicks,
+            metrics_clicks * 20 + CAST(floor(popularity * 10
+              * {_uniform(options, "'impressions'", 'i', 'd')}) AS BIGINT)
+              AS metrics_impressions
+          FROM (
+            SELECT
+              *,
+              IF(zero_click, 0, CAST(floor(popularity * 2
+                 * {_uniform(options, "'clicks'", 'i', 'd')}) AS BIGINT))
+                AS metrics_clicks
+            FROM (
+              SELECT
+                *,
+                {_uniform(options, "'zero_click'", 'i')}
+                  < {options.zero_click_share} AS zero_click,
+                least(1e4, pow(1 - {_uniform(options, "'popularity'", 'i')},
+                               -1 / {_POPULARITY_SHAPE})) AS popularity
+              FROM ({offers})
+            )
+          )
+          WHERE metrics_clicks > 0 OR popularity * 10
+            * {_uniform(options, "'impressions'", 'i', 'd')} >= 1
+      """, '_DATA_DATE'),
+      Table(f'ads_Campaign_{gads}', f"""
+          SELECT _DATA_DATE, _LATEST_DATE, CAST(c AS BIGINT) AS campaign_id,
+            'ENABLED' AS campaign_status
+          FROM ({days})
+          CROSS JOIN (SELECT UNNEST([{campaign_ids}])) AS campaigns(c)
+      """, '_DATA_DATE'),
+      Table(f'ads_AdGroup_{gads}', f"""
+          SELECT _DATA_DATE, _LATEST_DATE, CAST(c AS BIGINT) AS campaign_id,
+            CAST(c * 10 AS BIGINT) AS ad_group_id, 'ENABLED' AS ad_group_status,
+            'SHOPPING_PRODUCT_ADS' AS ad_group_type
+          FROM ({days})
+          CROSS JOIN range(1, {_SHOPPING_CAMPAIGNS + 1}) AS campaigns(c)
+      """, '_DATA_DATE'),
+      # The first ad group is split by product type, the second one by brand
+      # with an excluded custom label under the first brand.
+      Table(f'ads_AdGroupCriterion_{gads}', f"""
+          SELECT _DATA_DATE, _LATEST_DATE, CAST(ad_group AS BIGINT) AS ad_group_id,
+            negative AS ad_group_criterion_negative,
+            'ENABLED' AS ad_group_criterion_status,
+            display_name AS ad_group_criterion_display_name
+          FROM ({days})
+          CROSS JOIN (
+            SELECT 10, 'product_type_l1==type_' || t, FALSE
+            FROM range({_PRODUCT_TYPES // 2}) AS types(t)
+            UNION ALL SELECT 10, 'product_type_l1==*', FALSE
+            UNION ALL
+            SELECT 20, 'brand==brand_' || b, FALSE
+            FROM range(0, {_BRANDS}, 5) AS brands(b)
+            UNION ALL SELECT 20, 'brand==brand_0&+custom0==cl0_1', TRUE
+            UNION ALL SELECT 20, 'brand==*', TRUE
+          ) AS criteria(ad_group, display_name, negative)
+      """, '_DATA_DATE'),
+      Table(f'ads_AssetGroup_{gads}', f"""
+          SELECT _DATA_DATE, _LATEST_DATE,
+            CAST(a + {_PMAX_CAMPAIGN_OFFSET} AS BIGINT) AS asset_group_id,
+            'customers/{gads}/campaigns/' || (a + {_PMAX_CAMPAIGN_OFFSET})
+              AS asset_group_campaign,
+            'ENABLED' AS asset_group_status
+          FROM ({days})
+          CROSS JOIN range({options.asset_groups}) AS asset_groups(a)
+      """, '_DATA_DATE'),
+      # Every asset group includes three brands, the third one being split by
+      # custom label, and excludes everything else.
+      Table(f'ads_AssetGroupListingGroupFilter_{gads}', f"""
+          SELECT
+            _DATA_DATE,
+            _LATEST_DATE,
+            CAST(a * 100 + node AS BIGINT) AS asset_group_listing_group_filter_id,
+            IF(parent IS NULL, NULL,
+               'customers/{gads}/assetGroupListingGroupFilters/'
+               || (a + {_PMAX_CAMPAIGN_OFFSET}) || '~' || (a * 100 + parent))
+              AS asset_group_listing_group_filter_parent_listing_group_filter,
+            'customers/{gads}/assetGroups/' || (a + {_PMAX_CAMPAIGN_OFFSET})
+              AS asset_group_listing_group_filter_asset_group,
+            filter_type AS asset_group_listing_group_filter_type,
+            label_index
+              AS asset_group_listing_group_filter_case_value_product_custom_attribute_index,
+            label
+              AS asset_group_listing_group_filter_case_value_product_custom_attribute_value,
+            NULL::VARCHAR
+              AS asset_group_listing_group_filter_case_value_product_type_level,
+            NULL::VARCHAR
+              AS asset_group_listing_group_filter_case_value_product_type_value,
+            NULL::VARCHAR
+              AS asset_group_listing_group_filter_case_value_product_category_level,
+            NULL::VARCHAR
+              AS asset_group_listing_group_filter_case_value_product_category_category_id,
+            'UNSPECIFIED'
+              AS asset_group_listing_group_filter_case_value_product_channel_channel,
+            'UNSPECIFIED'
+              AS asset_group_listing_group_filter_case_value_product_condition_condition,
+            IF(brand IS NULL, NULL, 'brand_' || (a * 3 + brand) % {_BRANDS})
+              AS asset_group_listing_group_filter_case_value_product_brand_value,
+            NULL::VARCHAR
+              AS asset_group_listing_group_filter_case_value_product_item_id_value
+          FROM ({days})
+          CROSS JOIN range({options.asset_groups}) AS asset_groups(a)
+          CROSS JOIN (VALUES
+            (1, NULL, 'SUBDIVISION', NULL, NULL, NULL),
+            (2, 1, 'UNIT_INCLUDED', 0, NULL, NULL),
+            (3, 1, 'UNIT_INCLUDED', 1, NULL, NULL),
+            (4, 1, 'SUBDIVISION', 2, NULL, NULL),
+            (5, 4, 'UNIT_INCLUDED', NULL, 'INDEX0', 'cl0_1'),
+            (6, 4, 'UNIT_EXCLUDED', NULL, 'INDEX0', NULL),
+            (7, 1, 'UNIT_EXCLUDED', NULL, NULL, NULL)
+          ) AS nodes(node, parent, filter_type, brand, label_index, label)
+      """, '_DATA_DATE'),
+  )
+
+
+def create_tables(conn: duckdb.DuckDBPyConnection, options: Options, mc: str,
+                  gads: str, run_date: datetime.date,
+                  materialize: bool = True) -> None:
+  """Creates the generated tables in a DuckDB connection.
+
+  Args:
+    conn: DuckDB connection to create the tables in.
+    options: Knobs of the dataset.
+    mc: Merchant Center account id.
+    gads: Google Ads account id.
+    run_date: Run date of the scheduled query.
+    materialize: Whether to store the rows, views are created otherwise.
+  """
+  kind = 'TABLE' if materialize else 'VIEW'
+  for table in get_tables(options, mc, gads, run_date):
+    conn.execute(f'CREATE OR REPLACE {kind} "{table.name}" AS {table.query}')
+
+
+def write_tables(conn: duckdb.DuckDBPyConnection, options: Options, mc: str,
+                 gads: str, run_date: datetime.date, output_dir: str,
+                 file_format: str = 'parquet') -> Dict[str, int]:
+  """Streams the generated tables to partitioned files.
+
+  Every table is written to `output_dir/<table>/<partition>=<date>/`. The CSV
+  files hold the nested columns as JSON strings.
+
+  Args:
+    conn: DuckDB connection used to generate the rows.
+    options: Knobs of the dataset.
+    mc: Merchant Center account id.
+    gads: Google Ads account id.
+    run_date: Run date of the scheduled query.
+    output_dir: Directory to write the tables to.
+    file_format: parquet or csv.
+  Returns:
+    The number of rows written per table.
+  """
+  rows = {}
+  for table in get_tables(options, mc, gads, run_date):
+    conn.execute(f'CREATE OR REPLACE TEMP VIEW generated AS {table.query}')
+    query = 'SELECT * FROM generated'
+    if file_format == 'csv':
+      nested = [name for name, column_type, *_ in
+                conn.execute('DESCRIBE generated').fetchall()
+                if '[' in column_type or 'STRUCT' in column_type]
+      if nested:
+        query = ('SELECT * REPLACE ('
+                 + ', '.join(f'to_json({name}) AS {name}' for name in nested)
+                 + ') FROM generated')
+    copy_options = [f'FORMAT {file_format}', 'OVERWRITE_OR_IGNORE']
+    path = os.path.join(output_dir, table.name)
+    if table.partition_by:
+      copy_options.append(f'PARTITION_BY ({table.partition_by})')
+    else:
+      os.makedirs(path, exist_ok=True)
+      path = os.path.join(path, f'data.{file_format}')
+    if file_format == 'csv':
+      copy_options.append('HEADER')
+    rows[table.name] = conn.execute(
+        f"COPY ({query}) TO '{path}' ({', '.join(copy_options)})").fetchone()[0]
+  return rows
+
+
+def attach_tables(conn: duckdb.DuckDBPyConnection, data_dir: str) -> None:
+  """Creates a view over every Parquet table written by write_tables."""
+  for name in sorted(os.listdir(data_dir)):
+    files = os.path.join(data_dir, name, '**', '*.parquet')
+    conn.execute(f"""
+        CREATE OR REPLACE VIEW "{name}" AS
+        SELECT * FROM read_parquet('{files}', hive_partitioning = true)
+    """)
+
+
+def get_options_parser(parser: argparse.ArgumentParser) -> None:
+  """Adds the arguments of the dataset knobs to a parser."""
+  defaults = Options()
+  parser.add_argument('--offers', type=int, default=defaults.offers,
+                      help='Number of offers in the catalog.')
+  parser.add_argument('--variants_per_group', type=int,
+                      default=defaults.variants_per_group,
+                      help='Number of offers per item group.')
+  parser.add_argument('--countries', nargs='+',
+                      default=list(defaults.countries),
+                      help='Country codes the offers are sold in.')
+  parser.add_argument('--zero_click_share', type=float,
+                      default=defaults.zero_click_share,
+                      help='Share of the offers without any click.')
+  parser.add_argument('--days', type=int, default=defaults.days,
+                      help='Number of daily partitions before the run date.')
+  parser.add_argument('--asset_groups', type=int,
+                      default=defaults.asset_groups,
+                      help='Number of Performance Max asset groups.')
+  parser.add_argument('--seed', type=int, default=defaults.seed,
+                      help='Seed of the generated values.')
+  parser.add_argument('--feed_label', default=defaults.feed_label,
+                      help='Feed label of a multi-country feed, every offer '
+                      'is in a feed labelled with its country otherwise.')
+  parser.add_argument('--multi_label_share', type=float,
+                      default=defaults.multi_label_share,
+                      help='Share of the offers also listed under a second '
+                      'feed label.')
+
+
+def get_options(args: argparse.Namespace) -> Options:
+  """Returns the dataset knobs parsed by a get_options_parser parser."""
+  return Options(args.offers, args.variants_per_group, tuple(args.countries),
+                 args.zero_click_share, args.days, args.asset_groups,
+                 args.seed, args.feed_label, args.multi_label_share)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--output_dir', required=True,
+                      help='Directory to write the tables to.')
+  parser.add_argument('--format', choices=('parquet', 'csv'),
+                      default='parquet', help='Format of the files.')
+  parser.add_argument('--mc', default=DEFAULT_MC,
+                      help='Merchant Center account id.')
+  parser.add_argument('--gads', default=DEFAULT_GADS,
+                      help='Google Ads account id.')
+  parser.add_argument('--run_date', default=None,
+                      help='Run date as YYYY-MM-DD, today by default.')
+  parser.add_argument('--memory_limit', default=None,
+                      help='DuckDB memory limit, e.g. 4GB.')
+  get_options_parser(parser)
+  args = parser.parse_args(argv)
+  run_date = (datetime.date.fromisoformat(args.run_date) if args.run_date
+              else datetime.date.today())
+
+  conn = duckdb.connect()
+  # Lets DuckDB stream the rows instead of buffering them to keep their order.
+  conn.execute('SET preserve_insertion_order = false')
+  if args.memory_limit:
+    conn.execute(f"SET memory_limit = '{args.memory_limit}'")
+  rows = write_tables(conn, get_options(args), args.mc, args.gads, run_date,
+                      args.output_dir, args.format)
+  for name, count in rows.items():
+    print(f'{name}\t{count}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,348 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Resolves the targeted products with an in-process listing group index.
+
+The rows of criteria_view are compiled into one trie per date, merchant and
+country. Every level of the trie is a product dimension, the criteria leaving a
+dimension unset go down a wildcard branch and the exclusions of the criteria are
+checked at the leaves. The products are then streamed through the tries, so the
+work grows with the number of products instead of products times criteria. The
+`compare` command checks the result against targeted_products_view on the
+fixtures of sql_harness.py, e.g.:
+
+  python src/tools/targeting_engine.py compare --offers 100000
+"""
+
+import argparse
+import datetime
+import os
+import time
+from typing import (Dict, FrozenSet, Iterable, Iterator, List, Mapping,
+                    NamedTuple, Optional, Sequence, Tuple)
+
+import duckdb
+import sql_harness
+import synthetic_data
+
+# Dimensions of the criteria in trie level order, with the product_view column
+# holding the product value.
+DIMENSIONS = (
+    ('custom_label0', 'custom_labels.label_0'),
+    ('custom_label1', 'custom_labels.label_1'),
+    ('custom_label2', 'custom_labels.label_2'),
+    ('custom_label3', 'custom_labels.label_3'),
+    ('custom_label4', 'custom_labels.label_4'),
+    ('product_type_l1', 'product_type_l1'),
+    ('product_type_l2', 'product_type_l2'),
+    ('product_type_l3', 'product_type_l3'),
+    ('product_type_l4', 'product_type_l4'),
+    ('product_type_l5', 'product_type_l5'),
+    ('google_product_category_l1', 'google_product_category_l1'),
+    ('google_product_category_l2', 'google_product_category_l2'),
+    ('google_product_category_l3', 'google_product_category_l3'),
+    ('google_product_category_l4', 'google_product_category_l4'),
+    ('google_product_category_l5', 'google_product_category_l5'),
+    ('brand', 'brand'),
+    ('channel', 'channel'),
+    ('channel_exclusivity', 'channel_exclusivity'),
+    ('condition', 'condition'),
+)
+# Only the Performance Max criteria target offer ids, see targeted_products_view.
+_ID_TARGETING_SOURCE = 'pMax'
+_FETCH_ROWS = 100000
+
+# (dimension index, excluded values) pairs of a criterion.
+Exclusions = Tuple[Tuple[int, FrozenSet[str]], ...]
+TreeKey = Tuple[datetime.date, int, str]
+
+
+class Product(NamedTuple):
+  """A product_view row, the values are normalized by normalize_product."""
+  data_date: datetime.date
+  merchant_id: int
+  target_country: Optional[str]
+  product_id: str
+  offer_id: Optional[str]
+  values: Tuple[Optional[str], ...]  # One value per DIMENSIONS entry.
+
+
+class Resolution(NamedTuple):
+  """Targeting of a product."""
+  data_date: datetime.date
+  product_id: str
+  merchant_id: int
+  target_country: Optional[str]
+  targeted: bool
+
+
+def _normalize(value: Optional[str]) -> Optional[str]:
+  """Applies the TRIM(LOWER(...)) of the targeting queries."""
+  return None if value is None else value.lower().strip()
+
+
+class _Node(object):
+  """Trie node, the exclusions are only set on the leaves."""
+  __slots__ = ('children', 'wildcard', 'exclusions', 'matches_all')
+
+  def __init__(self):
+    self.children = {}
+    self.wildcard = None
+    self.exclusions = set()
+    self.matches_all = False
+
+
+class TargetingTree(object):
+  """Listing group criteria of a date, merchant and country."""
+
+  def __init__(self):
+    self._root = _Node()
+    self._offer_ids = set()
+
+  def add_criterion(self, values: Sequence[Optional[str]],
+                    exclusions: Exclusions) -> None:
+    """Adds a criterion without offer id.
+
+    Args:
+      values: Value of every DIMENSIONS entry, None when unset.
+      exclusions: Values excluded per dimension index.
+    """
+    node = self._root
+    for value in values:
+      if value is None:
+        if node.wildcard is None:
+          node.wildcard = _Node()
+        node = node.wildcard
+      else:
+        node = node.children.setdefault(value, _Node())
+    if exclusions:
+      node.exclusions.add(exclusions)
+    else:
+      node.matches_all = True
+
+  def add_offer_id(self, offer_id: str) -> None:
+    """Adds an offer id targeted by a criterion."""
+    self._offer_ids.add(_normalize(offer_id))
+
+  def matches(self, product: Product) -> bool:
+    """Returns whether a criterion of the tree targets the product."""
+    if product.offer_id is not None and product.offer_id in self._offer_ids:
+      return True
+    values = product.values
+    depth = len(values)
+    stack = [(self._root, 0)]
+    while stack:
+      node, level = stack.pop()
+      if level == depth:
+        if node.matches_all or any(
+            all(values[index] is None or values[index] not in excluded
+                for index, excluded in exclusions)
+            for exclusions in node.exclusions):
+          return True
+        continue
+      if node.wildcard is not None:
+        stack.append((node.wildcard, level + 1))
+      value = values[level]
+      if value is not None:
+        child = node.children.get(value)
+        if child is not None:
+          stack.append((child, level + 1))
+    return False
+
+
+class TargetingIndex(object):
+  """Targeting trees keyed by date, merchant and country."""
+
+  def __init__(self):
+    self._trees = {}  # type: Dict[TreeKey, TargetingTree]
+
+  def _get_tree(self, key: TreeKey) -> TargetingTree:
+    tree = self._trees.get(key)
+    if tree is None:
+      tree = self._trees[key] = TargetingTree()
+    return tree
+
+  def add_criteria_row(self, row: Mapping) -> None:
+    """Adds a criteria_view row.
+
+    Args:
+      row: Mapping with the columns of criteria_view.
+    """
+    key = (row['_DATA_DATE'], row['merchant_id'], row['target_country'])
+    if row['offer_id'] is not None:
+      if row['source'] == _ID_TARGETING_SOURCE:
+        self._get_tree(key).add_offer_id(row['offer_id'])
+      return
+    exclusions = tuple(
+        (index, frozenset(row[f'neg_{name}']))
+        for index, (name, _) in enumerate(DIMENSIONS) if row[f'neg_{name}'])
+    self._get_tree(key).add_criterion(
+        [row[name] for name, _ in DIMENSIONS], exclusions)
+
+  def resolve(self, products: Iterable[Product]) -> Iterator[Resolution]:
+    """Streams the products through the trees of their date and country."""
+    for product in products:
+      # NULL keys never satisfy the equality joins of the SQL.
+      tree = None
+      if None not in (product.data_date, product.merchant_id,
+                      product.target_country):
+        tree = self._trees.get((product.data_date, product.merchant_id,
+                                product.target_country))
+      yield Resolution(product.data_date, product.product_id,
+                       product.merchant_id, product.target_country,
+                       tree is not None and tree.matches(product))
+
+  def __len__(self) -> int:
+    return len(self._trees)
+
+
+def normalize_product(row: Sequence) -> Product:
+  """Builds a Product from a row of get_products_query."""
+  data_date, merchant_id, target_country, product_id, offer_id = row[:5]
+  return Product(data_date, merchant_id, target_country, product_id,
+                 _normalize(offer_id),
+                 tuple(_normalize(value) for value in row[5:]))
+
+
+def get_products_query(product_table: str) -> str:
+  """Returns the query of the product rows expected by normalize_product."""
+  columns = ', '.join(column for _, column in DIMENSIONS)
+  return (f'SELECT _DATA_DATE, merchant_id, target_country, product_id, '
+          f'offer_id, {columns} FROM "{product_table}"')
+
+
+def _fetch_rows(cursor, size: int = _FETCH_ROWS) -> Iterator[Sequence]:
+  """Streams the rows of an executed DuckDB query in batches."""
+  while True:
+    rows = cursor.fetchmany(size)
+    if not rows:
+      return
+    yield from rows
+
+
+def build_index(conn: duckdb.DuckDBPyConnection,
+                criteria_table: str) -> TargetingIndex:
+  """Compiles the rows of a criteria_view table into a TargetingIndex."""
+  index = TargetingIndex()
+  cursor = conn.execute(f'SELECT * FROM "{criteria_table}"')
+  names = [column[0] for column in cursor.description]
+  for row in _fetch_rows(cursor):
+    index.add_criteria_row(dict(zip(names, row)))
+  return index
+
+
+def resolve_table(conn: duckdb.DuckDBPyConnection, index: TargetingIndex,
+                  product_table: str) -> Iterator[Resolution]:
+  """Resolves the targeting of every row of a product_view table."""
+  cursor = conn.execute(get_products_query(product_table))
+  return index.resolve(normalize_product(row) for row in _fetch_rows(cursor))
+
+
+def _prepare(conn: duckdb.DuckDBPyConnection, args,
+             run_date: datetime.date, stages: Sequence[str]) -> None:
+  """Loads the fixture tables and runs the sql_harness.py stages."""
+  variables = sql_harness.load_variables(
+      os.path.join(sql_harness._ROOT_DIR, 'variables.tf'))  # pylint: disable=protected-access
+  if args.data_dir:
+    synthetic_data.attach_tables(conn, args.data_dir)
+  else:
+    synthetic_data.create_tables(conn, synthetic_data.get_options(args),
+                                 args.mc, args.gads, run_date)
+  for stage in sql_harness.STAGES:
+    if stage.name in stages:
+      conn.execute(sql_harness.get_stage_query(stage, variables, args.mc,
+                                               args.gads, run_date))
+
+
+def _timed_resolve(conn: duckdb.DuckDBPyConnection, args
+                  ) -> Tuple[List[Resolution], float, float, int]:
+  """Builds the index and resolves every product, with their timings."""
+  start = time.perf_counter()
+  index = build_index(conn, f'criteria_view_{args.gads}')
+  build_seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  resolutions = list(resolve_table(conn, index, f'product_view_{args.mc}'))
+  return (resolutions, build_seconds, time.perf_counter() - start,
+          len(index))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  subparsers = parser.add_subparsers(dest='command', required=True)
+  for command in ('run', 'compare'):
+    subparser = subparsers.add_parser(command)
+    subparser.add_argument('--mc', default=synthetic_data.DEFAULT_MC,
+                           help='Merchant Center account id.')
+    subparser.add_argument('--gads', default=synthetic_data.DEFAULT_GADS,
+                           help='Google Ads account id.')
+    subparser.add_argument('--run_date', default=None,
+                           help='Run date as YYYY-MM-DD, today by default.')
+    subparser.add_argument(
+        '--data_dir', default=None,
+        help='Directory of the tables written by synthetic_data.py, the '
+        'tables are generated in memory otherwise.')
+    synthetic_data.get_options_parser(subparser)
+  subparsers.choices['run'].add_argument(
+      '--output', default=None,
+      help='TSV file to write the product_id, country and targeted rows to.')
+  args = parser.parse_args(argv)
+  run_date = (datetime.date.fromisoformat(args.run_date) if args.run_date
+              else datetime.date.today())
+
+  stages = ['product_view', 'adgroup_criteria_view', 'pmax_criteria_view',
+            'criteria_view']
+  if args.command == 'compare':
+    stages.append('targeted_products_view')
+  conn = duckdb.connect()
+  _prepare(conn, args, run_date, stages)
+
+  resolutions, build_seconds, resolve_seconds, trees = _timed_resolve(
+      conn, args)
+  targeted = sum(resolution.targeted for resolution in resolutions)
+  print(f'{trees} trees built in {build_seconds:.3f}s, {len(resolutions)} '
+        f'products resolved in {resolve_seconds:.3f}s, {targeted} targeted')
+
+  if args.command == 'run':
+    if args.output:
+      with open(args.output, 'w') as output:
+        output.write('data_date\tproduct_id\tcountry\ttargeted\n')
+        for resolution in resolutions:
+          output.write(f'{resolution.data_date}\t{resolution.product_id}\t'
+                       f'{resolution.target_country}\t'
+                       f'{str(resolution.targeted).lower()}\n')
+    return
+
+  engine_rows = {(resolution.data_date, resolution.product_id,
+                  resolution.merchant_id, resolution.target_country)
+                 for resolution in resolutions if resolution.targeted}
+  start = time.perf_counter()
+  sql_rows = set(conn.execute(
+      'SELECT DISTINCT _DATA_DATE, product_id, merchant_id, target_country '
+      f'FROM "targeted_products_view_{args.gads}"').fetchall())
+  print(f'{len(sql_rows)} targeted rows read from targeted_products_view in '
+        f'{time.perf_counter() - start:.3f}s')
+  missing = sorted(sql_rows - engine_rows, key=str)
+  extra = sorted(engine_rows - sql_rows, key=str)
+  for name, rows in (('missing', missing), ('extra', extra)):
+    print(f'{len(rows)} {name} rows')
+    for row in rows[:10]:
+      print('\t' + '\t'.join(str(value) for value in row))
+  if missing or extra:
+    raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
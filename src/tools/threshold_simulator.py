@@ -0,0 +1,431 @@
+# coding=utf-8
+# Copyright 2023 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# python3
+"""Simulates the low volume skus selected by other threshold settings.
+
+The offer and item group aggregates of a LowVolumeSkus run are fetched once and
+cached as NumPy arrays. The clicks and impressions thresholds per country and
+feed label are then recomputed for every combination of zombies_deciles,
+zombies_clicks_decil, zombies_impressions_decil and zombies_sql_condition, e.g.:
+
+  python src/tools/threshold_simulator.py \
+    --table my-project.zombies.LowVolumeSkus_111_222_20230601 \
+    --cache /tmp/aggregates.npz --deciles 10 20 --clicks_decils 1 2 4 \
+    --conditions "offer_id_clicks = 0" "group_clicks <= clicks_threshold"
+"""
+
+import argparse
+import itertools
+import os
+import re
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+# Offer level columns of the LowVolumeSkus tables.
+_OFFER_COLUMNS = ('offer_id_clicks', 'offer_id_impressions')
+# Item group level columns of the LowVolumeSkus tables.
+_GROUP_COLUMNS = ('group_clicks', 'group_impressions', 'avg_group_clicks',
+                  'avg_group_impressions')
+_KEY_COLUMNS = ('offer_id', 'item_group_id', 'country', 'feed_label')
+_KEY_SEPARATOR = '\x1f'
+
+
+class Aggregates(NamedTuple):
+  """Offers and item groups of a run, as columnar arrays.
+
+  The groups are keyed by item group, country and feed label, the partitions by
+  country and feed label like the thresholds of the scheduled query.
+  """
+  partitions: np.ndarray  # (country, feed_label) strings per partition.
+  group_partition: np.ndarray  # Partition index per group.
+  group_columns: Dict[str, np.ndarray]  # _GROUP_COLUMNS values per group.
+  offer_group: np.ndarray  # Group index per offer.
+  offer_columns: Dict[str, np.ndarray]  # _OFFER_COLUMNS values per offer.
+
+
+class Result(NamedTuple):
+  """Low volume skus selected by a parameter combination."""
+  deciles: int
+  clicks_decil: int
+  impressions_decil: int
+  condition: str
+  skus: int
+  skus_per_partition: np.ndarray
+
+
+def get_aggregates(columns: Dict[str, Iterable]) -> Aggregates:
+  """Builds the aggregates from the columns of a LowVolumeSkus table.
+
+  Args:
+    columns: Values of the _KEY_COLUMNS, _OFFER_COLUMNS and _GROUP_COLUMNS, one
+      entry per distinct offer, item group, country and feed label.
+  Returns:
+    The aggregates of the run.
+  """
+  keys = {name: np.array(['' if value is None else str(value)
+                          for value in columns[name]], dtype=object)
+          for name in _KEY_COLUMNS}
+  partition_keys = keys['country'] + _KEY_SEPARATOR + keys['feed_label']
+  group_keys = keys['item_group_id'] + _KEY_SEPARATOR + partition_keys
+  _, group_first_offer, offer_group = np.unique(
+      group_keys.astype(str), return_index=True, return_inverse=True)
+  partitions, partition = np.unique(
+      partition_keys[group_first_offer].astype(str), return_inverse=True)
+  return Aggregates(
+      partitions=np.array([key.split(_KEY_SEPARATOR) for key in partitions]),
+      group_partition=partition.ravel(),
+      group_columns={
+          name: np.asarray(columns[name], dtype=float)[group_first_offer]
+          for name in _GROUP_COLUMNS},
+      offer_group=offer_group.ravel(),
+      offer_columns={name: np.asarray(columns[name], dtype=float)
+                     for name in _OFFER_COLUMNS})
+
+
+def fetch_from_bigquery(table: str, project: Optional[str] = None,
+                        client=None) -> Aggregates:
+  """Fetches the aggregates of a LowVolumeSkus table from BigQuery.
+
+  Args:
+    table: Fully qualified LowVolumeSkus table id.
+    project: Project the query job runs in.
+    client: bigquery.Client to use, created when not given.
+  Returns:
+    The aggregates of the run.
+  """
+  if client is None:
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    client = bigquery.Client(project=project)
+  columns = ', '.join(_KEY_COLUMNS + _OFFER_COLUMNS + _GROUP_COLUMNS)
+  arrow_table = client.query(
+      f'SELECT DISTINCT {columns} FROM `{table}`').result().to_arrow()
+  return get_aggregates(arrow_table.to_pydict())
+
+
+def load_tsv(path: str) -> Aggregates:
+  """Loads the aggregates of a LowVolumeSkus table written by sql_harness.py."""
+  import pyarrow.csv  # pylint: disable=g-import-not-at-top
+  arrow_table = pyarrow.csv.read_csv(
+      path, parse_options=pyarrow.csv.ParseOptions(delimiter='\t'),
+      convert_options=pyarrow.csv.ConvertOptions(
+          column_types={name: 'string' for name in _KEY_COLUMNS}))
+  rows = arrow_table.select(
+      list(_KEY_COLUMNS + _OFFER_COLUMNS + _GROUP_COLUMNS)).to_pylist()
+  distinct = list(dict.fromkeys(tuple(row.values()) for row in rows))
+  names = _KEY_COLUMNS + _OFFER_COLUMNS + _GROUP_COLUMNS
+  return get_aggregates({name: [row[i] for row in distinct]
+                         for i, name in enumerate(names)})
+
+
+def save(aggregates: Aggregates, path: str) -> None:
+  """Caches the aggregates in a compressed .npz file."""
+  arrays = {'partitions': aggregates.partitions,
+            'group_partition': aggregates.group_partition,
+            'offer_group': aggregates.offer_group}
+  arrays.update({f'group_{name}': values
+                 for name, values in aggregates.group_columns.items()})
+  arrays.update({f'offer_{name}': values
+                 for name, values in aggregates.offer_columns.items()})
+  with open(path, 'wb') as cache:
+    np.savez_compressed(cache, **arrays)
+
+
+def load(path: str) -> Aggregates:
+  """Loads aggregates cached by save."""
+  with np.load(path) as arrays:
+    return Aggregates(
+        partitions=arrays['partitions'],
+        group_partition=arrays['group_partition'],
+        group_columns={name: arrays[f'group_{name}']
+                       for name in _GROUP_COLUMNS},
+        offer_group=arrays['offer_group'],
+        offer_columns={name: arrays[f'offer_{name}']
+                       for name in _OFFER_COLUMNS})
+
+
+def compute_quantiles(values: np.ndarray, partition: np.ndarray,
+                      partitions: int, buckets: int) -> np.ndarray:
+  """Computes the quantile boundaries of the values of every partition.
+
+  Like APPROX_QUANTILES(values, buckets) the buckets + 1 boundaries, minimum
+  and maximum included, are returned. They are exact nearest rank quantiles,
+  as computed by the local harness.
+
+  Args:
+    values: Value of every element.
+    partition: Partition index of every element.
+    partitions: Number of partitions.
+    buckets: Number of quantile buckets.
+  Returns:
+    Array of shape (partitions, buckets + 1), NaN for empty partitions.
+  """
+  order = np.lexsort((values, partition))
+  sorted_values = np.append(values[order], np.nan)
+  counts = np.bincount(partition, minlength=partitions)
+  starts = np.cumsum(counts) - counts
+  # Nearest rank ceil(count * i / buckets) - 1, in integers to avoid rounding.
+  ranks = np.maximum(
+      -(-counts[:, None] * np.arange(buckets + 1)[None, :] // buckets) - 1, 0)
+  indices = starts[:, None] + ranks
+  indices[counts == 0] = len(values)
+  return sorted_values[indices]
+
+
+_TOKEN = re.compile(r'\s*(?:(\d+(?:\.\d*)?)|(\w+)|(<>|!=|<=|>=|[=<>()+\-*/]))')
+_COMPARISONS = {'=': np.equal, '!=': np.not_equal, '<>': np.not_equal,
+                '<': np.less, '<=': np.less_equal, '>': np.greater,
+                '>=': np.greater_equal}
+_ARITHMETIC = {'+': np.add, '-': np.subtract, '*': np.multiply,
+               '/': np.divide}
+
+
+class _ConditionParser(object):
+  """Parses a SQL boolean expression over the columns into a NumPy function.
+
+  Supports AND, OR, NOT, comparisons, arithmetic, parentheses, numbers and
+  column names, which covers the usual zombies_sql_condition values.
+  """
+
+  def __init__(self, condition: str):
+    self._tokens = []
+    position = 0
+    condition = condition.strip()
+    while position < len(condition):
+      match = _TOKEN.match(condition, position)
+      if not match or match.end() == position:
+        raise ValueError(f'Unsupported condition syntax at: '
+                         f'{condition[position:]}')
+      number, name, symbol = match.groups()
+      if number:
+        self._tokens.append(('number', float(number)))
+      elif name:
+        upper = name.upper()
+        self._tokens.append(
+            ('keyword', upper) if upper in ('AND', 'OR', 'NOT', 'TRUE', 'FALSE')
+            else ('column', name.lower()))
+      else:
+        self._tokens.append(('symbol', symbol))
+      position = match.end()
+    self._position = 0
+
+  def parse(self) -> Callable[[Dict[str, np.ndarray]], np.ndarray]:
+    function = self._parse_or()
+    if self._position != len(self._tokens):
+      raise ValueError(f'Unexpected token {self._tokens[self._position][1]}')
+    return function
+
+  def _peek(self):
+    if self._position < len(self._tokens):
+      return self._tokens[self._position]
+    return (None, None)
+
+  def _accept(self, *values) -> Optional[str]:
+    kind, value = self._peek()
+    if kind in ('keyword', 'symbol') and value in values:
+      self._position += 1
+      return value
+    return None
+
+  def _parse_or(self):
+    left = self._parse_and()
+    while self._accept('OR'):
+      left = (lambda l, r: lambda c: np.logical_or(l(c), r(c)))(
+          left, self._parse_and())
+    return left
+
+  def _parse_and(self):
+    left = self._parse_not()
+    while self._accept('AND'):
+      left = (lambda l, r: lambda c: np.logical_and(l(c), r(c)))(
+          left, self._parse_not())
+    return left
+
+  def _parse_not(self):
+    if self._accept('NOT'):
+      operand = self._parse_not()
+      return lambda c: np.logical_not(operand(c))
+    return self._parse_comparison()
+
+  def _parse_comparison(self):
+    left = self._parse_sum()
+    operator = self._accept(*_COMPARISONS)
+    if operator:
+      left = (lambda l, r, f: lambda c: f(l(c), r(c)))(
+          left, self._parse_sum(), _COMPARISONS[operator])
+    return left
+
+  def _parse_sum(self):
+    left = self._parse_product()
+    operator = self._accept('+', '-')
+    while operator:
+      left = (lambda l, r, f: lambda c: f(l(c), r(c)))(
+          left, self._parse_product(), _ARITHMETIC[operator])
+      operator = self._accept('+', '-')
+    return left
+
+  def _parse_product(self):
+    left = self._parse_atom()
+    operator = self._accept('*', '/')
+    while operator:
+      left = (lambda l, r, f: lambda c: f(l(c), r(c)))(
+          left, self._parse_atom(), _ARITHMETIC[operator])
+      operator = self._accept('*', '/')
+    return left
+
+  def _parse_atom(self):
+    if self._accept('('):
+      expression = self._parse_or()
+      if not self._accept(')'):
+        raise ValueError('Missing closing parenthesis')
+      return expression
+    if self._accept('-'):
+      operand = self._parse_atom()
+      return lambda c: np.negative(operand(c))
+    kind, value = self._peek()
+    self._position += 1
+    if kind == 'number':
+      return lambda c: value
+    if kind == 'keyword' and value in ('TRUE', 'FALSE'):
+      return lambda c: value == 'TRUE'
+    if kind == 'column':
+      return lambda c: c[value]
+    raise ValueError(f'Unexpected token {value}')
+
+
+def compile_condition(
+    condition: str) -> Callable[[Dict[str, np.ndarray]], np.ndarray]:
+  """Compiles a zombies_sql_condition into a function of the offer columns.
+
+  Args:
+    condition: SQL condition over the columns of the LowVolumeSkus tables.
+  Returns:
+    A function taking a dict of offer level arrays and returning the mask of
+    the selected offers.
+  Raises:
+    ValueError: If the condition uses an unsupported syntax.
+  """
+  return _ConditionParser(condition).parse()
+
+
+def simulate(aggregates: Aggregates, deciles: Iterable[int],
+             clicks_decils: Iterable[int], impressions_decils: Iterable[int],
+             conditions: Iterable[str]) -> List[Result]:
+  """Counts the low volume skus of every parameter combination.
+
+  Every group gets the thresholds of its own country and feed label.
+
+  Args:
+    aggregates: Aggregates of a run.
+    deciles: zombies_deciles values.
+    clicks_decils: zombies_clicks_decil values.
+    impressions_decils: zombies_impressions_decil values.
+    conditions: zombies_sql_condition values.
+  Returns:
+    The results of the valid combinations, the decils must not exceed the
+    number of deciles.
+  """
+  compiled = [(condition, compile_condition(condition))
+              for condition in conditions]
+  offer_partition = aggregates.group_partition[aggregates.offer_group]
+  columns = dict(aggregates.offer_columns)
+  columns.update({name: values[aggregates.offer_group]
+                  for name, values in aggregates.group_columns.items()})
+  partitions = len(aggregates.partitions)
+  results = []
+  for buckets in deciles:
+    clicks_quantiles = compute_quantiles(
+        aggregates.group_columns['group_clicks'], aggregates.group_partition,
+        partitions, buckets)
+    impressions_quantiles = compute_quantiles(
+        aggregates.group_columns['group_impressions'],
+        aggregates.group_partition, partitions, buckets)
+    for clicks_decil, impressions_decil in itertools.product(
+        clicks_decils, impressions_decils):
+      if clicks_decil > buckets or impressions_decil > buckets:
+        continue
+      columns['clicks_threshold'] = clicks_quantiles[offer_partition,
+                                                     clicks_decil]
+      columns['impressions_threshold'] = impressions_quantiles[
+          offer_partition, impressions_decil]
+      for condition, function in compiled:
+        mask = np.broadcast_to(function(columns), offer_partition.shape)
+        skus_per_partition = np.bincount(offer_partition[mask],
+                                         minlength=partitions)
+        results.append(Result(buckets, clicks_decil, impressions_decil,
+                              condition, int(skus_per_partition.sum()),
+                              skus_per_partition))
+  return results
+
+
+def _get_aggregates(args) -> Aggregates:
+  """Loads the cached aggregates or fetches and caches them."""
+  if args.cache and os.path.exists(args.cache):
+    return load(args.cache)
+  if args.table:
+    aggregates = fetch_from_bigquery(args.table, args.project)
+  elif args.tsv:
+    aggregates = load_tsv(args.tsv)
+  else:
+    raise ValueError('--table or --tsv is required without a cache')
+  if args.cache:
+    save(aggregates, args.cache)
+  return aggregates
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--table', default=None,
+                      help='Fully qualified LowVolumeSkus table to fetch.')
+  parser.add_argument('--project', default=None,
+                      help='Project running the fetch query.')
+  parser.add_argument('--tsv', default=None,
+                      help='LowVolumeSkus table written by sql_harness.py.')
+  parser.add_argument('--cache', default=None,
+                      help='.npz file caching the aggregates, read when it '
+                      'exists and written otherwise.')
+  parser.add_argument('--deciles', type=int, nargs='+', default=[10],
+                      help='zombies_deciles values.')
+  parser.add_argument('--clicks_decils', type=int, nargs='+', default=[4],
+                      help='zombies_clicks_decil values.')
+  parser.add_argument('--impressions_decils', type=int, nargs='+',
+                      default=[2], help='zombies_impressions_decil values.')
+  parser.add_argument('--conditions', nargs='+',
+                      default=['offer_id_clicks = 0'],
+                      help='zombies_sql_condition values.')
+  parser.add_argument('--by_partition', action='store_true',
+                      help='Print the skus of every country and feed label.')
+  args = parser.parse_args(argv)
+
+  aggregates = _get_aggregates(args)
+  offers = len(aggregates.offer_group)
+  print(f'{offers} offers, {len(aggregates.group_partition)} groups, '
+        f'{len(aggregates.partitions)} country and feed label partitions')
+  print('deciles\tclicks_decil\timpressions_decil\tcondition\tskus\tshare')
+  results = simulate(aggregates, args.deciles, args.clicks_decils,
+                     args.impressions_decils, args.conditions)
+  for result in results:
+    print(f'{result.deciles}\t{result.clicks_decil}\t'
+          f'{result.impressions_decil}\t{result.condition}\t{result.skus}\t'
+          f'{result.skus / max(offers, 1):.3f}')
+    if args.by_partition:
+      for (country, feed_label), skus in zip(aggregates.partitions,
+                                             result.skus_per_partition):
+        print(f'\t{country}\t{feed_label}\t{skus}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,258 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Materialized targeted products.
+#
+# When zombies_materialize_targeted_products is true the targeted products are stored in a date partitioned table
+# clustered by the normalized offer id and country. A scheduled query appends the partition of the latest
+# Merchant Center snapshot of its run date before the low volume skus query runs, so the latter reads a single
+# partition instead of expanding the stack of views over the whole history. Running it for a past run date, as
+# src/bq_transfers/backfill.py does, appends the partition of that date.
+
+resource "google_bigquery_table" "targeted_products" {
+  depends_on = [google_bigquery_dataset.zombies_dataset]
+
+  for_each = { for pair in var.accounts_table : "${pair.mc}_${pair.gads}" => pair if var.zombies_materialize_targeted_products }
+
+  dataset_id = google_bigquery_dataset.zombies_dataset.dataset_id
+  table_id   = "targeted_products_${each.value.mc}_${each.value.gads}"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = "DAY"
+    field = "_DATA_DATE"
+  }
+
+  clustering = ["offer_id", "country"]
+
+  schema = <<EOF
+[
+  {"name": "_DATA_DATE", "type": "DATE", "mode": "NULLABLE", "description": "Date of the Merchant Center snapshot"},
+  {"name": "merchant_id", "type": "INTEGER", "mode": "NULLABLE", "description": "Merchant account id"},
+  {"name": "product_id", "type": "STRING", "mode": "NULLABLE", "description": "Merchant Center product id"},
+  {"name": "offer_id", "type": "STRING", "mode": "NULLABLE", "description": "Trimmed and lower cased offer id of the product id"},
+  {"name": "country", "type": "STRING", "mode": "NULLABLE", "description": "Lower cased target country"}
+]
+EOF
+}
+
+resource "google_bigquery_data_transfer_config" "targeted_products_refresh" {
+  depends_on = [google_project_iam_member.permissions_token,
+    google_project_service.enable_bqdt,
+    google_bigquery_job.criteria_view,
+    google_bigquery_job.product_view,
+    google_bigquery_table.targeted_products
+  ]
+  for_each = { for pair in var.accounts_table : "${pair.mc}_${pair.gads}" => pair if var.zombies_materialize_targeted_products }
+
+  display_name         = "targeted_products_${each.value.mc}_${each.value.gads}"
+  location             = var.zombies_data_location
+  data_source_id       = "scheduled_query"
+  schedule             = var.zombies_targeted_products_schedule
+  service_account_name = google_service_account.service_account.email
+
+  # With readiness gating, readiness.py starts the refresh before the low volume skus query of the pair.
+  schedule_options {
+    disable_auto_scheduling = var.zombies_readiness_gating
+  }
+
+  params = {
+    query = <<EOF
+      # Copyright 2023 Google LLC
+      #
+      # Licensed under the Apache License, Version 2.0 (the "License");
+      # you may not use this file except in compliance with the License.
+      # You may obtain a copy of the License at
+      #
+      #     https://www.apache.org/licenses/LICENSE-2.0
+      #
+      # Unless required by applicable law or agreed to in writing, software
+      # distributed under the License is distributed on an "AS IS" BASIS,
+      # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+      # See the License for the specific language governing permissions and
+      # limitations under the License.
+      # Appends the targeted products of the latest Merchant Center snapshot of the run date.
+      #
+      # The product attributes are normalized once per product, the criteria joins then compare plain columns.
+
+      DECLARE data_date DATE DEFAULT (
+        SELECT MAX(_PARTITIONDATE)
+        FROM `${var.gcp_merchant_and_gads_dataset_project}.${var.merchant_dataset_name}.Products_${each.value.mc}`
+        WHERE _PARTITIONDATE <= @run_date);
+
+      IF NOT EXISTS (
+        SELECT 1
+        FROM `${var.gcp_project}.${var.zombies_dataset_name}.targeted_products_${each.value.mc}_${each.value.gads}`
+        WHERE _DATA_DATE = data_date) THEN
+        INSERT INTO `${var.gcp_project}.${var.zombies_dataset_name}.targeted_products_${each.value.mc}_${each.value.gads}`
+          (_DATA_DATE, merchant_id, product_id, offer_id, country)
+        WITH
+          Products AS (
+          SELECT
+            _DATA_DATE,
+            product_id,
+            merchant_id,
+            target_country,
+            TRIM(LOWER(offer_id)) AS offer_id,
+            TRIM(LOWER(custom_labels.label_0)) AS custom_label0,
+            TRIM(LOWER(custom_labels.label_1)) AS custom_label1,
+            TRIM(LOWER(custom_labels.label_2)) AS custom_label2,
+            TRIM(LOWER(custom_labels.label_3)) AS custom_label3,
+            TRIM(LOWER(custom_labels.label_4)) AS custom_label4,
+            TRIM(LOWER(product_type_l1)) AS product_type_l1,
+            TRIM(LOWER(product_type_l2)) AS product_type_l2,
+            TRIM(LOWER(product_type_l3)) AS product_type_l3,
+            TRIM(LOWER(product_type_l4)) AS product_type_l4,
+            TRIM(LOWER(product_type_l5)) AS product_type_l5,
+            TRIM(LOWER(google_product_category_l1)) AS google_product_category_l1,
+            TRIM(LOWER(google_product_category_l2)) AS google_product_category_l2,
+            TRIM(LOWER(google_product_category_l3)) AS google_product_category_l3,
+            TRIM(LOWER(google_product_category_l4)) AS google_product_category_l4,
+            TRIM(LOWER(google_product_category_l5)) AS google_product_category_l5,
+            TRIM(LOWER(brand)) AS brand,
+            TRIM(LOWER(channel)) AS channel,
+            TRIM(LOWER(channel_exclusivity)) AS channel_exclusivity,
+            TRIM(LOWER(condition)) AS condition
+          FROM
+            `${var.gcp_project}.${var.zombies_dataset_name}.product_view_${each.value.mc}`
+          WHERE
+            _DATA_DATE = data_date
+          ),
+          Criteria AS (
+          SELECT
+            *
+          FROM
+            `${var.gcp_project}.${var.zombies_dataset_name}.criteria_view_${each.value.gads}`
+          WHERE
+            _DATA_DATE = data_date
+          ),
+          IdTargetedOffer AS (
+          SELECT DISTINCT
+            merchant_id,
+            target_country,
+            offer_id
+          FROM
+            `${var.gcp_project}.${var.zombies_dataset_name}.pmax_criteria_view_${each.value.gads}`
+          WHERE
+            _DATA_DATE = data_date
+            AND offer_id IS NOT NULL
+          ),
+          IdTargeted AS (
+          SELECT
+            Products._DATA_DATE,
+            Products.product_id,
+            Products.merchant_id,
+            Products.target_country
+          FROM
+            Products
+          INNER JOIN IdTargetedOffer
+            ON
+            IdTargetedOffer.merchant_id = Products.merchant_id
+            AND IdTargetedOffer.target_country = Products.target_country
+            AND TRIM(LOWER(IdTargetedOffer.offer_id)) = Products.offer_id
+          ),
+          NonIdTargeted AS (
+          SELECT
+            Products._DATA_DATE,
+            Products.product_id,
+            Products.merchant_id,
+            Products.target_country
+          FROM
+            Products
+          INNER JOIN Criteria
+            ON
+            Criteria.merchant_id = Products.merchant_id
+            AND Criteria.target_country = Products.target_country
+            AND (Criteria.custom_label0 IS NULL OR Criteria.custom_label0 = Products.custom_label0)
+            AND (Criteria.custom_label1 IS NULL OR Criteria.custom_label1 = Products.custom_label1)
+            AND (Criteria.custom_label2 IS NULL OR Criteria.custom_label2 = Products.custom_label2)
+            AND (Criteria.custom_label3 IS NULL OR Criteria.custom_label3 = Products.custom_label3)
+            AND (Criteria.custom_label4 IS NULL OR Criteria.custom_label4 = Products.custom_label4)
+            AND (Criteria.product_type_l1 IS NULL OR Criteria.product_type_l1 = Products.product_type_l1)
+            AND (Criteria.product_type_l2 IS NULL OR Criteria.product_type_l2 = Products.product_type_l2)
+            AND (Criteria.product_type_l3 IS NULL OR Criteria.product_type_l3 = Products.product_type_l3)
+            AND (Criteria.product_type_l4 IS NULL OR Criteria.product_type_l4 = Products.product_type_l4)
+            AND (Criteria.product_type_l5 IS NULL OR Criteria.product_type_l5 = Products.product_type_l5)
+            AND (
+              Criteria.google_product_category_l1 IS NULL
+              OR Criteria.google_product_category_l1 = Products.google_product_category_l1)
+            AND (
+              Criteria.google_product_category_l2 IS NULL
+              OR Criteria.google_product_category_l2 = Products.google_product_category_l2)
+            AND (
+              Criteria.google_product_category_l3 IS NULL
+              OR Criteria.google_product_category_l3 = Products.google_product_category_l3)
+            AND (
+              Criteria.google_product_category_l4 IS NULL
+              OR Criteria.google_product_category_l4 = Products.google_product_category_l4)
+            AND (
+              Criteria.google_product_category_l5 IS NULL
+              OR Criteria.google_product_category_l5 = Products.google_product_category_l5)
+            AND (Criteria.brand IS NULL OR Criteria.brand = Products.brand)
+            AND (Criteria.channel IS NULL OR Criteria.channel = Products.channel)
+            AND (
+              Criteria.channel_exclusivity IS NULL
+              OR Criteria.channel_exclusivity = Products.channel_exclusivity)
+            AND (Criteria.condition IS NULL OR Criteria.condition = Products.condition)
+            AND (Products.custom_label0 IS NULL OR Products.custom_label0 NOT IN UNNEST(neg_custom_label0))
+            AND (Products.custom_label1 IS NULL OR Products.custom_label1 NOT IN UNNEST(neg_custom_label1))
+            AND (Products.custom_label2 IS NULL OR Products.custom_label2 NOT IN UNNEST(neg_custom_label2))
+            AND (Products.custom_label3 IS NULL OR Products.custom_label3 NOT IN UNNEST(neg_custom_label3))
+            AND (Products.custom_label4 IS NULL OR Products.custom_label4 NOT IN UNNEST(neg_custom_label4))
+            AND (Products.product_type_l1 IS NULL OR Products.product_type_l1 NOT IN UNNEST(neg_product_type_l1))
+            AND (Products.product_type_l2 IS NULL OR Products.product_type_l2 NOT IN UNNEST(neg_product_type_l2))
+            AND (Products.product_type_l3 IS NULL OR Products.product_type_l3 NOT IN UNNEST(neg_product_type_l3))
+            AND (Products.product_type_l4 IS NULL OR Products.product_type_l4 NOT IN UNNEST(neg_product_type_l4))
+            AND (Products.product_type_l5 IS NULL OR Products.product_type_l5 NOT IN UNNEST(neg_product_type_l5))
+            AND (
+              Products.google_product_category_l1 IS NULL
+              OR Products.google_product_category_l1 NOT IN UNNEST(neg_google_product_category_l1))
+            AND (
+              Products.google_product_category_l2 IS NULL
+              OR Products.google_product_category_l2 NOT IN UNNEST(neg_google_product_category_l2))
+            AND (
+              Products.google_product_category_l3 IS NULL
+              OR Products.google_product_category_l3 NOT IN UNNEST(neg_google_product_category_l3))
+            AND (
+              Products.google_product_category_l4 IS NULL
+              OR Products.google_product_category_l4 NOT IN UNNEST(neg_google_product_category_l4))
+            AND (
+              Products.google_product_category_l5 IS NULL
+              OR Products.google_product_category_l5 NOT IN UNNEST(neg_google_product_category_l5))
+            AND (Products.brand IS NULL OR Products.brand NOT IN UNNEST(neg_brand))
+            AND (Products.channel IS NULL OR Products.channel NOT IN UNNEST(neg_channel))
+            AND (
+              Products.channel_exclusivity IS NULL
+              OR Products.channel_exclusivity NOT IN UNNEST(neg_channel_exclusivity))
+            AND (Products.condition IS NULL OR Products.condition NOT IN UNNEST(neg_condition))
+          WHERE
+            Criteria.offer_id IS NULL
+          ),
+          TargetedProducts AS (
+          SELECT * FROM IdTargeted
+          UNION ALL
+          SELECT * FROM NonIdTargeted
+          )
+        SELECT DISTINCT
+          _DATA_DATE,
+          merchant_id,
+          product_id,
+          LOWER(SPLIT(product_id, ':')[ARRAY_LENGTH(SPLIT(product_id, ':')) - 1]) AS offer_id,
+          LOWER(target_country) AS country
+        FROM
+          TargetedProducts;
+      END IF;
+    EOF
+  }
+}
@@ -113,6 +113,24 @@ variable "zombies_schedule" {
   default     = "every day 03:00"
 }
 
+variable "zombies_schedule_offsets" {
+  type        = map(number)
+  description = "Minutes after zombies_schedule each pair's BQ scheduled query starts, keyed by <mc>_<gads>, written to zombies_schedule.auto.tfvars.json by src/tools/schedule_planner.py"
+  default     = {}
+}
+
+variable "zombies_readiness_gating" {
+  type        = bool
+  description = "true to disable zombies_schedule, the BQ scheduled queries and their refreshes are then started by src/bq_transfers/readiness.py once the transfers of their pair landed"
+  default     = false
+}
+
+variable "zombies_readiness_trigger" {
+  type        = string
+  description = "Job running src/bq_transfers/readiness.py every day, e.g. a cron entry or a Cloud Scheduler job, required by zombies_readiness_gating"
+  default     = ""
+}
+
 variable "zombies_pubsub_topic" {
   type        = string
   description = "Topic to publish the pubsub message to"
@@ -143,6 +161,30 @@ variable "zombies_clicks_decil" {
   default     = 4
 }
 
+variable "zombies_materialize_targeted_products" {
+  type        = bool
+  description = "true to append the targeted products of each day to a partitioned table read by the scheduled query instead of the targeted_products_view"
+  default     = false
+}
+
+variable "zombies_targeted_products_schedule" {
+  type        = string
+  description = "Schedule of the refresh of the targeted products table, must run before zombies_schedule"
+  default     = "every day 02:00"
+}
+
+variable "zombies_incremental_aggregates" {
+  type        = bool
+  description = "true to keep the daily clicks, impressions and item groups of the offers in partitioned tables rolled forward every day and summed by the scheduled query instead of rescanning 31 days"
+  default     = false
+}
+
+variable "zombies_daily_stats_schedule" {
+  type        = string
+  description = "Schedule of the refresh of the daily aggregate tables, must run after the transfers and before zombies_schedule"
+  default     = "every day 02:00"
+}
+
 variable "generate_feed_files" {
   type        = bool
   description = "true or false to indicate if Cloud Functions to generate files in Google Cloud Storage must be deployed"
@@ -155,6 +197,90 @@ variable "zombies_feed_label_index" {
   default     = "4"
 }
 
+variable "zombies_feed_mode" {
+  type        = string
+  description = "full to rewrite the whole supplemental feed every run, delta to only export the offers added or removed since the previous run"
+  default     = "full"
+}
+
+variable "zombies_feed_snapshot_weekday" {
+  type        = number
+  description = "ISO weekday (1 is Monday, 7 is Sunday) on which the full feed is exported when zombies_feed_mode is delta"
+  default     = 7
+}
+
+variable "zombies_feed_compression" {
+  type        = string
+  description = "none to write plain feed files, gzip to compress them"
+  default     = "none"
+}
+
+variable "zombies_feed_sharding" {
+  type        = string
+  description = "none to write the full feed under a single prefix, country to split it per country and feed label and only rewrite the changed shards"
+  default     = "none"
+}
+
+variable "zombies_feed_shard_max_rows" {
+  type        = number
+  description = "Target number of rows of a feed shard when zombies_feed_sharding is country"
+  default     = 1000000
+}
+
+variable "zombies_feed_batch_window_seconds" {
+  type        = number
+  description = "Seconds during which the completed account pairs are collected and exported by a single script, 0 exports every pair on its own"
+  default     = 0
+}
+
+variable "zombies_feed_delivery" {
+  type        = string
+  description = "gcs to write the supplemental feed files, content_api to push the labels to Merchant Center with the Content API"
+  default     = "gcs"
+}
+
+variable "zombies_content_api_feed_ids" {
+  type        = map(string)
+  description = "Content API supplemental feed id per merchant account id, used when zombies_feed_delivery is content_api"
+  default     = {}
+}
+
+variable "zombies_push_batch_size" {
+  type        = number
+  description = "Label updates per products.custombatch request"
+  default     = 1000
+}
+
+variable "zombies_push_concurrency" {
+  type        = number
+  description = "Concurrent products.custombatch requests"
+  default     = 8
+}
+
+variable "zombies_run_ledger" {
+  type        = string
+  description = "bigquery to export every LowVolumeSkus table version once and skip duplicate notifications, none to export on every notification"
+  default     = "bigquery"
+}
+
+variable "zombies_input_fingerprints" {
+  type        = bool
+  description = "true to record the fingerprint of the source partitions and thresholds of every run in the input_fingerprints table and skip the export, and with zombies_readiness_gating the scoring, of a run whose inputs did not change"
+  default     = false
+}
+
+variable "zombies_spans_exporter" {
+  type        = string
+  description = "none to disable the timing spans of the Cloud Function, jsonl to log them as JSON lines, otel to send them to OpenTelemetry"
+  default     = "none"
+}
+
+variable "zombies_track_export_jobs" {
+  type        = bool
+  description = "true to wait for the feed export jobs and record their statistics in the feed_runs table"
+  default     = false
+}
+
 variable "accounts_table" {
   type = map(object({
     mc      = string,